@@ -0,0 +1,145 @@
+"""
+Broadcaster against a fake Bot API.
+
+    python bench/bench_broadcast.py [--users 600] [--rate 30] [--blocked 0.05]
+
+The fake bot answers after --latency seconds, raises Forbidden for a
+--blocked fraction of users and RetryAfter whenever more than --limit
+messages went out in the last second (Telegram's flood control). The job
+starts in a child process that is SIGKILLed halfway, in the middle of a
+chunk, and is resumed here by a fresh Broadcaster from what the child left
+on disk. Reports throughput, flood waits, the size of a checkpoint and how
+many chats got the message twice (must be none), and checks that every
+blocked chat, including those the killed child found, is marked inactive.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import Forbidden, RetryAfter  # noqa: E402
+
+from broadcast import Broadcaster  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, latency: float, limit: int, blocked: set, delivered_path: str = ""):
+        self.latency = latency
+        self.limit = limit
+        self.blocked = blocked
+        self.window = collections.deque()
+        self.received = collections.Counter()
+        self.flood_errors = 0
+        # The child's deliveries go to a file too, so they outlive its kill
+        self.delivered = open(delivered_path, "a", buffering=1) if delivered_path else None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        while self.window and now - self.window[0] > 1.0:
+            self.window.popleft()
+        if len(self.window) >= self.limit:
+            self.flood_errors += 1
+            raise RetryAfter(1)
+        self.window.append(now)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if chat_id >= 0:
+            self.received[chat_id] += 1
+            if self.delivered is not None:
+                self.delivered.write(f"{chat_id}\n")
+
+
+def blocked_users(users: int, share: float) -> set:
+    return set(random.Random(1).sample(range(users), int(users * share)))
+
+
+async def child(state: str, delivered: str, users: int, rate: float, limit: int,
+                blocked_share: float, latency: float):
+    """The first process: starts the job and runs until the parent kills it."""
+    bot = FakeBot(latency, limit, blocked_users(users, blocked_share), delivered)
+    first = Broadcaster(state, rate)
+    first.start(bot, {"text": "new files in DATA"}, range(users))
+    await first._task
+
+
+def count_lines(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+async def run(users: int, rate: float, limit: int, blocked_share: float, latency: float):
+    blocked = blocked_users(users, blocked_share)
+    workdir = tempfile.mkdtemp()
+    state = os.path.join(workdir, "broadcast.json")
+    delivered_path = os.path.join(workdir, "delivered.txt")
+    chunk = max(1, int(rate))
+
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", state, delivered_path,
+                             "--users", str(users), "--rate", str(rate), "--limit", str(limit),
+                             "--blocked", str(blocked_share), "--latency", str(latency)])
+    # Halfway and half a chunk in: the last checkpoint is behind what was delivered
+    target = (users - len(blocked)) // 2 + chunk // 2
+    while count_lines(delivered_path) < target and proc.poll() is None:
+        await asyncio.sleep(0.005)
+    proc.send_signal(signal.SIGKILL)
+    proc.wait()
+    with open(state) as f:
+        at_kill = json.load(f)
+
+    bot = FakeBot(latency, limit, blocked)
+    with open(delivered_path) as f:
+        bot.received.update(int(line) for line in f)
+    past_checkpoint = sum(1 for chat_id in bot.received if chat_id >= at_kill["position"])
+    marked = []
+    second = Broadcaster(state, rate)
+    assert second.resume(bot, on_blocked=marked.append)
+    await second._task
+    elapsed = time.perf_counter() - started
+
+    job = second.job
+    delivered = len(bot.received)
+    duplicates = sum(1 for n in bot.received.values() if n > 1)
+    print(f"users={users} rate={rate:g}/s: {elapsed:.1f}s ({users / elapsed:.1f} msgs/s), "
+          f"state={job['state']} sent={job['sent']} blocked={job['blocked']} failed={job['failed']}")
+    print(f"  killed with the checkpoint at position {at_kill['position']} and {past_checkpoint} chats past it "
+          f"already delivered; checkpoint {os.path.getsize(state)} bytes, recipients file "
+          f"{os.path.getsize(second.recipients_path)} bytes (written once)")
+    print(f"  delivered to {delivered}/{users - len(blocked)} reachable chats, "
+          f"{duplicates} duplicates after the kill, {len(set(marked))} marked inactive, "
+          f"{bot.flood_errors} RetryAfter from the fake API")
+    assert duplicates == 0, "chats got the message twice"
+    assert delivered == users - len(blocked) and job["sent"] == delivered, "chats missed or miscounted"
+    # The child's marks died with it (never saved); resume must report every blocked chat again
+    assert set(marked) == blocked, "blocked chats not marked inactive"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=600)
+    parser.add_argument("--rate", type=float, default=30)
+    parser.add_argument("--limit", type=int, default=30, help="fake API's msgs/s before RetryAfter")
+    parser.add_argument("--blocked", type=float, default=0.05)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--child", nargs=2, metavar=("STATE", "DELIVERED"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(*args.child, args.users, args.rate, args.limit, args.blocked, args.latency))
+        return
+    asyncio.run(run(args.users, args.rate, args.limit, args.blocked, args.latency))
+
+
+if __name__ == "__main__":
+    main()
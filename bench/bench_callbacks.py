@@ -0,0 +1,100 @@
+"""
+Per-update CPU cost of callback dispatch and keyboard construction.
+
+    python bench/bench_callbacks.py [--n 200000]
+
+"legacy" replays the old if/elif chain with data.split("_") and rebuilds
+the bottom nav on every call; "router" uses main.callbacks.resolve() and
+the prebuilt keyboards.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+import main  # noqa: E402
+from config import NAV_DEEPSEEK, NAV_HOME, NAV_SETTINGS  # noqa: E402
+
+# Mix weighted towards the routes that used to sit at the end of the chain
+SAMPLE = [
+    "nav_home", "top_data", "data_page_3", "file_12", "download_12", "details_12",
+    "font_code", "popup_disable", "feedback_open", "ds_mode_coder",
+]
+
+
+def legacy_resolve(data: str):
+    if data == "nav_home":
+        return "home"
+    elif data == "nav_deepseek":
+        return "deepseek"
+    elif data == "nav_settings":
+        return "settings"
+    elif data == "top_data":
+        return "data", 0
+    elif data.startswith("data_page_"):
+        return "data", int(data.split("_")[-1])
+    elif data.startswith("file_"):
+        return "file", int(data.split("_")[-1])
+    elif data.startswith("download_"):
+        return "download", int(data.split("_")[-1])
+    elif data.startswith("details_"):
+        return "details", int(data.split("_")[-1])
+    elif data == "ai_links":
+        return "ai"
+    elif data in ("ds_mode_normal", "ds_mode_coder"):
+        return "mode", "normal" if data.endswith("normal") else "coder"
+    elif data == "font_small":
+        return "font", "small"
+    elif data == "font_normal":
+        return "font", "normal"
+    elif data == "font_big":
+        return "font", "big"
+    elif data == "font_code":
+        return "font", "code"
+    elif data == "feedback_open":
+        return "feedback"
+    elif data == "popup_disable":
+        return "popup"
+
+
+def legacy_bottom_nav():
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
+            InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
+            InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings"),
+        ]
+    ])
+
+
+def bench(label: str, fn, n: int):
+    t = min(timeit.repeat(fn, number=n, repeat=3))
+    print(f"{label:28} {t / n * 1e9:8.0f} ns/op")
+
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200_000)
+    n = ap.parse_args().n
+    resolve = main.callbacks.resolve
+
+    def legacy_dispatch():
+        for d in SAMPLE:
+            legacy_resolve(d)
+
+    def router_dispatch():
+        for d in SAMPLE:
+            resolve(d)
+
+    bench(f"dispatch legacy (x{len(SAMPLE)})", legacy_dispatch, n // len(SAMPLE))
+    bench(f"dispatch router (x{len(SAMPLE)})", router_dispatch, n // len(SAMPLE))
+    bench("bottom_nav legacy", legacy_bottom_nav, n // 10)
+    bench("bottom_nav prebuilt", main.bottom_nav, n)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,64 @@
+"""
+Cost of rendering a DATA page as the catalog grows.
+
+    python bench/bench_catalog.py [--sizes 10 50000]
+
+Compares the old path (reload files.json, slice, build the keyboard) with
+the resident Catalog, cold (first render after a change) and warm (memoized).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import storage  # noqa: E402
+
+
+def seed(tmp: str, n: int):
+    files = os.path.join(tmp, "files.json")
+    storage.write_json(files, {"items": [
+        {"title": f"file-{i}.pdf", "description": "seed", "file_id": f"FID{i}"} for i in range(n)
+    ]})
+    return storage.JsonBackend(os.path.join(tmp, "users.json"), files)
+
+
+def bench(label: str, fn, number: int):
+    t = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f"{label:34} {t * 1e6:10.1f} us/page")
+
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 50_000])
+    args = ap.parse_args()
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = seed(tmp, n)
+            storage.init_storage(backend)
+            files = storage.catalog()
+            page = max(len(files) // 6 // 2, 0)
+
+            def legacy():
+                items = backend.list_files()
+                items[page * 6:page * 6 + 6]
+                main.build_data_keyboard(page, 6)
+
+            def cold():
+                files._changed()
+                files.cached_page(page, 6, main.build_data_keyboard)
+
+            def warm():
+                files.cached_page(page, 6, main.build_data_keyboard)
+
+            print(f"-- {n} files")
+            bench("reload files.json + build", legacy, 20)
+            bench("catalog, cold page", cold, 2000)
+            bench("catalog, memoized page", warm, 20000)
+
+
+if __name__ == "__main__":
+    main_()
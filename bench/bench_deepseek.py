@@ -0,0 +1,94 @@
+"""
+Latency/throughput of DeepseekClient against a local fake endpoint.
+
+    python bench/bench_deepseek.py --requests 500 --concurrency 100
+
+Runs the same burst twice: once opening a new httpx.AsyncClient per call
+(the old behaviour) and once through the pooled, admission-limited client,
+then measures time-to-first-token for a streamed reply.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from deepseek_client import DeepseekBusy, DeepseekClient  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+async def per_call_client(url: str):
+    async with httpx.AsyncClient(timeout=60) as client:
+        r = await client.post(url, json={"messages": MESSAGES})
+        r.raise_for_status()
+        return r.json()
+
+
+async def burst(call, n: int, concurrency: int):
+    gate = asyncio.Semaphore(concurrency)
+    latencies, busy = [], 0
+
+    async def one():
+        nonlocal busy
+        async with gate:
+            t = time.perf_counter()
+            try:
+                await call()
+            except DeepseekBusy:
+                busy += 1
+                return
+            latencies.append((time.perf_counter() - t) * 1000)
+
+    t = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(n)))
+    return time.perf_counter() - t, latencies, busy
+
+
+def report(name: str, fake: FakeDeepseek, elapsed: float, lat, busy: int):
+    lat = sorted(lat)
+    p95 = lat[int(len(lat) * 0.95) - 1] if lat else 0
+    print(f"{name:10} {len(lat) / elapsed:8.1f} req/s  p50={statistics.median(lat):7.1f}ms "
+          f"p95={p95:7.1f}ms  connections={fake.connections} busy={busy}")
+
+
+async def main(args):
+    fake = FakeDeepseek(latency=args.latency)
+    url = await fake.start()
+
+    elapsed, lat, busy = await burst(lambda: per_call_client(url), args.requests, args.concurrency)
+    report("per-call", fake, elapsed, lat, busy)
+
+    fake.connections = 0
+    ds = DeepseekClient(api_key="bench", base_url=url)
+    elapsed, lat, busy = await burst(lambda: ds.chat(MESSAGES), args.requests, args.concurrency)
+    report("pooled", fake, elapsed, lat, busy)
+
+    # Time to first token vs. full completion for a long streamed reply
+    fake.reply = "token " * args.tokens
+    fake.token_delay = args.token_delay
+    t = time.perf_counter()
+    first = None
+    async for _ in ds.stream_chat(MESSAGES):
+        if first is None:
+            first = time.perf_counter() - t
+    total = time.perf_counter() - t
+    print(f"stream     first token={first * 1000:7.1f}ms  full={total * 1000:8.1f}ms ({args.tokens} tokens)")
+    await ds.aclose()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=100)
+    ap.add_argument("--latency", type=float, default=0.05)
+    ap.add_argument("--tokens", type=int, default=500)
+    ap.add_argument("--token-delay", type=float, default=0.01)
+    asyncio.run(main(ap.parse_args()))
@@ -0,0 +1,155 @@
+"""
+Restart test for the Deepseek job queue, against the local fakes.
+
+    python bench/bench_jobs.py [--prompts 40] [--kill-after 1.5]
+
+Starts `python main.py` against a fake Bot API and a slow streaming fake
+Deepseek, sends --prompts prompts from different users, SIGKILLs the bot
+mid-generation and starts it again on the same data. Then checks, per chat,
+that exactly one placeholder was sent, that the feedback popup was sent once
+(or not at all for users who turned it off) and that the placeholder ended
+up holding the full answer, and reports how the jobs
+finished and how long the queue waits were.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+from bench.loadtest import ROOT, bot_env, free_port, log_tail, scrape, seed_data  # noqa: E402
+from render import to_plain  # noqa: E402
+
+ANSWER_TOKENS = 40
+
+
+def prompt(uid: int, message_id: int) -> dict:
+    user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+    return {"message": {"message_id": message_id, "date": int(time.time()), "text": f"question from {uid}",
+                        "chat": {"id": uid, "type": "private"}, "from": user}}
+
+
+async def start_bot(env: dict, log_path: str, fake_tg: FakeTelegram, metrics_url: str) -> subprocess.Popen:
+    with open(log_path, "ab") as log:
+        proc = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, stdout=log,
+                                stderr=subprocess.STDOUT, env=env)
+    polls = fake_tg.calls["getUpdates"]
+    async with httpx.AsyncClient(timeout=5) as client:
+        deadline = time.monotonic() + 60
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bot exited with {proc.returncode}:\n{log_tail(log_path)}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"bot did not start:\n{log_tail(log_path)}")
+            await asyncio.sleep(0.1)
+            if fake_tg.calls["getUpdates"] > polls:
+                try:
+                    await scrape(client, metrics_url)
+                    return proc
+                except httpx.HTTPError:
+                    pass
+
+
+def job_rows(db_path: str):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT state, outcome, attempts, started_at - created_at FROM jobs").fetchall()
+    finally:
+        conn.close()
+
+
+async def run(prompts: int, kill_after: float, token_delay: float, workers: int):
+    fake_ds = FakeDeepseek(latency=0.2, reply=" ".join(["token"] * ANSWER_TOKENS), token_delay=token_delay)
+    fake_tg = FakeTelegram(latency=0.005, record=True)
+    ds_url = await fake_ds.start()
+    tg_url = await fake_tg.start()
+    workdir = tempfile.mkdtemp(prefix="bench-jobs-")
+    data_dir = os.path.join(workdir, "data")
+    seed_data(data_dir, prompts, 10)
+    metrics_url = f"http://127.0.0.1:{free_port()}/metrics"
+    args = SimpleNamespace(backend="json", workers=None, keep_limits=False,
+                           env=[f"JOBS_WORKERS={workers}", "STREAM_EDIT_INTERVAL=0.3"])
+    env = bot_env(args, tg_url, ds_url, data_dir, int(metrics_url.rsplit(":", 1)[1].split("/")[0]))
+    log_path = os.path.join(workdir, "bot.log")
+
+    proc = await start_bot(env, log_path, fake_tg, metrics_url)
+    for uid in range(1, prompts + 1):
+        fake_tg.push(prompt(uid, 1000 + uid))
+    await asyncio.sleep(kill_after)
+    proc.kill()
+    proc.wait()
+    db_path = os.path.join(data_dir, "jobs.db")
+    killed = Counter(state for state, *_ in job_rows(db_path))
+    print(f"killed after {kill_after:g}s: jobs {dict(killed)}, "
+          f"{fake_ds.requests} Deepseek requests so far")
+
+    started = time.perf_counter()
+    proc = await start_bot(env, log_path, fake_tg, metrics_url)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        rows = job_rows(db_path)
+        if len(rows) >= prompts and all(state in ("done", "failed") for state, *_ in rows):
+            break
+        await asyncio.sleep(0.2)
+    recovered = time.perf_counter() - started
+    proc.send_signal(2)
+    proc.wait(30)
+
+    rows = job_rows(db_path)
+    print(f"after restart: all {len(rows)} jobs finished in {recovered:.1f}s; "
+          f"states {dict(Counter(r[0] for r in rows))}, outcomes {dict(Counter(r[1] for r in rows))}, "
+          f"attempts {dict(Counter(r[2] for r in rows))}")
+    waits = sorted(r[3] for r in rows if r[3] is not None)
+    if waits:
+        print(f"queue wait (last attempt): p50={waits[len(waits) // 2] * 1000:.0f}ms max={waits[-1] * 1000:.0f}ms")
+
+    placeholders, popups, placeholder_id, final_text = Counter(), Counter(), {}, {}
+    for method, params, result in fake_tg.log:
+        chat = int(params.get("chat_id") or 0)
+        text = params.get("text", "")
+        if method == "sendMessage":
+            if text.startswith("How do you feel"):
+                popups[chat] += 1
+            elif text == "…" or text.startswith("Queued"):
+                placeholders[chat] += 1
+                placeholder_id[chat] = result["message_id"]
+        elif method == "editMessageText":
+            final_text[(chat, int(params["message_id"]))] = to_plain(text)
+    answer = " ".join(["token"] * ANSWER_TOKENS)
+    # Seeded users with uid % 3 == 0 have the feedback popup turned off
+    want_popups = {c: 0 if c % 3 == 0 else 1 for c in range(1, prompts + 1)}
+    bad = [c for c in want_popups if placeholders[c] != 1 or popups[c] != want_popups[c]
+           or final_text.get((c, placeholder_id.get(c))) != answer]
+    print(f"chats with one placeholder, the expected popups and the full answer: {prompts - len(bad)}/{prompts}")
+    for c in bad[:10]:
+        print(f"  chat {c}: {placeholders[c]} placeholder(s), {popups[c]} popup(s), "
+              f"final text {final_text.get((c, placeholder_id.get(c)), '')[:40]!r}")
+
+    await fake_tg.stop()
+    await fake_ds.stop()
+    print(f"logs and data kept in {workdir}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=40)
+    parser.add_argument("--kill-after", type=float, default=1.5)
+    parser.add_argument("--token-delay", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(run(args.prompts, args.kill_after, args.token_delay, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+MediaFetcher against a local file server.
+
+    python bench/bench_media.py [--photos 40] [--distinct 10] [--size 4000x3000]
+
+Serves one large JPEG and requests --photos images (--distinct unique ids,
+so the rest are reposts) all at once. Reports time, downloads vs cache hits,
+bytes kept in flight, Python heap peak (tracemalloc) and the encoded size
+sent to the model. Also checks that an over-cap file is rejected early, that
+a small PNG claiming a huge bitmap is refused without decoding it, and that
+cancelling the first requester of an image doesn't fail the others.
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from media import MediaFetcher, MediaTooLarge  # noqa: E402
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    img = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=95)
+    return out.getvalue()
+
+
+def make_png_bomb(width: int, height: int) -> bytes:
+    """A single-colour PNG: a few KB on the wire for width x height pixels."""
+    out = io.BytesIO()
+    Image.new("1", (width, height)).save(out, "PNG")
+    return out.getvalue()
+
+
+async def run(photos: int, distinct: int, width: int, height: int, concurrency: int, max_dim: int):
+    jpeg = make_jpeg(width, height)
+    app = web.Application()
+    bomb = make_png_bomb(8000, 8000)
+
+    async def serve(request):
+        if request.match_info["name"] == "bomb.png":
+            return web.Response(body=bomb, content_type="image/png")
+        if request.match_info["name"] == "slow.jpg":
+            await asyncio.sleep(0.2)
+        return web.Response(body=jpeg, content_type="image/jpeg")
+
+    app.router.add_get("/file/{name}", serve)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    fetcher = MediaFetcher(max_bytes=len(jpeg) + 1, max_dim=max_dim, max_concurrency=concurrency)
+
+    async def one(i: int):
+        uid = f"u{i % distinct}"
+
+        async def url():
+            return f"http://127.0.0.1:{port}/file/{uid}.jpg"
+
+        return await fetcher.image_data_url(uid, url)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(photos)))
+    elapsed = time.perf_counter() - started
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    st = fetcher.stats()
+    print(f"{photos} photos ({distinct} distinct, source {width}x{height}, {len(jpeg) / 1e6:.1f} MB): "
+          f"{elapsed * 1000:.0f} ms")
+    print(f"  downloads={st['downloads']} cache hits={st['hits']} "
+          f"peak in-flight download bytes={st['peak_buffered'] / 1e6:.1f} MB "
+          f"(cap {concurrency} x {len(jpeg) / 1e6:.1f} MB)")
+    print(f"  python heap peak={heap_peak / 1e6:.1f} MB, data URL sent to model={len(results[0]) / 1e3:.0f} KB")
+
+    small = MediaFetcher(max_bytes=len(jpeg) // 2)
+    try:
+        await small.image_data_url("big", lambda: asyncio.sleep(0, f"http://127.0.0.1:{port}/file/big.jpg"))
+        print("  over-cap file: NOT rejected")
+    except MediaTooLarge:
+        print(f"  over-cap file rejected after {small.bytes_downloaded} bytes kept")
+
+    try:
+        await fetcher.image_data_url("bomb", lambda: asyncio.sleep(0, f"http://127.0.0.1:{port}/file/bomb.png"))
+        print("  PNG bomb: NOT rejected")
+    except MediaTooLarge:
+        print(f"  PNG bomb ({len(bomb) / 1e3:.0f} KB for 64 megapixels) rejected before decoding")
+
+    def slow(uid):
+        return fetcher.image_data_url(uid, lambda: asyncio.sleep(0, f"http://127.0.0.1:{port}/file/slow.jpg"))
+
+    first = asyncio.ensure_future(slow("shared"))
+    second = asyncio.ensure_future(slow("shared"))
+    await asyncio.sleep(0.05)
+    first.cancel()
+    shared = await second
+    print(f"  second requester {'got the image' if shared else 'FAILED'} after the first was cancelled")
+
+    await fetcher.aclose()
+    await small.aclose()
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--photos", type=int, default=40)
+    parser.add_argument("--distinct", type=int, default=10)
+    parser.add_argument("--size", default="4000x3000")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-dim", type=int, default=1024)
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.split("x"))
+    asyncio.run(run(args.photos, args.distinct, width, height, args.concurrency, args.max_dim))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Cost of the metrics instrumentation on hot paths.
+
+    python bench/bench_metrics.py [--n 200000]
+
+Times the bare operation and the instrumented one side by side: a histogram
+observation, an async handler wrapped by instrument(), a callback dispatch
+through CallbackRouter, and rendering /metrics. Coroutines are driven
+directly (no event loop) so only the handler-path cost is measured.
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from callback_router import CallbackRouter  # noqa: E402
+from metrics import REGISTRY, histogram, instrument  # noqa: E402
+
+
+def drive(coro):
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+
+class _Query:
+    data = "file_12"
+
+
+class _Update:
+    callback_query = _Query()
+
+
+async def handler(update, context, *args):
+    return None
+
+
+def per_op(fn, n: int) -> float:
+    return min(timeit.repeat(fn, number=n, repeat=5)) / n * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=200000)
+    args = parser.parse_args()
+    n = args.n
+
+    child = histogram("bench_seconds", "bench", ["route"]).labels("x")
+    router = CallbackRouter()
+    router.prefix("file_")(handler)
+    wrapped = instrument("bench", handler)
+    update = _Update()
+
+    def bare_dispatch():
+        fn, extra = router.resolve(update.callback_query.data)
+        drive(fn(update, None, *extra))
+
+    rows = [
+        ("perf_counter() x2", lambda: (time.perf_counter(), time.perf_counter())),
+        ("histogram observe", lambda: child.observe(0.0123)),
+        ("handler bare", lambda: drive(handler(update, None))),
+        ("handler instrument()", lambda: drive(wrapped(update, None))),
+        ("callback resolve+call", bare_dispatch),
+        ("callback dispatch (timed)", lambda: drive(router.dispatch(update, None))),
+    ]
+    results = {}
+    for name, fn in rows:
+        results[name] = per_op(fn, n)
+        print(f"{name:<28}{results[name]:8.0f} ns/op")
+    print(f"{'=> handler overhead':<28}{results['handler instrument()'] - results['handler bare']:8.0f} ns/update")
+    print(f"{'=> callback overhead':<28}"
+          f"{results['callback dispatch (timed)'] - results['callback resolve+call']:8.0f} ns/update")
+
+    started = time.perf_counter()
+    text = REGISTRY.render()
+    print(f"render /metrics: {(time.perf_counter() - started) * 1000:.2f} ms, {len(text)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Markdown -> Telegram HTML rendering time versus output size.
+
+    python bench/bench_render.py [--sizes 25 50 100 200]
+
+Renders typical model output (prose, lists, fenced code) and several
+adversarial inputs (unmatched delimiters, brackets, backticks, one huge
+line) of each size in KB. Time per character should stay flat as the size
+grows, i.e. rendering is linear.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import render_chunks, visible_len  # noqa: E402
+
+SAMPLE = (
+    "## Step {i}\n"
+    "Use **pandas** to load the *raw* data, then call `df.groupby('k')` "
+    "and see [the docs](https://pandas.pydata.org/docs/) for snake_case_names.\n"
+    "- first item with ~~old~~ new value\n"
+    "- second item: 2 * 3 * 4 = 24\n"
+    "```python\n"
+    "def step_{i}(df):\n"
+    "    return df[df.x < 10 & (df.y > 2)]\n"
+    "```\n"
+)
+
+ADVERSARIAL = {
+    "unclosed *": "*a " * 20,
+    "unclosed [": "[x " * 20,
+    "backticks": "` `` ``` " * 6,
+    "underscores": "_a_b_c__d__ " * 6,
+}
+
+
+def make(kind: str, size: int) -> str:
+    if kind == "typical":
+        parts, total, i = [], 0, 0
+        while total < size:
+            block = SAMPLE.format(i=i)
+            parts.append(block)
+            total += len(block)
+            i += 1
+        return "".join(parts)[:size]
+    if kind == "one line":
+        return ("word **bold** " * (size // 14 + 1))[:size]
+    unit = ADVERSARIAL[kind]
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def measure(text: str, repeat: int = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = render_chunks(text)
+        best = min(best, time.perf_counter() - started)
+    assert all(visible_len(c) <= 4096 for c in chunks)
+    return best, len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[25, 50, 100, 200])
+    args = parser.parse_args()
+    for kind in ["typical", "one line"] + list(ADVERSARIAL):
+        for kb in args.sizes:
+            text = make(kind, kb * 1024)
+            seconds, chunks = measure(text)
+            print(f"{kind:<12} {kb:4d} KB: {seconds * 1000:7.1f} ms "
+                  f"({seconds / len(text) * 1e9:5.0f} ns/char, {chunks} messages)")
+
+
+if __name__ == "__main__":
+    main()
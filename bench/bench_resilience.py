@@ -0,0 +1,137 @@
+"""
+DeepseekClient under injected upstream failures, against the local fake.
+
+    python bench/bench_resilience.py [--requests 1000] [--concurrency 20]
+
+Scenarios:
+  errors   20% of requests answered 503: success rate without and with retries
+  429      every other request rate limited with Retry-After: 0.2
+  down     every request fails: the breaker opens and later calls fail fast
+  tail     3% of requests take 1s: p50/p99 without and with hedging
+  stall    the upstream hangs: the call gives up at the read timeout
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from deepseek_client import DeepseekClient, DeepseekUnavailable  # noqa: E402
+from resilience import CircuitBreaker, RetryPolicy  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def make_client(url: str, attempts: int = 3, **kwargs) -> DeepseekClient:
+    kwargs.setdefault("breaker", CircuitBreaker(failure_threshold=1000, reset_timeout=30))
+    return DeepseekClient(
+        api_key="bench", base_url=url, max_concurrency=100, max_queue=10000,
+        retry=RetryPolicy(max_attempts=attempts, base=0.05, cap=0.5, max_retry_after=5),
+        **kwargs,
+    )
+
+
+async def burst(client: DeepseekClient, n: int, concurrency: int):
+    gate = asyncio.Semaphore(concurrency)
+    latencies, failed = [], 0
+
+    async def one():
+        nonlocal failed
+        async with gate:
+            t = time.perf_counter()
+            try:
+                await client.chat(MESSAGES)
+            except DeepseekUnavailable:
+                failed += 1
+                return
+            latencies.append((time.perf_counter() - t) * 1000)
+
+    t = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(n)))
+    return time.perf_counter() - t, sorted(latencies), failed
+
+
+def report(name: str, n: int, elapsed: float, lat, failed: int, fake: FakeDeepseek):
+    p50 = statistics.median(lat) if lat else 0
+    p99 = lat[max(0, int(len(lat) * 0.99) - 1)] if lat else 0
+    slow = sum(1 for ms in lat if ms > 500)
+    print(f"  {name:14} ok={len(lat) / n:6.1%} failed={failed:4d} upstream requests={fake.requests:4d}  "
+          f"p50={p50:7.1f}ms p99={p99:7.1f}ms >500ms={slow:3d}  total={elapsed:5.2f}s")
+
+
+async def scenario(name: str, n: int, concurrency: int, fake_kwargs: dict, client_kwargs: dict):
+    fake = FakeDeepseek(latency=0.01, seed=1, **fake_kwargs)
+    url = await fake.start()
+    client = make_client(url, **client_kwargs)
+    try:
+        elapsed, lat, failed = await burst(client, n, concurrency)
+        report(name, n, elapsed, lat, failed, fake)
+    finally:
+        await client.aclose()
+        await fake.stop()
+
+
+async def down(n: int):
+    fake = FakeDeepseek(latency=0.01, error_rate=1.0, error_status=503)
+    url = await fake.start()
+    client = make_client(url, breaker=CircuitBreaker(failure_threshold=5, reset_timeout=30))
+    t = time.perf_counter()
+    for _ in range(n):
+        try:
+            await client.chat(MESSAGES)
+        except DeepseekUnavailable:
+            pass
+    elapsed = time.perf_counter() - t
+    print(f"  {n} calls in {elapsed * 1000:.0f} ms, upstream requests={fake.requests}, "
+          f"breaker={client.breaker.state}")
+    await client.aclose()
+    await fake.stop()
+
+
+async def stall():
+    fake = FakeDeepseek(latency=3600)
+    url = await fake.start()
+    client = make_client(url, attempts=1, read_timeout=0.5)
+    t = time.perf_counter()
+    try:
+        await client.chat(MESSAGES)
+        outcome = "answered"
+    except DeepseekUnavailable as e:
+        outcome = str(e)
+    print(f"  gave up after {(time.perf_counter() - t) * 1000:.0f} ms: {outcome}")
+    await client.aclose()
+    await fake.stop()
+
+
+async def run(n: int, concurrency: int):
+    print("errors: 20% 503")
+    await scenario("no retries", n, concurrency, {"error_rate": 0.2}, {"attempts": 1})
+    await scenario("3 attempts", n, concurrency, {"error_rate": 0.2}, {"attempts": 3})
+    print("429: 50% with Retry-After 0.2s")
+    await scenario("3 attempts", n, concurrency,
+                   {"error_rate": 0.5, "error_status": 429, "retry_after": 0.2}, {"attempts": 3})
+    print("down: every request 503, breaker threshold 5")
+    await down(n)
+    print("tail: 3% of requests take 1s")
+    tail = {"slow_rate": 0.03, "slow_latency": 1.0}
+    await scenario("no hedging", n, concurrency, tail, {})
+    # Hedging starts once 20 latencies are known; the delay is their p95 (at least 0.05s)
+    await scenario("hedged", n, concurrency, tail, {"hedge": True, "hedge_min_delay": 0.05})
+    print("stall: upstream never answers, read timeout 0.5s")
+    await stall()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Query latency of the catalog search index.
+
+    python bench/bench_search.py [--docs 100000]
+
+Indexes synthetic titles/descriptions drawn from a Zipf-ish vocabulary,
+then times exact, prefix and multi-word queries plus incremental (re)indexing of single entries.
+The first run of a query (which fills the prefix caches) is shown separately
+and summarized at the end: inline mode sends a new prefix per keystroke, so
+most of its queries are first runs. Scores are checked against a brute-force
+ranking, multi-word queries must average under 10 ms once cached, and a
+multi-word query must still find a document through a prefix matching
+thousands of terms.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import SearchIndex, tokenize  # noqa: E402
+
+SUBJECTS = ["algebra", "calculus", "physics", "chemistry", "biology", "history", "python",
+            "networks", "statistics", "economics", "geometry", "databases", "compilers"]
+WORDS = [f"w{i}" for i in range(20000)]
+
+
+def title(rng: random.Random, i: int) -> str:
+    return f"{rng.choice(SUBJECTS)}_{rng.choice(WORDS)}-part{i % 50}.pdf"
+
+
+def description(rng: random.Random) -> str:
+    # Skewed draw so some words are very common and most are rare
+    return " ".join(WORDS[int(rng.paretovariate(1.2)) % len(WORDS)] for _ in range(12))
+
+
+def brute_force(index: SearchIndex, query: str, limit: int = 10):
+    """Every matching document scored from the raw postings."""
+    n = len(index)
+    total = None
+    for token in dict.fromkeys(tokenize(query)):
+        scores = {}
+        for term in index._expand(token):
+            factor = index._factor(term, token, n)
+            for doc, w in index._postings[term].items():
+                scores[doc] = max(scores.get(doc, 0.0), w * factor)
+        total = scores if total is None else {doc: total[doc] + s for doc, s in scores.items() if doc in total}
+    return sorted(total.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=100_000)
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+    rng = random.Random(7)
+
+    index = SearchIndex()
+    t = time.perf_counter()
+    for i in range(args.docs):
+        index.add(i, title(rng, i), description(rng))
+    print(f"indexed {args.docs} docs in {time.perf_counter() - t:.2f}s")
+
+    slow = []
+    first_runs = {}
+    for q in ["algebra", "alg", "w123", "w1", "calculus w5", "physics part7", "w5 calculus", "nothing-here"]:
+        t = time.perf_counter()
+        hits = index.search(q)
+        first = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        for _ in range(args.repeat):
+            hits = index.search(q)
+        ms = (time.perf_counter() - t) / args.repeat * 1000
+        # Documents tied on score may come in any order; the scores may not differ
+        assert [s for _, s in hits] == [s for _, s in brute_force(index, q)], f"wrong ranking for {q!r}"
+        print(f"query {q!r:18} {ms:7.3f} ms  (first run {first:7.3f} ms, {len(hits)} hits)")
+        first_runs[q] = first
+        if len(q.split()) > 1 and ms >= 10:
+            slow.append(q)
+    assert not slow, f"multi-word queries over 10 ms: {slow}"
+    single = [ms for q, ms in first_runs.items() if len(q.split()) == 1]
+    multi = [ms for q, ms in first_runs.items() if len(q.split()) > 1]
+    print(f"first runs (uncached): single word up to {max(single):.1f} ms, multi-word up to {max(multi):.1f} ms")
+
+    # One rare term in a range of thousands must still count in a multi-word query
+    wide = SearchIndex()
+    for i in range(6000):
+        wide.add(i, f"ab{i:05d}")
+    wide.add(6000, "abzzzz unique")
+    assert [doc for doc, _ in wide.search("ab unique")] == [6000], "multi-word query missed a term of a long prefix"
+    print("long prefix range in a multi-word query: OK")
+
+    t = time.perf_counter()
+    for i in range(100):
+        index.add(i * 997 % args.docs, title(rng, i), description(rng))
+    print(f"incremental update  {(time.perf_counter() - t) * 10:7.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
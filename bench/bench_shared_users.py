@@ -0,0 +1,86 @@
+"""
+Two shard workers changing different fields of the same users.
+
+    python bench/bench_shared_users.py [--users 200] [--rounds 20]
+
+For each backend, two processes open the same storage in shared mode, as
+shard workers do (a user's private chat and a group can be routed to
+different shards). One process owns the font of every user, the other the
+Deepseek mode; each sets its field to a new value every round and flushes,
+so their flushes interleave. Passes if every user ends up with both
+processes' last values.
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import DEFAULT_USER, UserStore, open_backend, write_json  # noqa: E402
+
+FIELDS = ("font", "deepseek_mode")
+
+
+def paths(tmp: str):
+    return os.path.join(tmp, "users.json"), os.path.join(tmp, "files.json"), os.path.join(tmp, "bot.db")
+
+
+async def child(kind: str, tmp: str, field: str, users: int, rounds: int):
+    backend = open_backend(kind, *paths(tmp), shared=True)
+    store = UserStore(backend, shared=True)
+    rng = random.Random(field)
+    for r in range(rounds):
+        for uid in range(users):
+            store.set(uid, field, f"{field}-{r}")
+        await store.flush()
+        await asyncio.sleep(rng.random() * 0.01)
+    backend.close()
+
+
+def run(kind: str, users: int, rounds: int) -> bool:
+    with tempfile.TemporaryDirectory(prefix="bench-shared-users-") as tmp:
+        users_path, files_path, _ = paths(tmp)
+        write_json(users_path, {str(uid): dict(DEFAULT_USER) for uid in range(users)}, None)
+        write_json(files_path, {"items": []})
+        started = time.perf_counter()
+        procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", kind, tmp, field,
+                                   "--users", str(users), "--rounds", str(rounds)])
+                 for field in FIELDS]
+        codes = [p.wait() for p in procs]
+        elapsed = time.perf_counter() - started
+
+        backend = open_backend(kind, *paths(tmp))
+        stored = backend.load_users()
+        backend.close()
+        last = {field: f"{field}-{rounds - 1}" for field in FIELDS}
+        lost = {field: sum(1 for uid in range(users) if stored.get(str(uid), {}).get(field) != value)
+                for field, value in last.items()}
+        ok = codes == [0, 0] and not any(lost.values())
+        print(f"{kind:6} {users} users x {rounds} rounds from 2 processes in {elapsed:.1f}s: "
+              + ", ".join(f"{n} users lost their last {field}" for field, n in lost.items())
+              + f"  {'OK' if ok else 'FAILED'}")
+        return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--backend", choices=["json", "sqlite", "both"], default="both")
+    parser.add_argument("--child", nargs=3, metavar=("BACKEND", "DIR", "FIELD"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(*args.child, args.users, args.rounds))
+        return
+    kinds = ["json", "sqlite"] if args.backend == "both" else [args.backend]
+    results = [run(kind, args.users, args.rounds) for kind in kinds]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Shutdown test: SIGTERM (what Render sends on a redeploy) must flush state.
+
+    python bench/bench_shutdown.py [--users 20] [--signal TERM]
+
+Starts `python main.py` against the local fakes with a write-behind
+interval far longer than the test, changes the font of --users users with
+settings buttons, then sends the signal. Passes if the bot exits on its
+own, through its cleanup, and users.json holds every change.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.bench_jobs import start_bot  # noqa: E402
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+from bench.loadtest import bot_env, free_port, log_tail, seed_data  # noqa: E402
+
+
+def font_press(uid: int, query_id: int) -> dict:
+    user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+    menu = {"message_id": 500 + uid, "date": int(time.time()), "text": "Settings",
+            "chat": {"id": uid, "type": "private"}, "from": {"id": 100000, "is_bot": True, "first_name": "Bench"}}
+    return {"callback_query": {"id": str(query_id), "from": user, "chat_instance": str(uid),
+                               "data": "font_big", "message": menu}}
+
+
+async def run(users: int, sig: signal.Signals) -> bool:
+    fake_ds = FakeDeepseek()
+    fake_tg = FakeTelegram(latency=0.001)
+    ds_url = await fake_ds.start()
+    tg_url = await fake_tg.start()
+    workdir = tempfile.mkdtemp(prefix="bench-shutdown-")
+    data_dir = os.path.join(workdir, "data")
+    # A quarter of the seeded users already use "big"; the others only get it from the presses below
+    seed_data(data_dir, users, 5)
+    metrics_port = free_port()
+    args = SimpleNamespace(backend="json", workers=None, keep_limits=False,
+                           env=["USERS_FLUSH_INTERVAL=3600"])
+    env = bot_env(args, tg_url, ds_url, data_dir, metrics_port)
+    log_path = os.path.join(workdir, "bot.log")
+
+    proc = await start_bot(env, log_path, fake_tg, f"http://127.0.0.1:{metrics_port}/metrics")
+    for uid in range(1, users + 1):
+        fake_tg.push(font_press(uid, uid))
+    deadline = time.monotonic() + 30
+    while fake_tg.calls["answerCallbackQuery"] < users and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    with open(os.path.join(data_dir, "users.json"), encoding="utf-8") as f:
+        before = sum(row.get("font") == "big" for row in json.load(f).values())
+
+    proc.send_signal(sig)
+    try:
+        code = proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        code = None
+    await fake_tg.stop()
+    await fake_ds.stop()
+
+    with open(os.path.join(data_dir, "users.json"), encoding="utf-8") as f:
+        after = sum(row.get("font") == "big" for row in json.load(f).values())
+    ok = code is not None and code >= 0 and after == users
+    print(f"{sig.name}: {fake_tg.calls['answerCallbackQuery']}/{users} presses handled, "
+          f"users.json had {before} changed before the signal and {after} after; exit code {code}")
+    if not ok:
+        print(log_tail(log_path))
+    print(f"{'OK' if ok else 'FAILED'}; logs and data kept in {workdir}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--signal", default="TERM", choices=["TERM", "INT"])
+    args = parser.parse_args()
+    ok = asyncio.run(run(args.users, signal.Signals[f"SIG{args.signal}"]))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
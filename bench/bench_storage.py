@@ -0,0 +1,79 @@
+"""
+Compare the JSON and SQLite storage backends.
+
+    python bench/bench_storage.py [--users 10000 100000] [--files 1000]
+
+Each run seeds a fresh temp directory, then times: startup load, flushing
+a batch of changed user rows (what the write-behind task does), appending
+catalog entries and updating a description.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import DEFAULT_USER, UserStore, open_backend, write_json  # noqa: E402
+
+
+def seed(tmp: str, n_users: int, n_files: int):
+    users = {str(i): dict(DEFAULT_USER) for i in range(n_users)}
+    files = {"items": [
+        {"title": f"file-{i}.pdf", "description": "seed", "file_id": f"FID{i}"}
+        for i in range(n_files)
+    ]}
+    write_json(os.path.join(tmp, "users.json"), users, None)
+    write_json(os.path.join(tmp, "files.json"), files)
+
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - t) * 1000
+
+
+async def run_one(kind: str, n_users: int, n_files: int, dirty: int, appends: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        seed(tmp, n_users, n_files)
+        backend = open_backend(
+            kind, os.path.join(tmp, "users.json"), os.path.join(tmp, "files.json"),
+            os.path.join(tmp, "bot.db"),
+        )
+        t = time.perf_counter()
+        store = UserStore(backend)
+        load_ms = (time.perf_counter() - t) * 1000
+
+        for i in range(dirty):
+            store.set(i * 7 % n_users, "font", "big")
+        t = time.perf_counter()
+        await store.flush()
+        flush_ms = (time.perf_counter() - t) * 1000
+
+        append_ms = sum(
+            timed(backend.add_file, {"title": "new", "description": "", "file_id": f"N{i}"})
+            for i in range(appends)
+        ) / appends
+        desc_ms = timed(backend.update_file, n_files // 2, {"description": "updated"})
+        backend.close()
+    print(f"{kind:7} users={n_users:>7} load={load_ms:9.1f}ms "
+          f"flush({dirty} rows)={flush_ms:8.1f}ms add_file={append_ms:7.2f}ms "
+          f"setdesc={desc_ms:7.2f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    ap.add_argument("--files", type=int, default=1000)
+    ap.add_argument("--dirty", type=int, default=100)
+    ap.add_argument("--appends", type=int, default=20)
+    args = ap.parse_args()
+    for n in args.users:
+        for kind in ("json", "sqlite"):
+            asyncio.run(run_one(kind, n, args.files, args.dirty, args.appends))
+
+
+if __name__ == "__main__":
+    main()
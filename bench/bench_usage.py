@@ -0,0 +1,209 @@
+"""
+Cost of the token usage ledger.
+
+    python bench/bench_usage.py --records 2000000 --users 50000
+
+Measures, in a temporary directory:
+- record() (counters + buffered ledger record) and over_quota() per call,
+  and the periodic append of the buffered records;
+- rebuilding the counters at startup for a month with --records calls,
+  from the snapshot plus the last second of ledger versus replaying the
+  whole month, against a JSON-lines log of the same calls for scale;
+- that usage reported by a (fake) Deepseek endpoint, streamed and not,
+  ends up in the ledger exactly;
+- that with shards, a user chatting privately and in a group routed to
+  another worker hits the quota on their combined usage, on both workers
+  and after a restart.
+"""
+import argparse
+import asyncio
+import calendar
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import aclosing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from deepseek_client import DeepseekClient  # noqa: E402
+from shards import shard_of  # noqa: E402
+from usage import RECORD, UsageLedger, month_of  # noqa: E402
+
+
+def per_call_ns(fn, n: int) -> float:
+    started = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - started) / n * 1e9
+
+
+def fill(ledger: UsageLedger, records: int, users: int, now: float, rng: random.Random):
+    """A month of calls up to `now`: a few heavy users, a long tail, flushed as the bot would."""
+    t = time.gmtime(now)
+    month_start = calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+    step = (now - month_start) / records
+    heavy = max(1, users // 100)
+    for i in range(records):
+        uid = rng.randrange(heavy) if rng.random() < 0.3 else rng.randrange(users)
+        ts = month_start + i * step
+        ledger.record(uid, rng.randint(50, 3000), rng.randint(20, 4000), now=ts)
+        if i % 10000 == 9999:
+            ledger.flush(ts)
+    ledger.flush(now)
+
+
+def bench_hot_path(directory: str, users: int, n: int):
+    ledger = UsageLedger(directory, 200000, 2000000)
+    ledger.load()
+    rng = random.Random(1)
+    ids = [rng.randrange(users) for _ in range(n)]
+
+    def record(count):
+        for uid in ids[:count]:
+            ledger.record(uid, 500, 800)
+
+    def check(count):
+        for uid in ids[:count]:
+            ledger.over_quota(uid)
+
+    rec = per_call_ns(record, n)
+    pending = len(ledger._pending)
+    started = time.perf_counter()
+    ledger.flush()
+    flush = time.perf_counter() - started
+    chk = per_call_ns(check, n)
+    print(f"record(): {rec:.0f} ns/call; over_quota(): {chk:.0f} ns/call; "
+          f"flushing {pending} buffered records: {flush * 1000:.1f} ms ({flush / pending * 1e9:.0f} ns/record)")
+
+
+def bench_rebuild(directory: str, records: int, users: int):
+    now = time.time()
+    rng = random.Random(2)
+    ledger = UsageLedger(directory)
+    ledger.load(now)
+    started = time.perf_counter()
+    fill(ledger, records, users, now - 1, rng)
+    ledger.snapshot(now - 1)
+    # About a second of traffic after the last snapshot
+    for _ in range(200):
+        ledger.record(rng.randrange(users), 500, 800, now=now)
+    ledger.flush(now)
+    expected = {uid: list(row) for uid, row in ledger._rows.items()}
+    print(f"wrote {records} records for {len(expected)} users in {time.perf_counter() - started:.1f}s")
+
+    segment = ledger._segment(month_of(now))
+    size = os.path.getsize(segment)
+    snap_size = os.path.getsize(ledger.snapshot_path)
+
+    fresh = UsageLedger(directory)
+    started = time.perf_counter()
+    fresh.load(now)
+    with_snapshot = time.perf_counter() - started
+    assert fresh._rows == expected, "rebuild from snapshot differs"
+    replayed_tail = fresh.replayed
+
+    os.rename(ledger.snapshot_path, ledger.snapshot_path + ".off")
+    full = UsageLedger(directory)
+    started = time.perf_counter()
+    full.load(now)
+    without = time.perf_counter() - started
+    assert full._rows == expected, "full replay differs"
+    os.rename(ledger.snapshot_path + ".off", ledger.snapshot_path)
+
+    # The same calls as JSON lines, the obvious alternative format
+    jsonl = os.path.join(directory, "ledger.jsonl")
+    with open(segment, "rb") as src, open(jsonl, "w") as out:
+        for ts, uid, p, c, flags in RECORD.iter_unpack(src.read()):
+            out.write(json.dumps({"ts": ts, "user": uid, "prompt": p, "completion": c, "flags": flags}) + "\n")
+    started = time.perf_counter()
+    with open(jsonl) as f:
+        for line in f:
+            json.loads(line)
+    parse_jsonl = time.perf_counter() - started
+
+    print(f"ledger {size / 1e6:.1f} MB ({size // (records + 200)} bytes/call; JSON lines "
+          f"{os.path.getsize(jsonl) / 1e6:.1f} MB), snapshot {snap_size / 1e6:.2f} MB")
+    print(f"startup rebuild: snapshot + {replayed_tail} tail records {with_snapshot * 1000:.0f} ms; "
+          f"full month replay ({full.replayed} records) {without * 1000:.0f} ms; "
+          f"just parsing the month as JSON lines {parse_jsonl * 1000:.0f} ms")
+
+
+async def bench_client(directory: str):
+    fake = FakeDeepseek(latency=0.001, reply="word " * 99 + "end")
+    url = await fake.start()
+    ledger = UsageLedger(directory)
+    ledger.load()
+    client = DeepseekClient(api_key="bench", base_url=url, hedge=False, ledger=ledger)
+    messages = [{"role": "user", "content": "a question " * 40}]
+    expected = fake.usage(client._payload(messages, "normal"))
+    await client.chat(messages, user_id=1)
+    async for _ in client.stream_chat(messages, user_id=2):
+        pass
+    # Reader gives up after the first delta: no usage chunk, so the call is estimated
+    async with aclosing(client.stream_chat(messages, user_id=3)) as stream:
+        async for _ in stream:
+            break
+    await client.aclose()
+    await fake.stop()
+    for uid, label in ((1, "chat"), (2, "stream"), (3, "abandoned stream")):
+        u = ledger.usage(uid)
+        print(f"{label:17} ledger prompt={u['prompt']:4} completion={u['completion']:4}  "
+              f"(API reported prompt={expected['prompt_tokens']} completion={expected['completion_tokens']})")
+
+
+def check_shards(directory: str):
+    uid, shards, limit = 4242, 2, 10000
+    private = {"update_id": 1, "message": {"chat": {"id": uid, "type": "private"}, "from": {"id": uid}}}
+    group_id = next(c for c in range(-1001000000000, -1001000000100, -1)
+                    if c % shards != uid % shards)
+    group = {"update_id": 2, "message": {"chat": {"id": group_id, "type": "group"}, "from": {"id": uid}}}
+    a, b = shard_of(private, shards), shard_of(group, shards)
+    assert a != b
+    workers = {i: UsageLedger(directory, 0, limit, shard=i, shards=shards) for i in (a, b)}
+    for ledger in workers.values():
+        ledger.load()
+        ledger.load_peers()
+
+    # 6000 tokens in each chat: under the monthly quota on either worker alone, over it together
+    workers[a].record(uid, 2000, 4000)
+    workers[b].record(uid, 2000, 4000)
+    # One flush tick on each worker, then the next: each picks up what the other appended
+    for _ in range(2):
+        for ledger in workers.values():
+            ledger.sync()
+    verdicts = {i: ledger.over_quota(uid) for i, ledger in workers.items()}
+    seen = {i: ledger.usage(uid)["month"] for i, ledger in workers.items()}
+    print(f"user {uid} in chats on shards {a} and {b}: each worker sees {seen} tokens "
+          f"against a {limit} monthly quota -> {verdicts}")
+    assert all(v == "month" for v in verdicts.values()), "a worker let the user past the quota"
+    assert workers[a].report()[1] == 12000
+
+    # A restarted worker gets the other's share back from its snapshot and ledger tail
+    workers[b].snapshot()
+    workers[b].record(uid, 100, 100)
+    workers[b].flush()
+    restarted = UsageLedger(directory, 0, limit, shard=a, shards=shards)
+    restarted.load()
+    restarted.load_peers()
+    print(f"after restarting shard {a}: {restarted.usage(uid)['month']} tokens, {restarted.over_quota(uid)}")
+    assert restarted.usage(uid)["month"] == 12200 and restarted.over_quota(uid) == "month"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="bench-usage-") as tmp:
+        bench_hot_path(os.path.join(tmp, "hot"), args.users, args.calls)
+        bench_rebuild(os.path.join(tmp, "month"), args.records, args.users)
+        asyncio.run(bench_client(os.path.join(tmp, "client")))
+        check_shards(os.path.join(tmp, "shards"))
+
+
+if __name__ == "__main__":
+    main()
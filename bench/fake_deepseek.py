@@ -0,0 +1,159 @@
+"""
+Minimal local stand-in for the Deepseek chat completions endpoint.
+
+HTTP/1.1 with keep-alive, built on asyncio streams so it needs no extra
+packages. Counts accepted connections so connection reuse is visible.
+Reports a usage block (roughly 4 characters per prompt token, one token
+per reply word), on streams too when `stream_options.include_usage` is set.
+Can inject failures: a fraction of requests answered with an error status
+(optionally with Retry-After) and a fraction delayed by `slow_latency`.
+
+    python bench/fake_deepseek.py --port 8911 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import Optional
+
+_REASONS = {429: "Too Many Requests", 500: "Internal Server Error", 502: "Bad Gateway",
+            503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class FakeDeepseek:
+    def __init__(self, latency: float = 0.05, reply: str = "ok", token_delay: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, retry_after: Optional[float] = None,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.reply = reply
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rng = random.Random(seed)
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        headers = {}
+        while True:
+            h = await reader.readline()
+            if h in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = h.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        body = await reader.readexactly(int(headers.get("content-length", "0")))
+        return line.decode("latin-1"), headers, body
+
+    def usage(self, payload: dict) -> dict:
+        prompt, completion = 1, len(self.reply.split(" "))
+        for m in payload.get("messages", []):
+            content = m.get("content") or ""
+            # Content parts (text + image): a flat charge per part
+            prompt += len(content) // 4 if isinstance(content, str) else 250 * len(content)
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def respond(self, payload: dict) -> dict:
+        return {
+            "choices": [{"message": {"role": "assistant", "content": self.reply}}],
+            "usage": self.usage(payload),
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                req = await self._read_request(reader)
+                if req is None:
+                    break
+                _, headers, body = req
+                self.requests += 1
+                payload = json.loads(body or b"{}")
+                slow = self.slow_rate and self.rng.random() < self.slow_rate
+                await asyncio.sleep(self.slow_latency if slow else self.latency)
+                if self.error_rate and self.rng.random() < self.error_rate:
+                    self.errors += 1
+                    await self._error(writer)
+                    continue
+                if payload.get("stream"):
+                    await self._stream(writer, payload)
+                    continue
+                out = json.dumps(self.respond(payload)).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(out)}\r\n\r\n".encode() + out
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _error(self, writer: asyncio.StreamWriter):
+        out = json.dumps({"error": {"message": "injected failure"}}).encode()
+        extra = f"Retry-After: {self.retry_after:g}\r\n" if self.retry_after is not None else ""
+        writer.write(
+            f"HTTP/1.1 {self.error_status} {_REASONS.get(self.error_status, 'Error')}\r\n"
+            f"Content-Type: application/json\r\n{extra}Content-Length: {len(out)}\r\n\r\n".encode()
+            + out
+        )
+        await writer.drain()
+
+    async def _stream(self, writer: asyncio.StreamWriter, payload: dict):
+        # Server-sent events over chunked transfer encoding, one word per event
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        words = self.reply.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            event = json.dumps({"choices": [{"delta": {"content": delta}}]})
+            self._chunk(writer, f"data: {event}\n\n".encode())
+            await writer.drain()
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            event = json.dumps({"choices": [], "usage": self.usage(payload)})
+            self._chunk(writer, f"data: {event}\n\n".encode())
+        self._chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _chunk(writer: asyncio.StreamWriter, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+async def _serve(port: int, latency: float, token_delay: float):
+    fake = FakeDeepseek(latency, reply="streamed reply " * 50, token_delay=token_delay)
+    url = await fake.start(port=port)
+    print(f"Fake Deepseek listening on {url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8911)
+    ap.add_argument("--latency", type=float, default=0.05)
+    ap.add_argument("--token-delay", type=float, default=0.02)
+    args = ap.parse_args()
+    asyncio.run(_serve(args.port, args.latency, args.token_delay))
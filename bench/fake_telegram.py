@@ -0,0 +1,187 @@
+"""
+Minimal local stand-in for the Telegram Bot API, for load tests.
+
+Serves getUpdates (long polling) from a queue filled with push(), answers
+the send/edit/answer methods the bot uses with well-formed objects, and
+serves one JPEG for every getFile path. Counts calls per method and, with
+record=True, keeps every call as (method, params, result) in `log`.
+
+    python bench/fake_telegram.py --port 8912
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Methods answered with `true`
+_TRUE_METHODS = {
+    "deletewebhook", "setwebhook", "answercallbackquery", "sendchataction", "deletemessage",
+    "answerinlinequery", "setmycommands", "close", "logout",
+}
+# Methods answered with the Message that was sent or edited
+_MESSAGE_METHODS = {
+    "sendmessage", "editmessagetext", "editmessagereplymarkup", "senddocument", "sendphoto",
+    "forwardmessage",
+}
+
+
+def make_jpeg(width: int = 1280, height: int = 960) -> bytes:
+    from PIL import Image
+    out = io.BytesIO()
+    Image.radial_gradient("L").resize((width, height)).convert("RGB").save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, jpeg: Optional[bytes] = None, record: bool = False):
+        self.latency = latency
+        self.jpeg = jpeg
+        self.record = record
+        self.calls: Counter = Counter()
+        self.log: List[Tuple[str, Dict, object]] = []
+        self.updates_delivered = 0
+        self._pending: Deque[Dict] = deque()
+        self._arrived = asyncio.Event()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start serving; returns the base URL (add "/bot" or "/file/bot" for the bot's endpoints)."""
+        if self.jpeg is None:
+            self.jpeg = make_jpeg()
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", r"/bot{token}/{method}", self._method)
+        app.router.add_get(r"/file/bot{token}/{path:.*}", self._file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset(self):
+        self.calls.clear()
+        self.log.clear()
+        self.updates_delivered = 0
+        self._pending.clear()
+
+    def push(self, update: Dict) -> int:
+        """Queue an update (its update_id is assigned here) for the next getUpdates."""
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        self._pending.append(update)
+        self._arrived.set()
+        return update["update_id"]
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _params(self, request: web.Request) -> Dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        return {k: v for k, v in form.items() if isinstance(v, str)}
+
+    async def _method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = await self._params(request)
+        if method.lower() == "getupdates":
+            return self._ok(await self._get_updates(params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(method.lower(), params)
+        if result is None:
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+        if self.record:
+            self.log.append((method, params, result))
+        return self._ok(result)
+
+    def _result(self, name: str, params: Dict):
+        if name == "getme":
+            return BOT_USER
+        if name in _TRUE_METHODS:
+            return True
+        if name in _MESSAGE_METHODS:
+            return self._message(params)
+        if name == "copymessage":
+            return {"message_id": self._new_message_id()}
+        if name == "getfile":
+            file_id = params.get("file_id", "")
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}",
+                    "file_size": len(self.jpeg), "file_path": f"files/{file_id}.jpg"}
+        return None
+
+    async def _get_updates(self, params: Dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Updates below the offset were confirmed by the bot
+        while self._pending and self._pending[0]["update_id"] < offset:
+            self._pending.popleft()
+        if not self._pending and timeout > 0:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = [u for _, u in zip(range(limit), self._pending)]
+        if batch:
+            self.updates_delivered = max(self.updates_delivered, batch[-1]["update_id"])
+        return batch
+
+    async def _file(self, request: web.Request) -> web.Response:
+        self.calls["file"] += 1
+        return web.Response(body=self.jpeg, content_type="image/jpeg")
+
+    def _new_message_id(self) -> int:
+        self._next_message_id += 1
+        return self._next_message_id
+
+    def _message(self, params: Dict) -> Dict:
+        chat_id = params.get("chat_id") or params.get("from_chat_id") or 0
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            chat_id = 0
+        message_id = params.get("message_id")
+        return {
+            "message_id": int(message_id) if message_id else self._new_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.Response(text=json.dumps({"ok": True, "result": result}), content_type="application/json")
+
+
+async def _serve(port: int, latency: float):
+    fake = FakeTelegram(latency)
+    url = await fake.start(port=port)
+    print(f"Fake Bot API listening on {url} (TELEGRAM_API_URL={url}/bot TELEGRAM_FILE_URL={url}/file/bot)")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8912)
+    ap.add_argument("--latency", type=float, default=0.0)
+    args = ap.parse_args()
+    asyncio.run(_serve(args.port, args.latency))
@@ -0,0 +1,113 @@
+"""
+Randomized checks for render.render_chunks.
+
+    python bench/fuzz_render.py [--cases 20000] [--seed 1] [--limit 200]
+
+Feeds random Markdown-like text (delimiters, fences, headings, lists, HTML
+special characters, long lines) and checks every result:
+- each message is within the limit of visible characters and not empty,
+- tags are only Telegram's and are properly nested and closed in each message,
+- no letter or digit of the input is lost or invented (input without links).
+A small --limit makes the chunker cut often. Exits non-zero on the first failure.
+"""
+import argparse
+import os
+import random
+import sys
+from html.parser import HTMLParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import render_chunks, to_plain, visible_len  # noqa: E402
+
+ALLOWED = {"b", "i", "s", "u", "code", "pre", "a"}
+ATOMS = [
+    "*", "**", "_", "__", "~~", "`", "``", "```", "\\", "[", "]", "(", ")", "<", ">", "&",
+    "#", "# ", "- ", "* ", "> ", "\n", "\n\n", " ", "  ", "word", "x", "snake_case", "42",
+    "**bold**", "*it*", "`code`", "```\n", "```py\n", "~~~\n", "---\n", "\t", "é", "🙂",
+]
+
+
+class NestingChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.error = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED:
+            self.error = f"tag <{tag}> not allowed"
+        if tag == "pre" and self.stack:
+            self.error = "<pre> nested"
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.error = self.error or f"</{tag}> closes {self.stack[-1:] or 'nothing'}"
+        else:
+            self.stack.pop()
+
+
+def random_text(rng: random.Random) -> str:
+    parts = [rng.choice(ATOMS) for _ in range(rng.randint(0, 120))]
+    if rng.random() < 0.1:
+        parts.insert(rng.randint(0, len(parts)), "y" * rng.randint(100, 900))
+    return "".join(parts)
+
+
+def drop_fences(text: str) -> str:
+    """The input without its fence lines (whose info string is not shown)."""
+    kept, fence = [], None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if fence is None and stripped[:3] in ("```", "~~~"):
+            fence = stripped[:len(stripped) - len(stripped.lstrip(stripped[0]))]
+        elif fence is not None and stripped.startswith(fence) and not stripped.lstrip(fence[0]):
+            fence = None
+        else:
+            kept.append(line)
+    return "\n".join(kept)
+
+
+def alnum(text: str) -> str:
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def check(text: str, font: str, limit: int):
+    chunks = render_chunks(text, font, limit)
+    for chunk in chunks:
+        if visible_len(chunk) > limit:
+            return f"message of {visible_len(chunk)} visible chars > {limit}"
+        if not to_plain(chunk).strip():
+            return "empty message"
+        checker = NestingChecker()
+        checker.feed(chunk)
+        checker.close()
+        if checker.error:
+            return checker.error
+        if checker.stack:
+            return f"unclosed {checker.stack}"
+    if alnum("".join(to_plain(c) for c in chunks)) != alnum(text if font == "code" else drop_fences(text)):
+        return "letters/digits changed"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    for case in range(args.cases):
+        text = random_text(rng)
+        font = rng.choice(["normal", "big", "code"])
+        error = check(text, font, args.limit)
+        if error:
+            print(f"case {case} (font={font}): {error}\n{text!r}")
+            sys.exit(1)
+    print(f"{args.cases} cases OK (limit {args.limit})")
+
+
+if __name__ == "__main__":
+    main()
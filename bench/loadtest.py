@@ -0,0 +1,403 @@
+"""
+End-to-end load test of the bot, fully local: `python main.py` runs as a
+subprocess against a fake Bot API and a fake Deepseek endpoint, and an
+update stream is replayed into it at a target rate.
+
+    python bench/loadtest.py [--sizes 1000 10000 50000] [--rate 200] [--duration 15]
+    python bench/loadtest.py --replay updates.jsonl --speed 2
+    python bench/loadtest.py --out bench/results.jsonl --label "after storage change"
+    python bench/loadtest.py --sizes 10000 --shards 1 2 4 --backend sqlite
+
+For each size N, data/ starts with N users in users.json and N files in
+files.json; admin uploads and first-time users grow them during the run.
+Reported per size: updates handled per second, p50/p95/p99 handler time
+(bot_handler_seconds, over all handlers and per handler), event-loop lag,
+RSS after startup and peak, and the data file sizes at the end. --out
+appends the results as one JSON line so runs can be compared over time.
+With --shards, each size also runs in sharded mode (a front process and N
+workers); metrics are summed over all the processes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from itertools import cycle
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx  # noqa: E402
+
+from bench.fake_deepseek import FakeDeepseek  # noqa: E402
+from bench.fake_telegram import FakeTelegram  # noqa: E402
+from bench.replay import SyntheticUpdates, load_recorded, parse_mix, replay  # noqa: E402
+
+BOT_TOKEN = "123456:BENCH"
+ADMIN_ID = 42
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+# ---------- Metrics scraping ----------
+
+def parse_metrics(text: str) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+    """Prometheus text format -> {sample name: [(labels, value)]}."""
+    samples = defaultdict(list)
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = _SAMPLE_RE.match(line)
+        if m is None:
+            continue
+        labels = dict(_LABEL_RE.findall(m.group(2) or ""))
+        samples[m.group(1)].append((labels, float(m.group(3))))
+    return samples
+
+
+def buckets(samples, name: str, by: Optional[str] = None) -> Dict[str, Dict[float, float]]:
+    """Cumulative bucket counts of histogram `name`, summed over series (grouped by label `by`)."""
+    out: Dict[str, Dict[float, float]] = defaultdict(lambda: defaultdict(float))
+    for labels, value in samples.get(f"{name}_bucket", []):
+        group = labels.get(by, "") if by else ""
+        out[group][float(labels["le"])] += value
+    return out
+
+
+def quantile(q: float, cumulative: Dict[float, float]) -> Optional[float]:
+    """Estimate like PromQL histogram_quantile: linear within the bucket holding rank q."""
+    bounds = sorted(cumulative)
+    if not bounds or cumulative[bounds[-1]] == 0:
+        return None
+    rank = q * cumulative[bounds[-1]]
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        count = cumulative[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            return lower + (bound - lower) * ((rank - below) / (count - below) if count > below else 0)
+        lower, below = bound, count
+    return lower
+
+
+def gauge_value(samples, name: str) -> Optional[float]:
+    values = samples.get(name)
+    return values[0][1] if values else None
+
+
+def gauge_sum(samples, name: str) -> Optional[float]:
+    values = samples.get(name)
+    return sum(v for _, v in values) if values else None
+
+
+def handled(samples) -> int:
+    return int(sum(v for _, v in samples.get("bot_handler_seconds_count", [])))
+
+
+# ---------- Bot subprocess ----------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def free_ports(count: int) -> int:
+    """First of `count` consecutive free ports (shard workers listen on base + index)."""
+    while True:
+        base = free_port()
+        try:
+            for port in range(base + 1, base + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+
+
+def seed_data(data_dir: str, users: int, files: int):
+    os.makedirs(data_dir, exist_ok=True)
+    fonts = ("normal", "small", "big", "code")
+    rows = {str(uid): {"font": fonts[uid % 4], "feedback_popup": uid % 3 != 0, "deepseek_mode": "normal"}
+            for uid in range(1, users + 1)}
+    with open(os.path.join(data_dir, "users.json"), "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    items = [{"title": f"Seeded file {i} report notes", "description": f"Seeded description {i}",
+              "file_id": f"seed-{i}", "file_unique_id": f"seed-{i}"} for i in range(files)]
+    with open(os.path.join(data_dir, "files.json"), "w", encoding="utf-8") as f:
+        json.dump({"items": items}, f, ensure_ascii=False, indent=2)
+
+
+def bot_env(args, tg_url: str, ds_url: str, data_dir: str, metrics_port: int, shards: int = 1) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": f"{tg_url}/bot",
+        "TELEGRAM_FILE_URL": f"{tg_url}/file/bot",
+        "DEEPSEEK_API_URL": ds_url,
+        "DEEPSEEK_VISION_URL": ds_url,
+        "DEEPSEEK_API_KEY": "bench",
+        "DATA_DIR": data_dir,
+        "SQLITE_DB": os.path.join(data_dir, "bot.db"),
+        "BROADCAST_STATE": os.path.join(data_dir, "broadcast.json"),
+        "DEEPSEEK_CACHE_DB": "",
+        "STORAGE_BACKEND": args.backend,
+        "ADMIN_IDS": str(ADMIN_ID),
+        "GROUP_CHAT_ID": str(ADMIN_ID),
+        "WEBHOOK_MODE": "false",
+        "POLLING_INTERVAL": "0",
+        "METRICS_HOST": "127.0.0.1",
+        "METRICS_PORT": str(metrics_port),
+        "PYTHONUNBUFFERED": "1",
+    })
+    if args.workers is not None:
+        env["UPDATE_WORKERS"] = str(args.workers)
+    if shards > 1:
+        env.update({"SHARDS": str(shards), "SHARD_BASE_PORT": str(free_ports(shards))})
+    if not args.keep_limits:
+        # Measure the pipeline, not the per-user flood protection
+        env.update({"USER_RATE_PER_SEC": "1000", "USER_RATE_BURST": "1000",
+                    "GLOBAL_RATE_PER_SEC": "100000", "GLOBAL_RATE_BURST": "100000"})
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+async def scrape(client: httpx.AsyncClient, url: str):
+    r = await client.get(url)
+    r.raise_for_status()
+    return parse_metrics(r.text)
+
+
+async def scrape_all(client: httpx.AsyncClient, urls: List[str]):
+    """Samples of several processes (front and shard workers) in one dict; series are summed later."""
+    samples = defaultdict(list)
+    for part in await asyncio.gather(*(scrape(client, url) for url in urls)):
+        for name, values in part.items():
+            samples[name].extend(values)
+    return samples
+
+
+def log_tail(path: str, lines: int = 30) -> str:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return "".join(f.readlines()[-lines:])
+
+
+# ---------- One step ----------
+
+async def run_step(args, size: int, shards: int, fake_tg: FakeTelegram, tg_url: str, ds_url: str, recorded) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    data_dir = os.path.join(workdir, "data")
+    seed_data(data_dir, size, size)
+    # Sharded, the front serves metrics on this port and worker i on port + 1 + i
+    processes = shards + 1 if shards > 1 else 1
+    metrics_port = free_ports(processes)
+    metrics_urls = [f"http://127.0.0.1:{metrics_port + i}/metrics" for i in range(processes)]
+    log_path = os.path.join(workdir, "bot.log")
+    fake_tg.reset()
+
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(
+            [sys.executable, "main.py"], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT,
+            env=bot_env(args, tg_url, ds_url, data_dir, metrics_port, shards),
+        )
+    client = httpx.AsyncClient(timeout=10)
+    try:
+        # Ready once it polls for updates and serves metrics
+        deadline = time.monotonic() + 60
+        samples = None
+        while samples is None:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bot exited with {proc.returncode}:\n{log_tail(log_path)}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"bot did not start:\n{log_tail(log_path)}")
+            await asyncio.sleep(0.2)
+            if fake_tg.calls["getUpdates"]:
+                try:
+                    samples = await scrape_all(client, metrics_urls)
+                except httpx.HTTPError:
+                    pass
+        rss_start = gauge_sum(samples, "process_resident_memory_bytes")
+
+        if recorded is not None:
+            stream = iter(recorded)
+        else:
+            synthetic = SyntheticUpdates(size, size, ADMIN_ID, args.mix, seed=args.seed)
+            stream = ((None, update) for update in synthetic)
+        started = time.perf_counter()
+        sent = await replay(fake_tg.push, stream, args.rate, args.duration, args.speed)
+        pushed_for = time.perf_counter() - started
+
+        # Drain: wait until every update's handler has finished
+        finished_at = time.perf_counter()
+        done = 0
+        deadline = time.monotonic() + args.drain_timeout
+        while time.monotonic() < deadline:
+            samples = await scrape_all(client, metrics_urls)
+            now = handled(samples)
+            if now > done:
+                done, finished_at = now, time.perf_counter()
+            if done >= sent:
+                break
+            await asyncio.sleep(0.1)
+        elapsed = finished_at - started
+
+        overall = buckets(samples, "bot_handler_seconds").get("", {})
+        per_handler = buckets(samples, "bot_handler_seconds", by="handler")
+        lag = buckets(samples, "event_loop_lag_seconds").get("", {})
+        result = {
+            "size": size,
+            "shards": shards,
+            "sent": sent,
+            "handled": done,
+            "errors": int(sum(v for _, v in samples.get("bot_handler_errors_total", []))),
+            "push_seconds": round(pushed_for, 2),
+            "throughput": round(done / elapsed, 1) if elapsed > 0 else 0.0,
+            "p50_ms": _ms(quantile(0.50, overall)),
+            "p95_ms": _ms(quantile(0.95, overall)),
+            "p99_ms": _ms(quantile(0.99, overall)),
+            "loop_lag_p50_ms": _ms(quantile(0.50, lag)),
+            "loop_lag_p99_ms": _ms(quantile(0.99, lag)),
+            "rss_start_mb": _mb(rss_start),
+            "rss_peak_mb": _mb(gauge_sum(samples, "process_peak_resident_memory_bytes")),
+            "handlers": {
+                name: {"count": int(b[float("inf")]), "p95_ms": _ms(quantile(0.95, b))}
+                for name, b in sorted(per_handler.items()) if b[float("inf")]
+            },
+            "bot_api_calls": dict(fake_tg.calls),
+        }
+    finally:
+        await client.aclose()
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, proc.wait, 30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    # Sizes after shutdown, once pending settings and uploads are written back
+    result["users_json_kb"] = _kb(os.path.join(data_dir, "users.json"))
+    result["files_json_kb"] = _kb(os.path.join(data_dir, "files.json"))
+    if args.keep_data:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _mb(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value / 1e6, 1)
+
+
+def _kb(path: str) -> Optional[int]:
+    return os.path.getsize(path) // 1024 if os.path.exists(path) else None
+
+
+def _fmt(value) -> str:
+    return "-" if value is None else f"{value:g}"
+
+
+def report(results: List[Dict]):
+    print(f"{'size':>7} {'shards':>6} {'sent':>6} {'handled':>7} {'errors':>6} {'upd/s':>7} {'p50ms':>7} {'p95ms':>7} {'p99ms':>7} "
+          f"{'lag99ms':>7} {'rss0MB':>7} {'peakMB':>7} {'usersKB':>8} {'filesKB':>8}")
+    for r in results:
+        print(f"{r['size']:>7} {r['shards']:>6} {r['sent']:>6} {r['handled']:>7} {r['errors']:>6} {_fmt(r['throughput']):>7} "
+              f"{_fmt(r['p50_ms']):>7} {_fmt(r['p95_ms']):>7} {_fmt(r['p99_ms']):>7} "
+              f"{_fmt(r['loop_lag_p99_ms']):>7} {_fmt(r['rss_start_mb']):>7} {_fmt(r['rss_peak_mb']):>7} "
+              f"{_fmt(r['users_json_kb']):>8} {_fmt(r['files_json_kb']):>8}")
+    for r in results:
+        parts = [f"{name} {h['count']}x p95={_fmt(h['p95_ms'])}ms" for name, h in r["handlers"].items()]
+        print(f"  size {r['size']} x{r['shards']}: " + ", ".join(parts))
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> List[Dict]:
+    fake_ds = FakeDeepseek(args.ds_latency, reply=" ".join(["token"] * args.ds_tokens),
+                           token_delay=args.ds_token_delay, error_rate=args.ds_error_rate, seed=args.seed)
+    fake_tg = FakeTelegram(args.tg_latency)
+    ds_url = await fake_ds.start()
+    tg_url = await fake_tg.start()
+    recorded = None
+    if args.replay:
+        recorded = load_recorded(args.replay)
+        if args.loop:
+            recorded = cycle([(None, update) for _, update in recorded])
+    results = []
+    try:
+        for shards in args.shards:
+            for size in args.sizes:
+                print(f"size {size}, {shards} shard(s): {args.rate:g} upd/s for {args.duration:g}s ...", flush=True)
+                results.append(await run_step(args, size, shards, fake_tg, tg_url, ds_url, recorded))
+    finally:
+        await fake_tg.stop()
+        await fake_ds.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="users and files seeded in data/ for each step")
+    parser.add_argument("--rate", type=float, default=200, help="updates per second")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of traffic per step")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="synthetic mix, e.g. callback=50,command=15,text=15,photo=5,document=10,inline=5")
+    parser.add_argument("--replay", help="JSONL of recorded updates instead of synthetic ones")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up for timed recordings")
+    parser.add_argument("--loop", action="store_true", help="repeat the recording at --rate until --duration")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--workers", type=int, help="UPDATE_WORKERS for the bot")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1],
+                        help="SHARDS (worker processes); several values run each size once per count")
+    parser.add_argument("--keep-limits", action="store_true", help="keep the per-user/global rate limits")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the bot (repeatable)")
+    parser.add_argument("--tg-latency", type=float, default=0.02, help="fake Bot API latency per call")
+    parser.add_argument("--ds-latency", type=float, default=0.3, help="fake Deepseek time to first token")
+    parser.add_argument("--ds-tokens", type=int, default=40, help="tokens per fake Deepseek answer")
+    parser.add_argument("--ds-token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+    parser.add_argument("--ds-error-rate", type=float, default=0.0, help="share of Deepseek calls answered 503")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-data", action="store_true", help="keep each step's data dir and bot.log")
+    parser.add_argument("--out", help="append results as a JSON line to this file")
+    parser.add_argument("--label", default="", help="note stored with --out results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.out:
+        row = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": git_revision(), "label": args.label,
+            "rate": args.rate, "duration": args.duration, "backend": args.backend,
+            "replay": args.replay, "steps": results,
+        }
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row) + "\n")
+        print(f"appended to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
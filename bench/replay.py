@@ -0,0 +1,169 @@
+"""
+Update streams for load tests: a synthetic generator and recorded replays.
+
+Synthetic updates mix button presses, commands, Deepseek prompts, photos,
+admin document uploads and inline queries in configurable proportions.
+Recorded streams are JSONL files, one Bot API Update per line, either bare
+or as {"t": seconds_since_start, "update": {...}}; update_ids are
+reassigned when replayed.
+"""
+import asyncio
+import json
+import random
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_MIX = {"callback": 50, "command": 15, "text": 15, "photo": 5, "document": 10, "inline": 5}
+
+_CALLBACKS = ("nav_home", "top_data", "data_page_{page}", "file_{file}", "details_{file}",
+              "nav_settings", "font_normal", "font_big", "nav_deepseek", "ds_mode_normal", "ai_links")
+_COMMANDS = ("/start", "/help", "/data", "/settings", "/deepseek", "/find {word}")
+_WORDS = ("report", "guide", "notes", "manual", "invoice", "slides", "2024", "draft", "final", "scan")
+_PROMPTS = ("Summarize the benefits of unit tests.", "Write a Python function that reverses a list.",
+            "What is a circuit breaker?", "Explain **async** IO in two sentences.")
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """"callback=50,text=20" -> weights; kinds left out get 0."""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"unknown update kind {kind!r} (known: {', '.join(DEFAULT_MIX)})")
+        mix[kind] = float(weight)
+    return mix
+
+
+class SyntheticUpdates:
+    """
+    Endless stream of update dicts (without update_id). Users are drawn from
+    1..users (pre-seeded ids, so lookups hit), plus `new_user_share` first-
+    time users whose /start grows users.json. Documents come from `admin_id`
+    and have fresh file ids, so every one grows files.json.
+    """
+
+    def __init__(self, users: int, files: int, admin_id: int, mix: Optional[Dict[str, float]] = None,
+                 new_user_share: float = 0.02, photos: int = 50, seed: int = 1):
+        self.users = max(1, users)
+        self.files = max(1, files)
+        self.admin_id = admin_id
+        mix = mix or DEFAULT_MIX
+        self.kinds = [k for k, w in mix.items() if w > 0]
+        self.weights = [mix[k] for k in self.kinds]
+        self.new_user_share = new_user_share
+        self.photos = photos
+        self.rng = random.Random(seed)
+        self._next_new_user = 10 ** 9
+        self._message_id = 0
+        self._documents = 0
+        self._queries = 0
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self
+
+    def __next__(self) -> Dict:
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        return getattr(self, f"_{kind}")()
+
+    def _user(self) -> Dict:
+        if self.rng.random() < self.new_user_share:
+            self._next_new_user += 1
+            uid = self._next_new_user
+        else:
+            uid = self.rng.randint(1, self.users)
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+    def _message(self, user: Dict, **fields) -> Dict:
+        self._message_id += 1
+        return dict({
+            "message_id": self._message_id, "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"}, "from": user,
+        }, **fields)
+
+    def _callback(self) -> Dict:
+        user = self._user()
+        data = self.rng.choice(_CALLBACKS).format(
+            page=self.rng.randint(0, max(0, self.files // 6 - 1)), file=self.rng.randrange(self.files)
+        )
+        self._queries += 1
+        return {"callback_query": {
+            "id": str(self._queries), "from": user, "chat_instance": str(user["id"]), "data": data,
+            "message": self._message({"id": 100000, "is_bot": True, "first_name": "Bench"}, text="menu",
+                                     chat={"id": user["id"], "type": "private"}),
+        }}
+
+    def _command(self) -> Dict:
+        user = self._user()
+        text = self.rng.choice(_COMMANDS).format(word=self.rng.choice(_WORDS))
+        if user["id"] > self.users:
+            text = "/start"
+        command = text.split()[0]
+        return {"message": self._message(user, text=text, entities=[
+            {"type": "bot_command", "offset": 0, "length": len(command)}
+        ])}
+
+    def _text(self) -> Dict:
+        return {"message": self._message(self._user(), text=self.rng.choice(_PROMPTS))}
+
+    def _photo(self) -> Dict:
+        n = self.rng.randrange(self.photos)
+        sizes = [
+            {"file_id": f"photo{n}_{w}", "file_unique_id": f"photo{n}_{w}", "width": w, "height": w * 3 // 4,
+             "file_size": w * w // 8}
+            for w in (90, 320, 1280)
+        ]
+        return {"message": self._message(self._user(), photo=sizes, caption="What is in this picture?")}
+
+    def _document(self) -> Dict:
+        self._documents += 1
+        n = self._documents
+        admin = {"id": self.admin_id, "is_bot": False, "first_name": "admin"}
+        return {"message": self._message(admin, document={
+            "file_id": f"bench-doc-{n}", "file_unique_id": f"bench-doc-{n}",
+            "file_name": f"{self.rng.choice(_WORDS)}-{n}.pdf", "mime_type": "application/pdf",
+            "file_size": 250000,
+        })}
+
+    def _inline(self) -> Dict:
+        self._queries += 1
+        return {"inline_query": {
+            "id": str(self._queries), "from": self._user(), "query": self.rng.choice(_WORDS), "offset": "",
+        }}
+
+
+def load_recorded(path: str) -> List[Tuple[Optional[float], Dict]]:
+    """(offset seconds or None, update) pairs from a JSONL recording."""
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if "update" in row:
+                out.append((row.get("t"), row["update"]))
+            else:
+                out.append((None, row))
+    return out
+
+
+async def replay(push: Callable[[Dict], object], updates: Iterator[Tuple[Optional[float], Dict]],
+                 rate: float, duration: float, speed: float = 1.0) -> int:
+    """
+    Push updates open-loop: at `rate` per second, or at their recorded
+    offsets (divided by `speed`) when they have one. Stops after `duration`
+    seconds or when the stream ends; returns how many were pushed.
+    """
+    started = time.perf_counter()
+    sent = 0
+    for offset, update in updates:
+        due = offset / speed if offset is not None else sent / rate
+        if due >= duration:
+            break
+        delay = started + due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        push(update)
+        sent += 1
+    return sent
@@ -0,0 +1,258 @@
+import asyncio
+import os
+import struct
+import time
+from typing import Dict, Iterable, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from rate_limit import TokenBucket
+from storage import read_json, read_records, write_json
+
+SENT, BLOCKED, FAILED = "sent", "blocked", "failed"
+RESULTS = (SENT, BLOCKED, FAILED)
+# One finished recipient in the progress log: index in the recipients list, result
+PROGRESS = struct.Struct("<IB")
+
+# BadRequest texts that mean the chat will never accept messages from us again
+_GONE = ("chat not found", "user is deactivated", "bot was kicked", "peer_id_invalid")
+
+
+def _retry_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class Broadcaster:
+    """
+    Sends one message to many chats as a background job.
+
+    Sends are paced by a global token bucket (`rate` messages/s) and go out
+    in chunks of about one second's worth. Each chat gets exactly one
+    message, which keeps well inside Telegram's per-chat limit. A RetryAfter
+    pauses the whole job for the requested time, since flood control on a
+    broadcast is account-wide; the chat is then retried. Chats that blocked
+    the bot are reported as BLOCKED so the caller can stop targeting them:
+    `on_blocked(chat_id)` is called for each, and `save_blocked()`, if given,
+    is awaited before the job is checkpointed as finished, so the caller can
+    make the marks durable.
+
+    A job is three files next to `state_path`: the recipients, written once
+    at the start (`<name>.recipients.json`); a progress log with one small
+    record appended as each recipient finishes (`<name>.log`); and the state
+    itself (counters, position), rewritten after each chunk. A restart, even
+    after a kill mid-chunk, resumes from the state and skips everyone the
+    log has, so only sends in flight at the moment of the crash can repeat.
+    The log also has the BLOCKED results, so on resume `on_blocked` is called
+    again for each: marks the killed process had not saved yet are not lost.
+
+    `bot` only needs send_message / copy_message, so a fake can stand in.
+    """
+
+    def __init__(self, state_path: str, rate: float = 30.0, max_retries: int = 3):
+        self.state_path = state_path
+        base = os.path.splitext(state_path)[0]
+        self.recipients_path = base + ".recipients.json"
+        self.log_path = base + ".log"
+        self.rate = rate
+        self.max_retries = max_retries
+        self.job: Optional[Dict] = None
+        self.recipients: List[int] = []
+        # Indices past the checkpointed position that the progress log says are finished
+        self._done: set = set()
+        self._log = None
+        self._task: Optional[asyncio.Task] = None
+        self._bucket = TokenBucket(rate, 1)
+        self._paused_until = 0.0
+        self.flood_waits = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def status(self) -> Optional[Dict]:
+        if self.job is None:
+            return None
+        job = self.job
+        return {k: job[k] for k in ("id", "state", "position", "sent", "blocked", "failed")} | {
+            "total": len(self.recipients)
+        }
+
+    def start(self, bot, message: Dict, recipients: Iterable[int],
+              notify_chat: Optional[int] = None, on_blocked=None, save_blocked=None) -> Dict:
+        """
+        Start a job. `message` is {"text": ...} or {"from_chat_id": ..., "message_id": ...}
+        (copied, so media and formatting survive).
+        """
+        if self.running:
+            raise RuntimeError("a broadcast is already running")
+        self.recipients = list(dict.fromkeys(recipients))
+        self.job = {
+            "id": int(time.time()),
+            "state": "running",
+            "message": message,
+            "position": 0,
+            "sent": 0, "blocked": 0, "failed": 0,
+            "notify_chat": notify_chat,
+        }
+        self._done = set()
+        self._open_log(truncate=True)
+        self._launch(bot, on_blocked, save_blocked, fresh=True)
+        return self.status()
+
+    def resume(self, bot, on_blocked=None, save_blocked=None) -> bool:
+        """Continue a job a previous process left unfinished."""
+        if self.running or not os.path.exists(self.state_path):
+            return False
+        job = read_json(self.state_path)
+        if job.get("state") != "running":
+            return False
+        # Jobs checkpointed before the recipients got their own file carry them inline
+        recipients = job.pop("recipients", None)
+        self.recipients = recipients if recipients is not None else read_json(self.recipients_path)
+        self.job = job
+        blocked = self._replay()
+        if on_blocked is not None:
+            for chat_id in blocked:
+                on_blocked(chat_id)
+        self._open_log(truncate=False)
+        self._launch(bot, on_blocked, save_blocked, fresh=recipients is not None)
+        return True
+
+    def cancel(self) -> bool:
+        if not self.running:
+            return False
+        self.job["state"] = "cancelled"
+        return True
+
+    async def close(self):
+        """Stop sending (e.g. on shutdown) without finishing the job; it resumes on next start."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._close_log()
+
+    def _launch(self, bot, on_blocked, save_blocked, fresh: bool):
+        self._task = asyncio.get_running_loop().create_task(self._run(bot, on_blocked, save_blocked, fresh))
+
+    def _open_log(self, truncate: bool):
+        self._close_log()
+        self._log = open(self.log_path, "wb" if truncate else "ab", buffering=0)
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _replay(self) -> List[int]:
+        """
+        Counters and finished recipients from the progress log (which runs
+        ahead of the state). Returns the chats that were found BLOCKED.
+        """
+        job = self.job
+        self._done = set()
+        if not os.path.exists(self.log_path):
+            return []
+        counts = [0, 0, 0]
+        done = set()
+        blocked = []
+        gone = RESULTS.index(BLOCKED)
+        for index, result in PROGRESS.iter_unpack(read_records(self.log_path, PROGRESS)):
+            counts[result] += 1
+            if index >= job["position"]:
+                done.add(index)
+            if result == gone:
+                blocked.append(self.recipients[index])
+        job.update(zip(RESULTS, counts))
+        self._done = done
+        return blocked
+
+    async def _checkpoint(self):
+        await asyncio.to_thread(write_json, self.state_path, dict(self.job), None)
+
+    async def _acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self._bucket.take(now):
+                return
+            await asyncio.sleep((1 - self._bucket.tokens) / self.rate)
+
+    async def _send(self, bot, chat_id: int, message: Dict):
+        if "text" in message:
+            await bot.send_message(chat_id=chat_id, text=message["text"])
+        else:
+            await bot.copy_message(chat_id=chat_id, from_chat_id=message["from_chat_id"],
+                                   message_id=message["message_id"])
+
+    async def deliver(self, bot, chat_id: int, message: Dict) -> str:
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            try:
+                await self._send(bot, chat_id, message)
+                return SENT
+            except RetryAfter as e:
+                self.flood_waits += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + _retry_seconds(e))
+            except Forbidden:
+                return BLOCKED
+            except BadRequest as e:
+                return BLOCKED if any(s in str(e).lower() for s in _GONE) else FAILED
+            except NetworkError:
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError:
+                return FAILED
+        return FAILED
+
+    async def _finish(self, bot, index: int, chat_id: int, on_blocked):
+        result = await self.deliver(bot, chat_id, self.job["message"])
+        # Logged the moment the send is over, so a kill later in the chunk can't repeat it
+        self._log.write(PROGRESS.pack(index, RESULTS.index(result)))
+        self.job[result] += 1
+        if result == BLOCKED and on_blocked is not None:
+            on_blocked(chat_id)
+
+    async def _run(self, bot, on_blocked, save_blocked, fresh: bool):
+        job = self.job
+        recipients = self.recipients
+        chunk = max(1, int(self.rate))
+        try:
+            if fresh:
+                # The only time the list is written; from here on the state is a few counters
+                await asyncio.to_thread(write_json, self.recipients_path, recipients, None)
+            await self._checkpoint()
+            while job["state"] == "running" and job["position"] < len(recipients):
+                start = job["position"]
+                batch = [(i, recipients[i]) for i in range(start, min(start + chunk, len(recipients)))
+                         if i not in self._done]
+                await asyncio.gather(*(self._finish(bot, i, c, on_blocked) for i, c in batch))
+                self._done.difference_update(range(start, start + chunk))
+                job["position"] = min(start + chunk, len(recipients))
+                await self._checkpoint()
+            if job["blocked"] and save_blocked is not None:
+                # Past the final checkpoint the log is never replayed again
+                await save_blocked()
+            if job["state"] == "running":
+                job["state"] = "done"
+            await self._checkpoint()
+        except asyncio.CancelledError:
+            # Shutdown: keep state "running" so the next start resumes
+            await asyncio.shield(self._checkpoint())
+            raise
+        self._close_log()
+        if job.get("notify_chat"):
+            try:
+                await bot.send_message(
+                    chat_id=job["notify_chat"],
+                    text=f"Broadcast {job['state']}: sent {job['sent']}, "
+                         f"blocked {job['blocked']}, failed {job['failed']} "
+                         f"of {len(recipients)}.",
+                )
+            except TelegramError:
+                pass
@@ -0,0 +1,72 @@
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from metrics import CALLBACK_SECONDS
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+class CallbackRouter:
+    """
+    Maps callback_data to handlers.
+    Exact routes are a single dict lookup. Prefix routes cover data shaped
+    like "<prefix><arg>" where the prefix ends in "_" (e.g. "file_12"); the
+    prefix is found with one rpartition + dict lookup, and the argument is
+    converted with the route's parser before the handler is called.
+    Each dispatch is timed under its route (the exact data or the prefix).
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Tuple[Handler, tuple]] = {}
+        self._prefix: Dict[str, Tuple[Handler, Callable[[str], Any]]] = {}
+
+    def exact(self, data: str, *args):
+        """Register a handler for `data`; extra args are passed to it after (update, context)."""
+        def register(fn: Handler) -> Handler:
+            self._exact[data] = (fn, args)
+            return fn
+        return register
+
+    def prefix(self, prefix: str, parse: Callable[[str], Any] = int):
+        if not prefix.endswith("_"):
+            raise ValueError("prefix routes must end with '_'")
+
+        def register(fn: Handler) -> Handler:
+            self._prefix[prefix] = (fn, parse)
+            return fn
+        return register
+
+    def match(self, data: str) -> Optional[Tuple[str, Handler, tuple]]:
+        """(route name, handler, extra args) for `data`, or None if nothing matches or the argument does not parse."""
+        route = self._exact.get(data)
+        if route is not None:
+            return (data,) + route
+        head, sep, tail = data.rpartition("_")
+        if not sep:
+            return None
+        name = head + sep
+        route = self._prefix.get(name)
+        if route is None:
+            return None
+        fn, parse = route
+        try:
+            return name, fn, (parse(tail),)
+        except ValueError:
+            return None
+
+    def resolve(self, data: str) -> Optional[Tuple[Handler, tuple]]:
+        """Handler and extra args for `data`, or None."""
+        found = self.match(data)
+        return None if found is None else found[1:]
+
+    async def dispatch(self, update, context) -> bool:
+        found = self.match(update.callback_query.data or "")
+        if found is None:
+            return False
+        name, fn, args = found
+        started = time.perf_counter()
+        try:
+            await fn(update, context, *args)
+        finally:
+            CALLBACK_SECONDS.labels(name).observe(time.perf_counter() - started)
+        return True
@@ -0,0 +1,190 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from search_index import SearchIndex
+
+
+class Catalog:
+    """
+    Resident copy of the file catalog, loaded from the storage backend once.
+    Mutations write through to the backend and update the in-memory list,
+    so reads never go back to disk. Entries are addressed by their DATA
+    index or by Telegram file_id, both in O(1); file_unique_id (when the
+    entry has one) is indexed too, for de-duplicating uploads.
+
+    Additions write the backend from a worker thread, since a JSON catalog
+    is rewritten whole; they run one at a time, so the positions handed out
+    follow the order of the writes.
+
+    Rendered pages (e.g. DATA keyboards) can be memoized with cached_page();
+    every mutation clears them. A full-text index over titles and
+    descriptions is kept in step with each add/update.
+
+    With shared=True (shard workers writing the same backend), refresh()
+    picks up changes made by other processes: the backend reports the
+    entries appended and edited since the last refresh, and only those are
+    indexed again. Own additions are not applied in memory but picked up
+    by a refresh after the write, so if another process wrote in between
+    the positions they return are still the ones every process sees.
+    """
+
+    def __init__(self, backend, shared: bool = False):
+        self.backend = backend
+        self.shared = shared
+        self._pages: Dict[Tuple[int, int], Any] = {}
+        self._version = backend.files_version() if shared else None
+        self._adding = asyncio.Lock()
+        if shared:
+            self._cursor, items, _ = backend.file_changes(0, None)
+        else:
+            items = backend.list_files()
+        self._rebuild(items)
+
+    def _rebuild(self, items: List[Dict]):
+        self._items: List[Dict] = items
+        self._by_file_id: Dict[str, int] = {}
+        self._by_unique_id: Dict[str, int] = {}
+        self.index = SearchIndex()
+        for idx, item in enumerate(self._items):
+            self._track(idx, item)
+
+    def refresh(self):
+        if not self.shared:
+            return
+        version = self.backend.files_version()
+        if version == self._version:
+            return
+        # Read after the version: a change in between is caught by the next refresh
+        self._version = version
+        changes = self.backend.file_changes(len(self._items), self._cursor)
+        if changes is None:
+            self._cursor, items, _ = self.backend.file_changes(0, None)
+            self._rebuild(items)
+        else:
+            self._cursor, appended, edited = changes
+            for idx, item in edited.items():
+                self._replace(idx, item)
+            for idx, item in enumerate(appended, start=len(self._items)):
+                self._items.append(item)
+                self._track(idx, item)
+        self._changed()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def items(self) -> List[Dict]:
+        return self._items
+
+    def get(self, index: int) -> Optional[Dict]:
+        if 0 <= index < len(self._items):
+            return self._items[index]
+        return None
+
+    def index_of(self, file_id: str) -> Optional[int]:
+        return self._by_file_id.get(file_id)
+
+    def contains(self, entry: Dict) -> bool:
+        """True if the same Telegram file is already catalogued."""
+        unique_id = entry.get("file_unique_id")
+        if unique_id and unique_id in self._by_unique_id:
+            return True
+        return bool(entry.get("file_id")) and entry["file_id"] in self._by_file_id
+
+    def _position(self, entry: Dict) -> Optional[int]:
+        unique_id = entry.get("file_unique_id")
+        if unique_id and unique_id in self._by_unique_id:
+            return self._by_unique_id[unique_id]
+        return self._by_file_id.get(entry.get("file_id"))
+
+    def _track(self, idx: int, item: Dict):
+        if item.get("file_id"):
+            self._by_file_id[item["file_id"]] = idx
+        if item.get("file_unique_id"):
+            self._by_unique_id[item["file_unique_id"]] = idx
+        self.index.add(idx, item.get("title", ""), item.get("description", ""))
+
+    def _replace(self, idx: int, item: Dict):
+        old = self._items[idx]
+        if self._by_file_id.get(old.get("file_id")) == idx:
+            del self._by_file_id[old["file_id"]]
+        if self._by_unique_id.get(old.get("file_unique_id")) == idx:
+            del self._by_unique_id[old["file_unique_id"]]
+        self._items[idx] = item
+        self._track(idx, item)
+
+    def page(self, page: int, page_size: int) -> List[Tuple[int, Dict]]:
+        start = page * page_size
+        return list(enumerate(self._items[start:start + page_size], start=start))
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[int, Dict]]:
+        return [(idx, self._items[idx]) for idx, _ in self.index.search(query, limit)]
+
+    def cached_page(self, page: int, page_size: int, build: Callable[[int, int], Any]) -> Any:
+        key = (page, page_size)
+        rendered = self._pages.get(key)
+        if rendered is None:
+            rendered = self._pages[key] = build(page, page_size)
+        return rendered
+
+    def _changed(self):
+        self._pages.clear()
+
+    async def add(self, entry: Dict) -> int:
+        async with self._adding:
+            await asyncio.to_thread(self.backend.add_file, entry)
+            if self.shared:
+                self.refresh()
+                return self._position(entry)
+            self._items.append(entry)
+            idx = len(self._items) - 1
+            self._track(idx, entry)
+            self._changed()
+            return idx
+
+    async def add_many(self, entries: List[Dict]) -> Tuple[List[int], int]:
+        """
+        Add entries with a single backend write, skipping files already in the
+        catalog or repeated within the batch. Returns (new indexes, skipped).
+        """
+        async with self._adding:
+            return await self._add_many(entries)
+
+    async def _add_many(self, entries: List[Dict]) -> Tuple[List[int], int]:
+        fresh: List[Dict] = []
+        seen = set()
+        for entry in entries:
+            key = entry.get("file_unique_id") or entry.get("file_id")
+            if key in seen or self.contains(entry):
+                continue
+            seen.add(key)
+            fresh.append(entry)
+        if fresh:
+            await asyncio.to_thread(self.backend.add_files, fresh)
+        if self.shared:
+            self.refresh()
+            return sorted(self._position(entry) for entry in fresh), len(entries) - len(fresh)
+        start = len(self._items)
+        for idx, entry in enumerate(fresh, start=start):
+            self._items.append(entry)
+            self._track(idx, entry)
+        if fresh:
+            self._changed()
+        return list(range(start, start + len(fresh))), len(entries) - len(fresh)
+
+    def update(self, index: int, fields: Dict) -> bool:
+        item = self.get(index)
+        if item is None or not self.backend.update_file(index, fields):
+            return False
+        old_file_id = item.get("file_id")
+        item.update(fields)
+        if item.get("file_id") != old_file_id:
+            self._by_file_id.pop(old_file_id, None)
+            if item.get("file_id"):
+                self._by_file_id[item["file_id"]] = index
+        if "title" in fields or "description" in fields:
+            self.index.add(index, item.get("title", ""), item.get("description", ""))
+        if "title" in fields:
+            # Pages only render titles; description edits leave them valid
+            self._changed()
+        self.refresh()
+        return True
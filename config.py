@@ -1,10 +1,79 @@
 import os
+import secrets
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# Bot API endpoints (token appended); point at a self-hosted telegram-bot-api server or a local fake
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+# Sharded mode: with SHARDS > 1, `python main.py` is a front process that receives updates and
+# routes each chat to one of SHARDS worker processes (shards.py), one per CPU core. The front
+# sets SHARD_INDEX for each worker; limits that are global (Deepseek concurrency, the global
+# prompt rate) are split evenly between the workers. Worker i listens for forwarded updates on
+# 127.0.0.1:SHARD_BASE_PORT+i and serves metrics on METRICS_PORT+1+i.
+SHARDS = max(1, int(os.getenv("SHARDS", "1")))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "-1"))
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "8700"))
+_SHARE = SHARDS if SHARD_INDEX >= 0 else 1
+
+def _per_shard(path: str) -> str:
+    """data/jobs.db -> data/jobs.2.db in worker 2, for state that only one process may own."""
+    if SHARD_INDEX < 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{SHARD_INDEX}{ext}"
+
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()]
 GROUP_CHAT_ID = int(os.getenv("GROUP_CHAT_ID", "0"))
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")
 DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+# Photos go to an OpenAI-compatible vision endpoint (image sent as base64 content)
+DEEPSEEK_VISION_URL = os.getenv("DEEPSEEK_VISION_URL", DEEPSEEK_API_URL)
+DEEPSEEK_VISION_MODEL = os.getenv("DEEPSEEK_VISION_MODEL", "deepseek-vl2")
+# Shared HTTP pool for the Deepseek client (HTTP/2 is used when the h2 package is installed)
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "20"))
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "20"))
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "30"))
+# Timeouts (seconds): connect, wait for a complete answer, and max silence between streamed chunks
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5"))
+DEEPSEEK_READ_TIMEOUT = float(os.getenv("DEEPSEEK_READ_TIMEOUT", "60"))
+DEEPSEEK_STREAM_READ_TIMEOUT = float(os.getenv("DEEPSEEK_STREAM_READ_TIMEOUT", "20"))
+# Retries on 429/5xx/network errors: attempts in total, jittered exponential backoff, and the
+# longest Retry-After worth waiting for
+DEEPSEEK_MAX_ATTEMPTS = int(os.getenv("DEEPSEEK_MAX_ATTEMPTS", "3"))
+DEEPSEEK_BACKOFF_BASE = float(os.getenv("DEEPSEEK_BACKOFF_BASE", "0.5"))
+DEEPSEEK_BACKOFF_MAX = float(os.getenv("DEEPSEEK_BACKOFF_MAX", "8"))
+DEEPSEEK_MAX_RETRY_AFTER = float(os.getenv("DEEPSEEK_MAX_RETRY_AFTER", "20"))
+# Circuit breaker: after this many consecutive failures, fail fast for DEEPSEEK_BREAKER_RESET seconds
+DEEPSEEK_BREAKER_THRESHOLD = int(os.getenv("DEEPSEEK_BREAKER_THRESHOLD", "5"))
+DEEPSEEK_BREAKER_RESET = float(os.getenv("DEEPSEEK_BREAKER_RESET", "30"))
+# Hedging (non-streamed calls): send a second request once the first is slower than the recent
+# p95 latency (never sooner than DEEPSEEK_HEDGE_MIN_DELAY). Costs up to one extra request per call.
+DEEPSEEK_HEDGE = os.getenv("DEEPSEEK_HEDGE", "false").lower() == "true"
+DEEPSEEK_HEDGE_MIN_DELAY = float(os.getenv("DEEPSEEK_HEDGE_MIN_DELAY", "2"))
+# Admission control: requests in flight, and how many more may wait before "busy" is returned
+DEEPSEEK_MAX_CONCURRENCY = max(1, int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "16")) // _SHARE)
+DEEPSEEK_MAX_QUEUE = int(os.getenv("DEEPSEEK_MAX_QUEUE", "200")) // _SHARE
+# Completion cache: modes it applies to (comma-separated), and it is skipped above this temperature.
+# DEEPSEEK_CACHE_DB persists entries across restarts (empty = memory only).
+DEEPSEEK_CACHE_MODES = [m.strip() for m in os.getenv("DEEPSEEK_CACHE_MODES", "coder").split(",") if m.strip()]
+DEEPSEEK_CACHE_MAX_TEMPERATURE = float(os.getenv("DEEPSEEK_CACHE_MAX_TEMPERATURE", "0.3"))
+DEEPSEEK_CACHE_MAX_ENTRIES = int(os.getenv("DEEPSEEK_CACHE_MAX_ENTRIES", "2000"))
+DEEPSEEK_CACHE_TTL = float(os.getenv("DEEPSEEK_CACHE_TTL", "86400"))
+DEEPSEEK_CACHE_DB = os.getenv("DEEPSEEK_CACHE_DB", "")
+# Conversation memory: prior turns sent with each prompt, capped at this many (estimated) tokens.
+# Sessions idle longer than CONVERSATION_IDLE_TTL seconds are dropped.
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "3000"))
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "5000"))
+CONVERSATION_IDLE_TTL = float(os.getenv("CONVERSATION_IDLE_TTL", "1800"))
+# Token-bucket limits on Deepseek prompts (text and photo), per user and across all users
+USER_RATE_PER_SEC = float(os.getenv("USER_RATE_PER_SEC", "0.2"))
+USER_RATE_BURST = float(os.getenv("USER_RATE_BURST", "3"))
+GLOBAL_RATE_PER_SEC = float(os.getenv("GLOBAL_RATE_PER_SEC", "10")) / _SHARE
+GLOBAL_RATE_BURST = float(os.getenv("GLOBAL_RATE_BURST", "30")) / _SHARE
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))
+# Stream replies token-by-token, editing the message at most once per interval (seconds)
+DEEPSEEK_STREAM = os.getenv("DEEPSEEK_STREAM", "true").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
 
 # UI constants
 NAV_HOME = "Home"
@@ -15,10 +84,77 @@ AI_LOGO_TEXT = "AI Links"
 
 # File limits: Telegram allows sending documents up to 50MB for bots (practical target 30–40MB)
 MAX_DOC_SIZE_MB = 50
+# Photo prompts: download cap, longest side sent to the model, largest bitmap decoded (in
+# megapixels; non-JPEG images are decoded at full size), parallel downloads, and memory for
+# prepared images (reposts of the same image are not downloaded again)
+MEDIA_MAX_DOWNLOAD_MB = float(os.getenv("MEDIA_MAX_DOWNLOAD_MB", "10"))
+MEDIA_MAX_DIM = int(os.getenv("MEDIA_MAX_DIM", "1024"))
+MEDIA_MAX_MEGAPIXELS = float(os.getenv("MEDIA_MAX_MEGAPIXELS", "25"))
+MEDIA_MAX_CONCURRENCY = int(os.getenv("MEDIA_MAX_CONCURRENCY", "4"))
+MEDIA_CACHE_MB = float(os.getenv("MEDIA_CACHE_MB", "32"))
 
 DATA_DIR = os.getenv("DATA_DIR", "data")
 FILES_JSON = os.path.join(DATA_DIR, "files.json")
 USERS_JSON = os.path.join(DATA_DIR, "users.json")
+# User settings live in memory; dirty state is written back at most this often (seconds)
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "2.0"))
+# Storage backend: json (users.json/files.json) | sqlite (migrates the JSON files on first start)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_DB = os.getenv("SQLITE_DB", os.path.join(DATA_DIR, "bot.db"))
+# Admin uploads are indexed in batches: a batch (album or run of documents in one chat) is
+# committed after INGEST_WINDOW seconds without a new document, or at INGEST_MAX_BATCH files.
+INGEST_WINDOW = float(os.getenv("INGEST_WINDOW", "1.5"))
+INGEST_MAX_BATCH = int(os.getenv("INGEST_MAX_BATCH", "500"))
+
+# /broadcast: global send rate (Telegram allows about 30 msgs/s) and the checkpoint file
+# that lets a restarted bot resume an unfinished broadcast instead of starting over (one per shard:
+# a broadcast runs in the worker that owns the admin's chat). Admins in different shards can
+# broadcast at the same time, so each worker gets its share of the rate.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30")) / _SHARE
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_STATE = _per_shard(os.getenv("BROADCAST_STATE", os.path.join(DATA_DIR, "broadcast.json")))
+
+# Deepseek prompts are queued in SQLite and answered by JOBS_WORKERS workers, so prompts still
+# unanswered at a restart (e.g. a redeploy) are resumed. With JOBS_MAX_QUEUED prompts waiting, new
+# ones get "busy". A job interrupted JOBS_MAX_ATTEMPTS times is given up; finished jobs are kept
+# JOBS_RETENTION seconds (long enough to recognise a redelivered update). Each shard has its own queue.
+# 4 workers measured best in the load test (95 upd/s vs 52 with 16, whose streamed edits swamp the loop).
+JOBS_DB = _per_shard(os.getenv("JOBS_DB", os.path.join(DATA_DIR, "jobs.db")))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "200"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+JOBS_RETENTION = float(os.getenv("JOBS_RETENTION", "86400"))
+
+# Deepseek token quotas per user (prompt + completion tokens per UTC day and calendar month;
+# 0 = no limit; admins are exempt). Usage of every call is appended to a ledger in USAGE_DIR (one
+# file per month), buffered for USAGE_FLUSH_INTERVAL seconds; the per-user counters are snapshotted
+# every USAGE_SNAPSHOT_INTERVAL seconds, so a restart replays only what was logged since. Each
+# shard keeps its own ledger (a chat always lands on the same shard).
+USAGE_DIR = os.getenv("USAGE_DIR", os.path.join(DATA_DIR, "usage"))
+USAGE_DAILY_TOKENS = int(os.getenv("USAGE_DAILY_TOKENS", "200000"))
+USAGE_MONTHLY_TOKENS = int(os.getenv("USAGE_MONTHLY_TOKENS", "2000000"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_SNAPSHOT_INTERVAL = float(os.getenv("USAGE_SNAPSHOT_INTERVAL", "60"))
+
+# Render note: with long polling, ensure only one instance
+POLLING_INTERVAL = float(os.getenv("POLLING_INTERVAL", "0.5"))
+
+# Webhook mode: Telegram POSTs updates to WEBHOOK_URL + WEBHOOK_PATH, served on PORT.
+# WEBHOOK_URL empty = serve only, don't register (e.g. local testing with recorded updates).
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "false").lower() == "true"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", os.getenv("RENDER_EXTERNAL_URL", ""))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Every POST must carry WEBHOOK_SECRET, since handlers trust the user ids in an update. When this
+# process registers the webhook itself and none is set, a random one is generated at each start.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or (secrets.token_urlsafe(32) if WEBHOOK_MODE and WEBHOOK_URL else "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "10000"))
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
-# Render note: we use long polling; ensure only one instance
-POLLING_INTERVAL = float(os.getenv("POLLING_INTERVAL", "0.5"))
\ No newline at end of file
+# Update processing: with more than one worker, different chats are handled in parallel
+# while each chat's updates stay in order. At most UPDATE_MAX_PENDING are admitted at once.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
\ No newline at end of file
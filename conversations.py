@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English/code; good enough for budgeting
+    # and computed once per turn, never over the whole history.
+    return len(text) // 4 + 1
+
+
+class Session:
+    """One user's recent turns with a running token total."""
+
+    def __init__(self):
+        self.turns: Deque[Tuple[str, str, int]] = deque()  # (role, content, tokens)
+        self.tokens = 0
+        self.last_used = time.monotonic()
+
+    def add(self, role: str, content: str):
+        n = estimate_tokens(content)
+        self.turns.append((role, content, n))
+        self.tokens += n
+
+    def trim(self, budget: int):
+        # Drop the oldest turns until the history fits
+        while self.turns and self.tokens > budget:
+            _, _, n = self.turns.popleft()
+            self.tokens -= n
+        # Never start the context with a dangling assistant reply
+        while self.turns and self.turns[0][0] == "assistant":
+            _, _, n = self.turns.popleft()
+            self.tokens -= n
+
+    def messages(self) -> List[Dict]:
+        return [{"role": role, "content": content} for role, content, _ in self.turns]
+
+
+class ConversationStore:
+    """
+    Per-user conversation history held in memory.
+    Sessions are kept in least-recently-used order; idle ones (older than
+    `idle_ttl` seconds) and any beyond `max_sessions` are evicted.
+    """
+
+    def __init__(self, token_budget: int = 3000, max_sessions: int = 5000, idle_ttl: float = 1800.0):
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self._sessions: "OrderedDict[int, Session]" = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) > self.max_sessions or now - session.last_used > self.idle_ttl:
+                del self._sessions[user_id]
+            else:
+                break
+
+    def session(self, user_id: int) -> Session:
+        now = time.monotonic()
+        s = self._sessions.get(user_id)
+        if s is None or now - s.last_used > self.idle_ttl:
+            s = self._sessions[user_id] = Session()
+        self._sessions.move_to_end(user_id)
+        s.last_used = now
+        self._evict(now)
+        return s
+
+    def context(self, user_id: int, prompt: str) -> List[Dict]:
+        """Prior turns that fit the budget alongside `prompt`, followed by the prompt itself."""
+        s = self.session(user_id)
+        s.trim(max(self.token_budget - estimate_tokens(prompt), 0))
+        return s.messages() + [{"role": "user", "content": prompt}]
+
+    def record(self, user_id: int, prompt: str, reply: str):
+        s = self.session(user_id)
+        s.add("user", prompt)
+        s.add("assistant", reply)
+        s.trim(self.token_budget)
+
+    def reset(self, user_id: int) -> bool:
+        return self._sessions.pop(user_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -1,40 +1,380 @@
+import asyncio
+import json
+import time
 import httpx
-from typing import Optional, List, Dict
-from config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL
+from typing import AsyncIterator, Iterable, Optional, List, Dict
+from config import (
+    DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_VISION_URL, DEEPSEEK_VISION_MODEL,
+    DEEPSEEK_MAX_CONNECTIONS, DEEPSEEK_MAX_KEEPALIVE, DEEPSEEK_KEEPALIVE_EXPIRY,
+    DEEPSEEK_MAX_CONCURRENCY, DEEPSEEK_MAX_QUEUE,
+    DEEPSEEK_CACHE_MODES, DEEPSEEK_CACHE_MAX_TEMPERATURE,
+    DEEPSEEK_CONNECT_TIMEOUT, DEEPSEEK_READ_TIMEOUT, DEEPSEEK_STREAM_READ_TIMEOUT,
+    DEEPSEEK_MAX_ATTEMPTS, DEEPSEEK_BACKOFF_BASE, DEEPSEEK_BACKOFF_MAX, DEEPSEEK_MAX_RETRY_AFTER,
+    DEEPSEEK_BREAKER_THRESHOLD, DEEPSEEK_BREAKER_RESET, DEEPSEEK_HEDGE, DEEPSEEK_HEDGE_MIN_DELAY,
+)
+from conversations import estimate_tokens
+from metrics import UPSTREAM_SECONDS, counter
+from resilience import CircuitBreaker, LatencyTracker, RetryPolicy, hedged, parse_retry_after
+from response_cache import CompletionCache, cache_key
+from usage import CODER, ESTIMATED, VISION, UsageLedger
+
+RETRIES = counter("deepseek_retries_total", "Deepseek requests retried.", ["reason"])
+HEDGES = counter("deepseek_hedges_total", "Hedged second requests sent.")
+REJECTED = counter("deepseek_circuit_rejections_total", "Calls refused while the circuit breaker was open.")
+
+# Worth retrying: rate limited or the upstream is struggling
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class DeepseekBusy(Exception):
+    """Raised when the admission queue is full; the caller should reply 'try again'."""
+
+
+class DeepseekUnavailable(Exception):
+    """The upstream failed (after retries) or the circuit breaker is open; reply with a friendly note."""
+
+
+class _Retryable(Exception):
+    def __init__(self, reason: str, retry_after: Optional[float] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    At most `limit` calls in flight; up to `max_queue` more wait their turn in
+    FIFO order. Anything beyond that is rejected immediately with DeepseekBusy.
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self._sem = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def __aenter__(self):
+        if self._sem.locked():
+            if self.waiting >= self.max_queue:
+                raise DeepseekBusy()
+            self.waiting += 1
+            try:
+                await self._sem.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._sem.acquire()
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.in_flight -= 1
+        self._sem.release()
+
 
 class DeepseekClient:
-    def __init__(self, api_key: str = DEEPSEEK_API_KEY, base_url: str = DEEPSEEK_API_URL):
+    def __init__(
+        self,
+        api_key: str = DEEPSEEK_API_KEY,
+        base_url: str = DEEPSEEK_API_URL,
+        max_connections: int = DEEPSEEK_MAX_CONNECTIONS,
+        max_keepalive: int = DEEPSEEK_MAX_KEEPALIVE,
+        keepalive_expiry: float = DEEPSEEK_KEEPALIVE_EXPIRY,
+        max_concurrency: int = DEEPSEEK_MAX_CONCURRENCY,
+        max_queue: int = DEEPSEEK_MAX_QUEUE,
+        cache: Optional[CompletionCache] = None,
+        cache_modes: Iterable[str] = DEEPSEEK_CACHE_MODES,
+        vision_url: str = DEEPSEEK_VISION_URL,
+        vision_model: str = DEEPSEEK_VISION_MODEL,
+        connect_timeout: float = DEEPSEEK_CONNECT_TIMEOUT,
+        read_timeout: float = DEEPSEEK_READ_TIMEOUT,
+        stream_read_timeout: float = DEEPSEEK_STREAM_READ_TIMEOUT,
+        retry: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge: bool = DEEPSEEK_HEDGE,
+        hedge_min_delay: float = DEEPSEEK_HEDGE_MIN_DELAY,
+        ledger: Optional[UsageLedger] = None,
+    ):
         self.api_key = api_key
         self.base_url = base_url
+        self.vision_url = vision_url
+        self.vision_model = vision_model
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.limiter = AdmissionLimiter(max_concurrency, max_queue)
+        self.cache = cache
+        self.cache_modes = set(cache_modes)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout)
+        self.stream_timeout = httpx.Timeout(stream_read_timeout, connect=connect_timeout, pool=connect_timeout)
+        self.retry = retry or RetryPolicy(
+            DEEPSEEK_MAX_ATTEMPTS, DEEPSEEK_BACKOFF_BASE, DEEPSEEK_BACKOFF_MAX, DEEPSEEK_MAX_RETRY_AFTER
+        )
+        self.breaker = breaker or CircuitBreaker(DEEPSEEK_BREAKER_THRESHOLD, DEEPSEEK_BREAKER_RESET)
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+        self.ledger = ledger
+        self._client: Optional[httpx.AsyncClient] = None
 
-    async def chat(self, messages: List[Dict], mode: str = "normal") -> str:
-        """
-        mode: normal | coder
-        - normal: concise helpful replies
-        - coder: maximize code completeness, return longer code blocks
-        """
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=HTTP2_AVAILABLE,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def image_message(prompt: str, image_url: str) -> Dict:
+        """User message carrying an image (e.g. a base64 data URL) in OpenAI content-part form."""
+        return {"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": image_url}},
+        ]}
+
+    def _payload(self, messages: List[Dict], mode: str, stream: bool = False,
+                 model: str = "deepseek-chat") -> Dict:
         system = "You are Deepseek. Be accurate and helpful."
         if mode == "coder":
             system = "You are Deepseek Coder. Provide complete, large, copy-ready code with explanations when needed."
 
         payload = {
-            "model": "deepseek-chat",  # adjust if your account requires a specific model name
+            "model": model,  # adjust if your account requires a specific model name
             "messages": [{"role": "system", "content": system}] + messages,
             "temperature": 0.2 if mode == "coder" else 0.7,
             "max_tokens": 2048 if mode == "normal" else 8192,
         }
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(self.base_url, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-            # Adjust parsing to Deepseek API response format if needed
-            content = (
-                data.get("choices", [{}])[0]
-                .get("message", {})
-                .get("content", "")
-            )
-            return content or "No content returned."
\ No newline at end of file
+        if stream:
+            payload["stream"] = True
+            # Ask for a final chunk carrying the usage block
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _record_usage(self, user_id: Optional[int], payload: Dict, mode: str, vision: bool,
+                      usage: Optional[Dict], content: str):
+        """Add the call to the usage ledger; estimated from the text when the API sent no usage block."""
+        if self.ledger is None:
+            return
+        flags = (CODER if mode == "coder" else 0) | (VISION if vision else 0)
+        if usage:
+            prompt, completion = usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+        else:
+            # No usage block (e.g. a stream the reader abandoned); images are not counted
+            flags |= ESTIMATED
+            texts = [m["content"] if isinstance(m["content"], str) else
+                     " ".join(part.get("text", "") for part in m["content"]) for m in payload["messages"]]
+            prompt, completion = sum(estimate_tokens(t) for t in texts), estimate_tokens(content)
+        self.ledger.record(user_id or 0, prompt, completion, flags)
+
+    def _cache_key(self, payload: Dict, mode: str) -> Optional[str]:
+        # Only cache modes configured for it, and only near-deterministic sampling
+        if (
+            self.cache is None
+            or mode not in self.cache_modes
+            or payload["temperature"] > DEEPSEEK_CACHE_MAX_TEMPERATURE
+        ):
+            return None
+        return cache_key(payload)
+
+    async def chat(self, messages: List[Dict], mode: str = "normal", vision: bool = False,
+                   user_id: Optional[int] = None) -> str:
+        """
+        mode: normal | coder
+        - normal: concise helpful replies
+        - coder: maximize code completeness, return longer code blocks
+        vision: send to the vision endpoint/model (messages with image content).
+        user_id: whose usage ledger entry the call's tokens go to (cache hits are free).
+        Raises DeepseekBusy if too many requests are already queued.
+        """
+        if vision:
+            payload = self._payload(messages, mode, model=self.vision_model)
+            url, upstream = self.vision_url, "deepseek_vision"
+        else:
+            payload = self._payload(messages, mode)
+            url, upstream = self.base_url, "deepseek"
+        key = self._cache_key(payload, mode)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        async with self.limiter:
+            data = await self._with_retries(lambda: hedged(
+                lambda: self._post_once(url, payload, upstream), self._hedge_delay(), HEDGES.inc
+            ))
+        # Adjust parsing to Deepseek API response format if needed
+        content = (
+            data.get("choices", [{}])[0]
+            .get("message", {})
+            .get("content", "")
+        )
+        self._record_usage(user_id, payload, mode, vision, data.get("usage"), content or "")
+        if content and key is not None:
+            self.cache.put(key, content)
+        return content or "No content returned."
+
+    async def stream_chat(self, messages: List[Dict], mode: str = "normal",
+                          user_id: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Same as chat(), but with `stream: true`: yields content deltas as the
+        server-sent events arrive. The admission slot is held until the
+        stream ends or the consumer stops iterating. A cache hit is yielded
+        as a single delta. Failures are retried only until the first delta
+        has been yielded; after that they raise DeepseekUnavailable. Usage is
+        taken from the final usage chunk, or estimated if the stream ended
+        without one after producing output.
+        """
+        payload = self._payload(messages, mode, stream=True)
+        key = self._cache_key(payload, mode)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+        parts: List[str] = []
+        usage: Dict = {}
+        async with self.limiter:
+            self._admit()
+            attempt = 0
+            try:
+                while True:
+                    try:
+                        async for delta in self._stream_once(payload, usage):
+                            parts.append(delta)
+                            yield delta
+                        break
+                    except _Retryable as e:
+                        delay = self._failed(e, attempt, can_retry=not parts)
+                        await asyncio.sleep(delay)
+                        attempt += 1
+            finally:
+                # Also when the consumer stops early: the tokens were generated all the same
+                if usage or parts:
+                    self._record_usage(user_id, payload, mode, False, usage, "".join(parts))
+            self.breaker.record_success()
+        # Reached only when the stream completed, so partial answers are never cached
+        if parts and key is not None:
+            self.cache.put(key, "".join(parts))
+
+    # ---------- Resilience ----------
+
+    def _admit(self):
+        if not self.breaker.allow():
+            REJECTED.inc()
+            raise DeepseekUnavailable("circuit open")
+
+    def _failed(self, error: "_Retryable", attempt: int, can_retry: bool = True) -> float:
+        """Record a failed attempt; the backoff before the next one, or raise DeepseekUnavailable."""
+        if error.reason != "429":
+            # Rate limiting says nothing about the upstream being down
+            self.breaker.record_failure()
+        delay = self.retry.delay(attempt, error.retry_after) if can_retry else None
+        if delay is None or not self.breaker.allow():
+            raise DeepseekUnavailable(f"Deepseek request failed ({error.reason})") from error
+        RETRIES.labels(error.reason).inc()
+        return delay
+
+    async def _with_retries(self, attempt_once):
+        self._admit()
+        attempt = 0
+        while True:
+            try:
+                result = await attempt_once()
+            except _Retryable as e:
+                await asyncio.sleep(self._failed(e, attempt))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.latency) < 20:
+            return None
+        return max(self.hedge_min_delay, self.latency.percentile(0.95))
+
+    @staticmethod
+    def _check(r: httpx.Response):
+        if r.status_code in RETRYABLE_STATUS:
+            raise _Retryable(str(r.status_code), parse_retry_after(r.headers.get("retry-after")))
+        if r.status_code >= 400:
+            raise DeepseekUnavailable(f"Deepseek returned HTTP {r.status_code}")
+
+    async def _post_once(self, url: str, payload: Dict, upstream: str) -> Dict:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            try:
+                r = await self.client.post(url, json=payload)
+            except httpx.TimeoutException as e:
+                status = "timeout"
+                raise _Retryable("timeout") from e
+            except httpx.TransportError as e:
+                raise _Retryable("network") from e
+            status = str(r.status_code)
+            self._check(r)
+            try:
+                data = r.json()
+            except ValueError as e:
+                raise _Retryable("bad_response") from e
+        finally:
+            elapsed = time.perf_counter() - started
+            UPSTREAM_SECONDS.labels(upstream, status).observe(elapsed)
+        self.latency.record(elapsed)
+        return data
+
+    async def _stream_once(self, payload: Dict, usage: Dict) -> AsyncIterator[str]:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self.client.stream("POST", self.base_url, json=payload,
+                                          timeout=self.stream_timeout) as r:
+                status = str(r.status_code)
+                self._check(r)
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    if chunk.get("usage"):
+                        usage.update(chunk["usage"])
+                    delta = (
+                        (chunk.get("choices") or [{}])[0]
+                        .get("delta", {})
+                        .get("content")
+                    )
+                    if delta:
+                        yield delta
+        except httpx.TimeoutException as e:
+            status = "timeout"
+            raise _Retryable("timeout") from e
+        except httpx.TransportError as e:
+            raise _Retryable("network") from e
+        finally:
+            # Request start to end of stream (or until the consumer stopped)
+            UPSTREAM_SECONDS.labels("deepseek_stream", status).observe(time.perf_counter() - started)
@@ -0,0 +1,124 @@
+import asyncio
+import csv
+import io
+import json
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+PENDING_DESCRIPTION = "Description pending. Use /setdesc <index> <text> to update."
+
+
+class _Batch:
+    __slots__ = ("items", "deadline", "task")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.deadline = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+
+class UploadBatcher:
+    """
+    Collects items (admin uploads) per key and hands each group to
+    `on_flush(key, items)` once.
+
+    A group is flushed when no item has arrived for `window` seconds, or as
+    soon as it reaches `max_batch` items. Keys are whatever belongs together:
+    an album's media_group_id, or the chat for documents sent one by one.
+    """
+
+    def __init__(self, on_flush: Callable[[Hashable, List[Any]], Awaitable[None]],
+                 window: float = 1.5, max_batch: int = 500):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_batch = max_batch
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._flushing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return sum(len(b.items) for b in self._batches.values())
+
+    def add(self, key: Hashable, item: Any):
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.task = loop.create_task(self._wait(key, batch))
+        batch.items.append(item)
+        batch.deadline = loop.time() + self.window
+        if len(batch.items) >= self.max_batch:
+            del self._batches[key]
+            batch.task.cancel()
+            self._spawn(key, batch.items)
+
+    async def _wait(self, key: Hashable, batch: _Batch):
+        loop = asyncio.get_running_loop()
+        # Debounce: every new item pushes the deadline back
+        while (delay := batch.deadline - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+        await self._flush(key, batch.items)
+
+    def _spawn(self, key: Hashable, items: List[Any]):
+        task = asyncio.get_running_loop().create_task(self._flush(key, items))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, key: Hashable, items: List[Any]):
+        try:
+            await self.on_flush(key, items)
+        except Exception:
+            pass  # on_flush reports its own failures; one bad batch must not stop the rest
+
+    async def flush_all(self):
+        """Flush every pending group now (e.g. on shutdown)."""
+        batches, self._batches = self._batches, {}
+        for key, batch in batches.items():
+            batch.task.cancel()
+            self._spawn(key, batch.items)
+        if self._flushing:
+            await asyncio.gather(*list(self._flushing), return_exceptions=True)
+
+
+def parse_manifest(data: bytes, filename: str = "") -> List[Dict]:
+    """
+    Catalog entries from an /import manifest.
+
+    JSON: a list of objects, or {"items": [...]} (the files.json layout).
+    CSV: a header row with file_id and title columns; description and
+    file_unique_id are optional. Rows without a file_id are skipped.
+    Raises ValueError if the manifest can't be read.
+    """
+    text = data.decode("utf-8-sig")
+    stripped = text.lstrip()
+    if filename.lower().endswith(".json") or stripped.startswith(("[", "{")):
+        try:
+            parsed = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}") from None
+        rows = parsed.get("items") if isinstance(parsed, dict) else parsed
+        if not isinstance(rows, list):
+            raise ValueError("JSON manifest must be a list or {\"items\": [...]}")
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "file_id" not in reader.fieldnames:
+            raise ValueError("CSV manifest needs a header with a file_id column")
+        rows = list(reader)
+
+    entries = []
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        file_id = str(row.get("file_id") or "").strip()
+        if not file_id:
+            continue
+        entry = {
+            "title": str(row.get("title") or "").strip() or file_id,
+            "description": str(row.get("description") or "").strip() or PENDING_DESCRIPTION,
+            "file_id": file_id,
+        }
+        unique_id = str(row.get("file_unique_id") or "").strip()
+        if unique_id:
+            entry["file_unique_id"] = unique_id
+        entries.append(entry)
+    return entries
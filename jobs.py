@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import counter, histogram
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+JOB_WAIT_SECONDS = histogram(
+    "jobs_wait_seconds", "Time from enqueue until a worker picks the job up.", ["kind"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+JOB_RUN_SECONDS = histogram("jobs_run_seconds", "Time a worker spent on a job.", ["kind"])
+JOBS_FINISHED = counter("jobs_finished_total", "Jobs finished, by outcome.", ["kind", "outcome"])
+JOBS_RESUMED = counter("jobs_resumed_total", "Jobs interrupted by a restart and queued again.")
+
+logger = logging.getLogger(__name__)
+
+RunFn = Callable[[object, Dict], Awaitable[Optional[str]]]
+
+
+class JobQueue:
+    """
+    Durable FIFO of jobs in SQLite, worked by a bounded pool of async workers.
+
+    enqueue() commits the job before returning, so it survives a restart, and
+    jobs that were running when the process stopped are queued again by
+    start(). Keys are unique: enqueueing a key again (a redelivered update)
+    is a no-op. A job saves progress with checkpoint(), e.g. the messages it
+    has already sent; a resumed attempt reads job["progress"] to pick up
+    from there instead of repeating visible work.
+
+    run(bot, job) returns an outcome label (default "ok") or raises. A job
+    that raises, or that has been started `max_attempts` times (i.e. keeps
+    dying with the process), goes to on_give_up(bot, job) and is not retried.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id          INTEGER PRIMARY KEY AUTOINCREMENT,
+        key         TEXT NOT NULL UNIQUE,
+        kind        TEXT NOT NULL,
+        chat_id     INTEGER NOT NULL,
+        user_id     INTEGER NOT NULL,
+        payload     TEXT NOT NULL,
+        progress    TEXT NOT NULL DEFAULT '{}',
+        state       TEXT NOT NULL,
+        outcome     TEXT,
+        attempts    INTEGER NOT NULL DEFAULT 0,
+        created_at  REAL NOT NULL,
+        started_at  REAL,
+        finished_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, id);
+    """
+
+    def __init__(self, db_path: str, run: RunFn, workers: int = 4, max_attempts: int = 3,
+                 retention: float = 86400.0, on_give_up: Optional[RunFn] = None):
+        self.db_path = db_path
+        self.run = run
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.on_give_up = on_give_up
+        self.bot = None
+        self.running = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            # Autocommit: every statement is its own transaction
+            self._conn = sqlite3.connect(self.db_path, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    # ---------- Producer side ----------
+
+    def has(self, key: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM jobs WHERE key = ?", (key,)).fetchone() is not None
+
+    def depth(self) -> int:
+        """Jobs waiting for a worker."""
+        return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    def enqueue(self, key: str, kind: str, chat_id: int, user_id: int, payload: Dict,
+                progress: Optional[Dict] = None) -> Optional[int]:
+        """Persist a job and wake a worker; returns its id, or None if `key` was already queued."""
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO jobs (key, kind, chat_id, user_id, payload, progress, state, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, kind, chat_id, user_id, json.dumps(payload, ensure_ascii=False),
+             json.dumps(progress or {}, ensure_ascii=False), QUEUED, time.time()),
+        )
+        if cur.rowcount == 0:
+            return None
+        self._wakeup.set()
+        return cur.lastrowid
+
+    def checkpoint(self, job: Dict, **progress):
+        """Merge `progress` into the job's saved progress (committed before returning)."""
+        job["progress"].update(progress)
+        self.conn.execute("UPDATE jobs SET progress = ? WHERE id = ?",
+                          (json.dumps(job["progress"], ensure_ascii=False), job["id"]))
+
+    # ---------- Workers ----------
+
+    def start(self, bot):
+        self.bot = bot
+        resumed = self.conn.execute("UPDATE jobs SET state = ? WHERE state = ?", (QUEUED, RUNNING)).rowcount
+        if resumed:
+            JOBS_RESUMED.inc(resumed)
+            logger.info("Resuming %d job(s) interrupted by the last shutdown", resumed)
+        self.conn.execute("DELETE FROM jobs WHERE state IN (?, ?) AND finished_at < ?",
+                          (DONE, FAILED, time.time() - self.retention))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        """Stop the workers; jobs they were running stay RUNNING and resume on the next start()."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _claim(self) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (QUEUED,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        claimed = self.conn.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ? WHERE id = ? AND state = ?",
+            (RUNNING, now, row["id"], QUEUED),
+        ).rowcount
+        if not claimed:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["progress"] = json.loads(job["progress"])
+        job["attempts"] += 1
+        job["started_at"] = now
+        return job
+
+    def _finish(self, job: Dict, state: str, outcome: str):
+        self.conn.execute("UPDATE jobs SET state = ?, outcome = ?, finished_at = ? WHERE id = ?",
+                          (state, outcome, time.time(), job["id"]))
+        JOBS_FINISHED.labels(job["kind"], outcome).inc()
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            job = self._claim()
+            if job is None:
+                await self._wakeup.wait()
+                continue
+            # More may be waiting; let another idle worker look too
+            self._wakeup.set()
+            await self._process(job)
+
+    async def _process(self, job: Dict):
+        kind = job["kind"]
+        if job["attempts"] == 1:
+            JOB_WAIT_SECONDS.labels(kind).observe(job["started_at"] - job["created_at"])
+        started = time.perf_counter()
+        self.running += 1
+        try:
+            if job["attempts"] > self.max_attempts:
+                await self._give_up(job, "gave_up")
+                return
+            try:
+                outcome = await self.run(self.bot, job) or "ok"
+            except Exception:
+                logger.exception("Job %s (%s) failed", job["id"], kind)
+                await self._give_up(job, "error")
+                return
+            self._finish(job, DONE, outcome)
+        finally:
+            self.running -= 1
+            JOB_RUN_SECONDS.labels(kind).observe(time.perf_counter() - started)
+
+    async def _give_up(self, job: Dict, outcome: str):
+        if self.on_give_up is not None:
+            try:
+                await self.on_give_up(self.bot, job)
+            except Exception:
+                logger.exception("Reporting failed job %s", job["id"])
+        self._finish(job, FAILED, outcome)
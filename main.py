@@ -1,69 +1,134 @@
 import asyncio
-from typing import List
+import signal
+from contextlib import aclosing
+from datetime import datetime, timezone
+from typing import Dict
 
 from telegram import (
+    Chat,
+    Message,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultCachedDocument,
     InputFile,
 )
-from telegram.constants import ParseMode
+from telegram.constants import ChatAction, ParseMode
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     filters,
     ContextTypes,
 )
 from config import (
-    BOT_TOKEN, ADMIN_IDS, GROUP_CHAT_ID,
+    BOT_TOKEN, TELEGRAM_API_URL, TELEGRAM_FILE_URL, ADMIN_IDS, GROUP_CHAT_ID,
     NAV_HOME, NAV_DEEPSEEK, NAV_SETTINGS, TOP_DATA, AI_LOGO_TEXT,
-    FILES_JSON, USERS_JSON, POLLING_INTERVAL, MAX_DOC_SIZE_MB
+    FILES_JSON, USERS_JSON, POLLING_INTERVAL, MAX_DOC_SIZE_MB, USERS_FLUSH_INTERVAL,
+    STORAGE_BACKEND, SQLITE_DB, DEEPSEEK_STREAM, STREAM_EDIT_INTERVAL,
+    DEEPSEEK_CACHE_MODES, DEEPSEEK_CACHE_MAX_ENTRIES, DEEPSEEK_CACHE_TTL, DEEPSEEK_CACHE_DB,
+    CONVERSATION_TOKEN_BUDGET, CONVERSATION_MAX_SESSIONS, CONVERSATION_IDLE_TTL,
+    USER_RATE_PER_SEC, USER_RATE_BURST, GLOBAL_RATE_PER_SEC, GLOBAL_RATE_BURST, RATE_LIMIT_MAX_USERS,
+    WEBHOOK_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, PORT,
+    UPDATE_WORKERS, UPDATE_MAX_PENDING, INGEST_WINDOW, INGEST_MAX_BATCH,
+    BROADCAST_RATE, BROADCAST_MAX_RETRIES, BROADCAST_STATE,
+    MEDIA_MAX_DOWNLOAD_MB, MEDIA_MAX_DIM, MEDIA_MAX_MEGAPIXELS, MEDIA_MAX_CONCURRENCY, MEDIA_CACHE_MB,
+    METRICS_HOST, METRICS_PORT,
+    JOBS_DB, JOBS_WORKERS, JOBS_MAX_QUEUED, JOBS_MAX_ATTEMPTS, JOBS_RETENTION,
+    SHARDS, SHARD_INDEX,
+    USAGE_DIR, USAGE_DAILY_TOKENS, USAGE_MONTHLY_TOKENS, USAGE_FLUSH_INTERVAL, USAGE_SNAPSHOT_INTERVAL,
 )
 from storage import (
-    add_file, list_files, get_user, set_user, read_json, write_json
+    add_files, catalog, update_file, get_user, set_user, init_storage, open_backend, user_store
 )
-from deepseek_client import DeepseekClient
+from broadcast import Broadcaster
+from callback_router import CallbackRouter
+from deepseek_client import DeepseekClient, DeepseekBusy, DeepseekUnavailable
+from ingest import PENDING_DESCRIPTION, UploadBatcher, parse_manifest
+from jobs import JobQueue
+from media import MediaFetcher, MediaTooLarge
+from metrics import (
+    UPDATE_QUEUE_DEPTH, UPDATES_ADMITTED, UPDATES_RUNNING, MetricsServer, counter, gauge, instrument,
+    watch_loop_lag,
+)
+from conversations import ConversationStore
+from rate_limit import InFlight, RateLimiter, Superseded
+from response_cache import CompletionCache
+from scheduler import ChatOrderedProcessor, release_chat
+from shards import run_front, watch_parent
+from render import apply_font, render_chunks
+from streaming import PLACEHOLDER, StreamingReply
+from usage import UsageLedger
+from webhook import WebhookServer
 
 
 # ---------- UI Helpers ----------
 
+callbacks = CallbackRouter()
+
+# Keyboards are immutable, so static ones are built once at import and reused.
+NAV_ROW = (
+    InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
+    InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
+    InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings"),
+)
+BACK_HOME_ROW = (InlineKeyboardButton("Back", callback_data="nav_home"),)
+
+_BOTTOM_NAV = InlineKeyboardMarkup([NAV_ROW])
+_TOP_BAR = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton(TOP_DATA, callback_data="top_data"),
+    ],
+    [
+        InlineKeyboardButton(AI_LOGO_TEXT, callback_data="ai_links"),
+    ]
+])
+AI_LINKS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("ChatGPT", url="https://chat.openai.com/")],
+    [InlineKeyboardButton("Gemini", url="https://gemini.google.com/")],
+    [InlineKeyboardButton("Meta AI", url="https://www.meta.ai/")],
+    [InlineKeyboardButton("Grok", url="https://x.ai/")],
+    BACK_HOME_ROW,
+    NAV_ROW,
+])
+DEEPSEEK_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Normal", callback_data="ds_mode_normal"),
+     InlineKeyboardButton("Coder", callback_data="ds_mode_coder")],
+    BACK_HOME_ROW,
+    NAV_ROW,
+])
+SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Font: Small", callback_data="font_small"),
+     InlineKeyboardButton("Normal", callback_data="font_normal"),
+     InlineKeyboardButton("Big", callback_data="font_big"),
+     InlineKeyboardButton("Code", callback_data="font_code")],
+    [InlineKeyboardButton("Feedback", callback_data="feedback_open")],
+    BACK_HOME_ROW,
+    NAV_ROW,
+])
+POPUP_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Don’t show again", callback_data="popup_disable")],
+    [InlineKeyboardButton("Feedback", callback_data="feedback_open")]
+])
+DATA_HEADER_ROWS = [
+    (InlineKeyboardButton(TOP_DATA, callback_data="top_data"),),
+    BACK_HOME_ROW,
+]
+
 def bottom_nav():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-            InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-            InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings"),
-        ]
-    ])
+    return _BOTTOM_NAV
 
 def top_bar():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton(TOP_DATA, callback_data="top_data"),
-        ],
-        [
-            InlineKeyboardButton(AI_LOGO_TEXT, callback_data="ai_links"),
-        ]
-    ])
-
-def apply_font(text: str, font: str) -> str:
-    if font == "small":
-        return f"{text}"
-    elif font == "normal":
-        return text
-    elif font == "big":
-        return f"<b>{text}</b>"
-    elif font == "code":
-        return f"<code>{text}</code>"
-    return text
+    return _TOP_BAR
 
 # ---------- Screens ----------
 
+@callbacks.exact("nav_home")
 async def show_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(USERS_JSON, user_id)
+    user = get_user(user_id)
     text = "Welcome to your hub.\nHome | Deepseek | Setting"
     txt = apply_font(text, user["font"])
     if update.callback_query:
@@ -76,36 +141,38 @@ async def show_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
             txt, reply_markup=bottom_nav(), parse_mode=ParseMode.HTML
         )
 
-async def show_data(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0, page_size: int = 6):
-    items = list_files(FILES_JSON)
-    user_id = update.effective_user.id
-    user = get_user(USERS_JSON, user_id)
-    total = len(items)
-    start = page * page_size
-    end = min(start + page_size, total)
-    text = f"DATA: {total} files\nSelect a file to Download or see Details."
-    txt = apply_font(text, user["font"])
-
+def build_data_keyboard(page: int, page_size: int) -> InlineKeyboardMarkup:
+    files = catalog()
+    total = len(files)
     rows = []
-    for idx, item in enumerate(items[start:end], start=start):
+    for idx, item in files.page(page, page_size):
         title = item.get("title", f"File {idx+1}")
         rows.append([InlineKeyboardButton(f"{title}", callback_data=f"file_{idx}")])
 
     nav = []
     if page > 0:
         nav.append(InlineKeyboardButton("◀ Prev", callback_data=f"data_page_{page-1}"))
-    if end < total:
+    if (page + 1) * page_size < total:
         nav.append(InlineKeyboardButton("Next ▶", callback_data=f"data_page_{page+1}"))
 
     # Add top bar and bottom nav
-    keyboard_rows = [[InlineKeyboardButton(TOP_DATA, callback_data="top_data")],
-                     [InlineKeyboardButton("Back", callback_data="nav_home")]] + rows
+    keyboard_rows = DATA_HEADER_ROWS + rows
     if nav:
         keyboard_rows.append(nav)
-    keyboard_rows.append([InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-                          InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-                          InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")])
-    kb = InlineKeyboardMarkup(keyboard_rows)
+    keyboard_rows.append(NAV_ROW)
+    return InlineKeyboardMarkup(keyboard_rows)
+
+@callbacks.exact("top_data", 0)
+@callbacks.prefix("data_page_")
+async def show_data(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0, page_size: int = 6):
+    files = catalog()
+    user_id = update.effective_user.id
+    user = get_user(user_id)
+    total = len(files)
+    text = f"DATA: {total} files\nSelect a file to Download or see Details."
+    txt = apply_font(text, user["font"])
+    # Keyboards are memoized per (page, page_size) until the catalog changes
+    kb = files.cached_page(page, page_size, build_data_keyboard)
 
     if update.callback_query:
         await update.callback_query.answer()
@@ -113,67 +180,93 @@ async def show_data(update: Update, context: ContextTypes.DEFAULT_TYPE, page: in
     else:
         await update.message.reply_text(txt, reply_markup=kb, parse_mode=ParseMode.HTML)
 
+@callbacks.prefix("file_")
 async def show_file_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
-    items = list_files(FILES_JSON)
-    if index < 0 or index >= len(items):
+    item = catalog().get(index)
+    if item is None:
         await update.callback_query.answer("Invalid file.")
         return
-    item = items[index]
     title = item.get("title", f"File {index+1}")
-    desc = item.get("description", "No details provided.")
     text = f"{title}\nChoose: Download or Details."
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Download", callback_data=f"download_{index}")],
         [InlineKeyboardButton("Details", callback_data=f"details_{index}")],
         [InlineKeyboardButton("Back", callback_data="top_data")],
-        [InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-         InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-         InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")]
+        NAV_ROW,
     ])
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(text, reply_markup=kb)
 
+@callbacks.prefix("download_")
 async def download_file(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
-    items = list_files(FILES_JSON)
-    if index < 0 or index >= len(items):
+    item = catalog().get(index)
+    if item is None:
         await update.callback_query.answer("Invalid file.")
         return
-    item = items[index]
     file_id = item.get("file_id")
     title = item.get("title", f"File {index+1}")
     await update.callback_query.answer("Sending file...")
     await context.bot.send_document(chat_id=update.effective_chat.id, document=file_id, caption=title)
 
+@callbacks.prefix("details_")
 async def details_file(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
-    items = list_files(FILES_JSON)
-    if index < 0 or index >= len(items):
+    item = catalog().get(index)
+    if item is None:
         await update.callback_query.answer("Invalid file.")
         return
-    item = items[index]
     title = item.get("title", f"File {index+1}")
     desc = item.get("description", "No details provided.")
     text = f"{title}\n\nDetails:\n{desc}"
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Back", callback_data=f"file_{index}")],
-        [InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-         InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-         InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")]
+        NAV_ROW,
     ])
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(text, reply_markup=kb)
 
+# ---------- Search ----------
+
+SEARCH_LIMIT = 10
+
+async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Usage: /find <words>")
+        return
+    results = catalog().search(query, SEARCH_LIMIT)
+    if not results:
+        await update.message.reply_text(f"No files match “{query}”.", reply_markup=bottom_nav())
+        return
+    rows = [
+        [InlineKeyboardButton(item.get("title", f"File {idx+1}"), callback_data=f"file_{idx}")]
+        for idx, item in results
+    ]
+    rows.append(NAV_ROW)
+    await update.message.reply_text(
+        f"Top {len(results)} results for “{query}”:", reply_markup=InlineKeyboardMarkup(rows)
+    )
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query.query.strip()
+    if not query:
+        await update.inline_query.answer([], cache_time=5)
+        return
+    results = [
+        InlineQueryResultCachedDocument(
+            id=str(idx),
+            title=item.get("title", f"File {idx+1}"),
+            document_file_id=item["file_id"],
+            description=item.get("description", "")[:100],
+        )
+        for idx, item in catalog().search(query, SEARCH_LIMIT)
+        if item.get("file_id")
+    ]
+    await update.inline_query.answer(results, cache_time=30)
+
+@callbacks.exact("ai_links")
 async def show_ai_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Simple AI hub links; Telegram opens them externally
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("ChatGPT", url="https://chat.openai.com/")],
-        [InlineKeyboardButton("Gemini", url="https://gemini.google.com/")],
-        [InlineKeyboardButton("Meta AI", url="https://www.meta.ai/")],
-        [InlineKeyboardButton("Grok", url="https://x.ai/")],
-        [InlineKeyboardButton("Back", callback_data="nav_home")],
-        [InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-         InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-         InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")]
-    ])
+    kb = AI_LINKS_KB
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text("AI Links:", reply_markup=kb)
@@ -182,88 +275,195 @@ async def show_ai_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- Deepseek ----------
 
-deepseek = DeepseekClient()
+completion_cache = CompletionCache(
+    DEEPSEEK_CACHE_MAX_ENTRIES, DEEPSEEK_CACHE_TTL, DEEPSEEK_CACHE_DB
+) if DEEPSEEK_CACHE_MODES else None
+ledger = UsageLedger(
+    USAGE_DIR, USAGE_DAILY_TOKENS, USAGE_MONTHLY_TOKENS, USAGE_FLUSH_INTERVAL, USAGE_SNAPSHOT_INTERVAL,
+    SHARD_INDEX, SHARDS,
+)
+deepseek = DeepseekClient(cache=completion_cache, ledger=ledger)
+conversations = ConversationStore(
+    CONVERSATION_TOKEN_BUDGET, CONVERSATION_MAX_SESSIONS, CONVERSATION_IDLE_TTL
+)
+media = MediaFetcher(
+    int(MEDIA_MAX_DOWNLOAD_MB * 1024 * 1024), MEDIA_MAX_DIM, MEDIA_MAX_CONCURRENCY,
+    int(MEDIA_CACHE_MB * 1024 * 1024), max_pixels=int(MEDIA_MAX_MEGAPIXELS * 1_000_000),
+)
 
+RATE_LIMITED = counter("bot_rate_limited_total", "Messages refused by the per-user/global rate limit.")
+gauge("deepseek_in_flight", "Deepseek requests in flight.", lambda: deepseek.limiter.in_flight)
+gauge("deepseek_queued", "Deepseek requests waiting for a slot.", lambda: deepseek.limiter.waiting)
+gauge("deepseek_circuit_open", "1 while the Deepseek circuit breaker refuses calls.",
+      lambda: deepseek.breaker.state != deepseek.breaker.CLOSED)
+if completion_cache is not None:
+    gauge("deepseek_cache_entries", "Completions held in the in-memory cache.",
+          lambda: completion_cache.stats()["entries"])
+gauge("usage_ledger_users", "Users with Deepseek token usage counted this month.", lambda: len(ledger))
+
+BUSY_TEXT = "Deepseek is busy right now. Please try again in a moment."
+UNAVAILABLE_TEXT = "Deepseek isn't responding right now. Please try again in a minute."
+RATE_LIMITED_TEXT = "You're sending messages too fast. Please wait a few seconds."
+QUOTA_TEXT = {
+    "day": "You've used today's Deepseek allowance ({limit:,} tokens). It resets at midnight UTC. See /usage.",
+    "month": "You've used this month's Deepseek allowance ({limit:,} tokens). See /usage.",
+}
+NO_CONTENT_TEXT = "No content returned."
+SUPERSEDED_TEXT = "(Stopped: answering your newer message instead.)"
+QUEUED_TEXT = "Queued: {ahead} request(s) ahead of yours…"
+FAILED_TEXT = "Sorry, this request could not be completed. Please send it again."
+
+rate_limiter = RateLimiter(
+    USER_RATE_PER_SEC, USER_RATE_BURST, GLOBAL_RATE_PER_SEC, GLOBAL_RATE_BURST, RATE_LIMIT_MAX_USERS
+)
+inflight = InFlight()
+
+@callbacks.exact("nav_deepseek")
 async def show_deepseek_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Normal", callback_data="ds_mode_normal"),
-         InlineKeyboardButton("Coder", callback_data="ds_mode_coder")],
-        [InlineKeyboardButton("Back", callback_data="nav_home")],
-        [InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-         InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-         InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")]
-    ])
+    kb = DEEPSEEK_MENU_KB
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text("Deepseek mode:\nChoose Normal or Coder.", reply_markup=kb)
     else:
         await update.message.reply_text("Deepseek mode:\nChoose Normal or Coder.", reply_markup=kb)
 
+# Prompts are answered from a durable job queue: the handler posts a placeholder and
+# enqueues; a worker streams the answer into the placeholder. A restart resumes
+# unfinished jobs in the same messages instead of dropping them.
+
+def job_key(message: Message) -> str:
+    return f"{message.chat_id}:{message.message_id}"
+
+def chat_message(bot, job: Dict, message_id: int) -> Message:
+    """Stand-in for a message of a job's chat known only by id (e.g. after a restart), to reply to or edit it."""
+    chat_id = job["chat_id"]
+    # Jobs queued before the chat type was stored: a negative id is a group or channel
+    chat_type = job["payload"].get("chat_type") or (Chat.PRIVATE if chat_id > 0 else Chat.GROUP)
+    msg = Message(message_id=message_id, date=datetime.now(timezone.utc), chat=Chat(chat_id, chat_type))
+    msg.set_bot(bot)
+    return msg
+
+async def enqueue_prompt(update: Update, kind: str, payload: Dict):
+    message = update.message
+    key = job_key(message)
+    if jobs.has(key):
+        # Redelivered after a restart; the job is already queued
+        return
+    ahead = jobs.depth()
+    if ahead >= JOBS_MAX_QUEUED:
+        await message.reply_text(BUSY_TEXT)
+        return
+    placeholder = await message.reply_text(QUEUED_TEXT.format(ahead=ahead) if ahead else PLACEHOLDER)
+    payload["message_id"] = message.message_id
+    payload["chat_type"] = message.chat.type
+    jobs.enqueue(key, kind, message.chat_id, update.effective_user.id, payload,
+                 {"reply_ids": [placeholder.message_id]})
+
 async def handle_deepseek_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user = get_user(USERS_JSON, user_id)
-    mode = user.get("deepseek_mode", "normal")
-    prompt = update.message.text
-    await update.message.chat.send_action("typing")
-    content = await deepseek.chat(messages=[{"role": "user", "content": prompt}], mode=mode)
-    # Code-friendly response in coder mode (monospace)
-    if mode == "coder":
-        await update.message.reply_text(f"{content}", parse_mode=ParseMode.MARKDOWN_V2)
-    else:
-        await update.message.reply_text(content)
+    user = get_user(update.effective_user.id)
+    await enqueue_prompt(update, "text", {
+        "prompt": update.message.text, "mode": user.get("deepseek_mode", "normal"),
+    })
+
+async def handle_deepseek_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = get_user(update.effective_user.id)
+    # Largest size that still fits the download cap (Telegram sends several sizes of each photo)
+    sizes = update.message.photo
+    photo = next((p for p in reversed(sizes) if (p.file_size or 0) <= media.max_bytes), sizes[0])
+    await enqueue_prompt(update, "photo", {
+        "prompt": update.message.caption or "Describe this image.",
+        "mode": user.get("deepseek_mode", "normal"),
+        "file_id": photo.file_id, "file_unique_id": photo.file_unique_id, "file_size": photo.file_size,
+    })
+
+async def answer_prompt(bot, job: Dict, reply: StreamingReply) -> str:
+    payload = job["payload"]
+    mode = payload["mode"]
+    await bot.send_chat_action(job["chat_id"], ChatAction.TYPING)
+    if job["kind"] == "photo":
+        async def file_url():
+            return (await bot.get_file(payload["file_id"])).file_path
+
+        image = await media.image_data_url(payload["file_unique_id"], file_url, payload["file_size"])
+        return await deepseek.chat(
+            messages=[deepseek.image_message(payload["prompt"], image)], mode=mode, vision=True,
+            user_id=job["user_id"],
+        )
+    messages = conversations.context(job["user_id"], payload["prompt"])
+    if not DEEPSEEK_STREAM:
+        return await deepseek.chat(messages=messages, mode=mode, user_id=job["user_id"])
+    await reply.start()
+    # Closed right away if feeding fails, so the admission slot is freed and the usage recorded
+    async with aclosing(deepseek.stream_chat(messages=messages, mode=mode, user_id=job["user_id"])) as stream:
+        async for delta in stream:
+            await reply.feed(delta)
+    return reply.text
+
+async def run_prompt_job(bot, job: Dict) -> str:
+    payload, progress = job["payload"], job["progress"]
+    user_id, chat_id = job["user_id"], job["chat_id"]
+    font = get_user(user_id).get("font", "normal")
+    # Model Markdown (code fences included) becomes Telegram HTML in the user's font, split into messages
+    reply = StreamingReply(
+        chat_message(bot, job, payload["message_id"]), STREAM_EDIT_INTERVAL,
+        render=lambda text: render_chunks(text, font),
+        sent=[chat_message(bot, job, mid) for mid in progress.get("reply_ids", [])],
+        on_sent=lambda sent: jobs.checkpoint(job, reply_ids=[m.message_id for m in sent]),
+    )
+    content = progress.get("answer")
+    if content is None:
+        try:
+            content = await inflight.run(user_id, answer_prompt(bot, job, reply))
+        except DeepseekBusy:
+            await reply.fail(BUSY_TEXT)
+            return "busy"
+        except DeepseekUnavailable:
+            await reply.fail(UNAVAILABLE_TEXT)
+            return "unavailable"
+        except MediaTooLarge:
+            await reply.fail(f"Image too large (max {MEDIA_MAX_DOWNLOAD_MB:g} MB, {MEDIA_MAX_MEGAPIXELS:g} megapixels).")
+            return "too_large"
+        except Superseded:
+            await reply.fail(SUPERSEDED_TEXT)
+            return "superseded"
+        # Saved before delivery: a restart from here re-lays out this answer instead of asking again
+        jobs.checkpoint(job, answer=content)
+    await reply.finish(NO_CONTENT_TEXT, text=content)
+    if content and job["kind"] == "text":
+        conversations.record(user_id, payload["prompt"], content)
 
     # After chat: popup (if enabled)
-    if user.get("feedback_popup", True):
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Don’t show again", callback_data="popup_disable")],
-            [InlineKeyboardButton("Feedback", callback_data="feedback_open")]
-        ])
-        await update.message.reply_text("How do you feel with this bot?", reply_markup=kb)
+    if get_user(user_id).get("feedback_popup", True) and not progress.get("popup"):
+        await bot.send_message(chat_id, "How do you feel with this bot?", reply_markup=POPUP_KB)
+        jobs.checkpoint(job, popup=True)
+    return "ok"
+
+async def give_up_prompt(bot, job: Dict):
+    reply_ids = job["progress"].get("reply_ids")
+    if reply_ids:
+        await chat_message(bot, job, reply_ids[0]).edit_text(FAILED_TEXT)
+    else:
+        await bot.send_message(job["chat_id"], FAILED_TEXT)
 
-async def handle_deepseek_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user = get_user(USERS_JSON, user_id)
-    mode = user.get("deepseek_mode", "normal")
-
-    photo = update.message.photo[-1]  # highest resolution
-    file = await context.bot.get_file(photo.file_id)
-    # For simplicity, send the URL as a hint; production: download file and send bytes to API if supported
-    prompt = update.message.caption or "Describe this image."
-    content = await deepseek.chat(messages=[
-        {"role": "user", "content": f"User prompt: {prompt}\nImage file_id: {photo.file_id}"}
-    ], mode=mode)
-    await update.message.reply_text(content)
-
-    if user.get("feedback_popup", True):
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Don’t show again", callback_data="popup_disable")],
-            [InlineKeyboardButton("Feedback", callback_data="feedback_open")]
-        ])
-        await update.message.reply_text("How do you feel with this bot?", reply_markup=kb)
+jobs = JobQueue(JOBS_DB, run_prompt_job, JOBS_WORKERS, JOBS_MAX_ATTEMPTS, JOBS_RETENTION, give_up_prompt)
+gauge("jobs_queued", "Deepseek prompts waiting for a worker.", lambda: jobs.depth())
+gauge("jobs_running", "Deepseek prompts being answered.", lambda: jobs.running)
 
 # ---------- Settings ----------
 
+@callbacks.exact("nav_settings")
 async def show_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(USERS_JSON, user_id)
+    user = get_user(user_id)
     txt = f"Settings\nFont: {user['font']}\nFeedback popup: {'on' if user['feedback_popup'] else 'off'}"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Font: Small", callback_data="font_small"),
-         InlineKeyboardButton("Normal", callback_data="font_normal"),
-         InlineKeyboardButton("Big", callback_data="font_big"),
-         InlineKeyboardButton("Code", callback_data="font_code")],
-        [InlineKeyboardButton("Feedback", callback_data="feedback_open")],
-        [InlineKeyboardButton("Back", callback_data="nav_home")],
-        [InlineKeyboardButton(NAV_HOME, callback_data="nav_home"),
-         InlineKeyboardButton(NAV_DEEPSEEK, callback_data="nav_deepseek"),
-         InlineKeyboardButton(NAV_SETTINGS, callback_data="nav_settings")]
-    ])
+    kb = SETTINGS_KB
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text(txt, reply_markup=kb)
     else:
         await update.message.reply_text(txt, reply_markup=kb)
 
+@callbacks.exact("feedback_open")
 async def feedback_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     await update.callback_query.edit_message_text(
@@ -284,23 +484,133 @@ async def handle_feedback_message(update: Update, context: ContextTypes.DEFAULT_
 
 # ---------- Admin: file upload ----------
 
+async def commit_uploads(key, items):
+    """Index one batch of uploads with a single catalog write and reply once."""
+    entries = [entry for entry, _ in items]
+    message = items[0][1]
+    try:
+        added, skipped = await add_files(entries)
+    except Exception:
+        await message.reply_text(f"Indexing failed for {len(entries)} file(s). Please resend them.")
+        raise
+    if len(entries) == 1 and added:
+        text = f"Uploaded and indexed: {entries[0]['title']}\nUsers can find it in DATA."
+    elif added:
+        text = f"Uploaded and indexed {len(added)} file(s)"
+        # Other shard workers may add files in between, so the indexes need not be contiguous
+        text += f" as DATA {', '.join(map(str, added))}." if len(added) <= 20 else "."
+        if skipped:
+            text += f"\nSkipped {skipped} already in DATA."
+        text += "\nUsers can find them in DATA."
+    else:
+        text = f"Nothing new: {skipped} file(s) already in DATA."
+    await message.reply_text(text)
+
+uploads = UploadBatcher(commit_uploads, INGEST_WINDOW, INGEST_MAX_BATCH)
+
+async def import_manifest(message, doc):
+    tg_file = await doc.get_file()
+    data = await tg_file.download_as_bytearray()
+    try:
+        entries = parse_manifest(bytes(data), doc.file_name or "")
+    except (ValueError, UnicodeDecodeError) as e:
+        await message.reply_text(f"Can't read manifest: {e}")
+        return
+    if not entries:
+        await message.reply_text("Manifest has no rows with a file_id.")
+        return
+    added, skipped = await add_files(entries)
+    await message.reply_text(f"Imported {len(added)} file(s); skipped {skipped} already in DATA.")
+
 async def handle_document_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
-    doc = update.message.document
+    message = update.message
+    doc = message.document
+    caption = (message.caption or "").split()
+    if caption and caption[0].split("@")[0] == "/import":
+        await import_manifest(message, doc)
+        return
     size_mb = (doc.file_size or 0) / (1024 * 1024)
     if size_mb > MAX_DOC_SIZE_MB:
-        await update.message.reply_text(f"File too large ({size_mb:.1f} MB). Max {MAX_DOC_SIZE_MB} MB.")
+        await message.reply_text(f"File too large ({size_mb:.1f} MB). Max {MAX_DOC_SIZE_MB} MB.")
         return
 
-    title = doc.file_name
     # Optional: description can be provided by replying with /setdesc
-    add_file(FILES_JSON, {
-        "title": title,
-        "description": "Description pending. Use /setdesc <index> <text> to update.",
-        "file_id": doc.file_id
-    })
-    await update.message.reply_text(f"Uploaded and indexed: {title}\nUsers can find it in DATA.")
+    entry = {
+        "title": doc.file_name,
+        "description": PENDING_DESCRIPTION,
+        "file_id": doc.file_id,
+        "file_unique_id": doc.file_unique_id,
+    }
+    # An album arrives as separate updates sharing a media_group_id; loose documents batch per chat
+    key = ("album", message.media_group_id) if message.media_group_id else ("chat", message.chat_id)
+    uploads.add(key, (entry, message))
+
+async def import_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    message = update.message
+    reply = message.reply_to_message
+    if reply is None or reply.document is None:
+        await message.reply_text(
+            "Usage: reply /import to a CSV or JSON manifest, or send the manifest with caption /import.\n"
+            "Columns: file_id, title, description (file_unique_id optional)."
+        )
+        return
+    await import_manifest(message, reply.document)
+
+broadcaster = Broadcaster(BROADCAST_STATE, BROADCAST_RATE, BROADCAST_MAX_RETRIES)
+
+def mark_inactive(user_id: int):
+    # Blocked the bot or deleted the account: skipped by later broadcasts until they /start again
+    set_user(user_id, "active", False)
+
+async def save_inactive():
+    await user_store().flush()
+
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    message = update.message
+    arg = context.args[0].lower() if context.args else ""
+    if arg in ("status", "cancel") and len(context.args) == 1:
+        if arg == "cancel" and not broadcaster.cancel():
+            await message.reply_text("No broadcast is running.")
+            return
+        st = broadcaster.status()
+        if st is None:
+            await message.reply_text("No broadcast yet.")
+            return
+        await message.reply_text(
+            f"Broadcast {st['state']}: {st['position']}/{st['total']} processed, "
+            f"sent {st['sent']}, blocked {st['blocked']}, failed {st['failed']}."
+        )
+        return
+    if broadcaster.running:
+        await message.reply_text("A broadcast is already running. /broadcast status | /broadcast cancel")
+        return
+    if message.reply_to_message is not None:
+        payload = {"from_chat_id": message.chat_id, "message_id": message.reply_to_message.message_id}
+    else:
+        parts = message.text.split(None, 1)
+        if len(parts) < 2:
+            await message.reply_text(
+                "Usage: /broadcast <text>, or reply /broadcast to the message to send.\n"
+                "/broadcast status | /broadcast cancel"
+            )
+            return
+        payload = {"text": parts[1]}
+    store = user_store()
+    # Sharded: include users that other workers have seen since this one started
+    await store.refresh()
+    recipients = [uid for uid in store.ids() if store.get(uid).get("active", True)]
+    broadcaster.start(context.bot, payload, recipients, notify_chat=message.chat_id,
+                      on_blocked=mark_inactive, save_blocked=save_inactive)
+    await message.reply_text(
+        f"Broadcasting to {len(recipients)} users (~{len(recipients) / BROADCAST_RATE:.0f}s). "
+        "You'll get a summary when it's done."
+    )
 
 async def set_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
@@ -310,68 +620,44 @@ async def set_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /setdesc <index> <description>")
         return
     idx = int(args[0])
-    items = list_files(FILES_JSON)
-    if idx < 0 or idx >= len(items):
+    desc = " ".join(args[1:])
+    if not update_file(idx, {"description": desc}):
         await update.message.reply_text("Invalid index.")
         return
-    desc = " ".join(args[1:])
-    items[idx]["description"] = desc
-    write_json(FILES_JSON, {"items": items})
     await update.message.reply_text(f"Updated description for file {idx}.")
 
 # ---------- Callbacks ----------
 
+@callbacks.exact("ds_mode_normal", "normal")
+@callbacks.exact("ds_mode_coder", "coder")
+async def set_deepseek_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str):
+    set_user(update.effective_user.id, "deepseek_mode", mode)
+    await update.callback_query.answer(f"Mode set: {mode}")
+    await update.callback_query.edit_message_text(f"Deepseek mode is now {mode}. Send a message.", reply_markup=bottom_nav())
+
+@callbacks.exact("font_small", "small")
+@callbacks.exact("font_normal", "normal")
+@callbacks.exact("font_big", "big")
+@callbacks.exact("font_code", "code")
+async def set_font(update: Update, context: ContextTypes.DEFAULT_TYPE, font: str):
+    set_user(update.effective_user.id, "font", font)
+    await show_settings(update, context)
+
+@callbacks.exact("popup_disable")
+async def disable_popup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_user(update.effective_user.id, "feedback_popup", False)
+    await update.callback_query.answer("Popup disabled.")
+
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = update.callback_query.data
-
-    if data == "nav_home":
-        await show_home(update, context)
-    elif data == "nav_deepseek":
-        await show_deepseek_menu(update, context)
-    elif data == "nav_settings":
-        await show_settings(update, context)
-    elif data == "top_data":
-        await show_data(update, context, page=0)
-    elif data.startswith("data_page_"):
-        page = int(data.split("_")[-1])
-        await show_data(update, context, page=page)
-    elif data.startswith("file_"):
-        idx = int(data.split("_")[-1])
-        await show_file_actions(update, context, idx)
-    elif data.startswith("download_"):
-        idx = int(data.split("_")[-1])
-        await download_file(update, context, idx)
-    elif data.startswith("details_"):
-        idx = int(data.split("_")[-1])
-        await details_file(update, context, idx)
-    elif data == "ai_links":
-        await show_ai_links(update, context)
-    elif data in ("ds_mode_normal", "ds_mode_coder"):
-        mode = "normal" if data.endswith("normal") else "coder"
-        set_user(USERS_JSON, update.effective_user.id, "deepseek_mode", mode)
-        await update.callback_query.answer(f"Mode set: {mode}")
-        await update.callback_query.edit_message_text(f"Deepseek mode is now {mode}. Send a message.", reply_markup=bottom_nav())
-    elif data == "font_small":
-        set_user(USERS_JSON, update.effective_user.id, "font", "small")
-        await show_settings(update, context)
-    elif data == "font_normal":
-        set_user(USERS_JSON, update.effective_user.id, "font", "normal")
-        await show_settings(update, context)
-    elif data == "font_big":
-        set_user(USERS_JSON, update.effective_user.id, "font", "big")
-        await show_settings(update, context)
-    elif data == "font_code":
-        set_user(USERS_JSON, update.effective_user.id, "font", "code")
-        await show_settings(update, context)
-    elif data == "feedback_open":
-        await feedback_open(update, context)
-    elif data == "popup_disable":
-        set_user(USERS_JSON, update.effective_user.id, "feedback_popup", False)
-        await update.callback_query.answer("Popup disabled.")
+    if not await callbacks.dispatch(update, context):
+        # Stale or unknown button: just stop the loading spinner
+        await update.callback_query.answer()
 
 # ---------- Commands ----------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if get_user(update.effective_user.id).get("active") is False:
+        set_user(update.effective_user.id, "active", True)
     await show_home(update, context)
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -381,9 +667,15 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/data - DATA\n"
         "/deepseek - Deepseek\n"
         "/settings - Settings\n"
+        "/find <words> - Search DATA (also inline: @bot <words>)\n"
+        "/reset - Forget the Deepseek conversation\n"
+        "/usage - Deepseek tokens used today and this month\n"
         "Admin:\n"
-        "Upload file by sending as document.\n"
-        "/setdesc <index> <text> - set file description."
+        "Upload file by sending as document (albums and bursts are indexed together).\n"
+        "/import - reply to a CSV/JSON manifest to add files in bulk.\n"
+        "/broadcast <text> - message every user (or reply to a message); status | cancel.\n"
+        "/setdesc <index> <text> - set file description.\n"
+        "/usage top [n] - heaviest Deepseek users this month."
     )
 
 async def data_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -395,48 +687,185 @@ async def deepseek_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_settings(update, context)
 
+async def reset_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversations.reset(update.effective_user.id)
+    await update.message.reply_text("Conversation cleared. Deepseek starts fresh.")
+
+def limit_text(used: int, limit: int) -> str:
+    return f"{used:,} of {limit:,}" if limit else f"{used:,} (no limit)"
+
+async def usage_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    args = context.args
+    if args and args[0].lower() == "top" and user_id in ADMIN_IDS:
+        n = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+        top, total = ledger.report(n)
+        if not top:
+            await update.message.reply_text("No Deepseek usage this month yet.")
+            return
+        lines = [f"Top {len(top)} users this month ({total:,} tokens in total):"]
+        for uid, prompt, completion, calls in top:
+            lines.append(f"{uid}: {prompt + completion:,} tokens ({prompt:,} in, {completion:,} out, {calls} calls)")
+        await update.message.reply_text("\n".join(lines))
+        return
+    u = ledger.usage(user_id)
+    await update.message.reply_text(
+        "Deepseek tokens used\n"
+        f"Today (UTC): {limit_text(u['today'], u['daily_limit'])}\n"
+        f"This month: {limit_text(u['month'], u['monthly_limit'])}\n"
+        f"({u['prompt']:,} in, {u['completion']:,} out, {u['calls']} requests)"
+    )
+
 # ---------- Router ----------
 
 def is_in_deepseek_mode(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
     # If user has selected deepseek mode, any text/photo is treated as deepseek prompt
-    user = get_user(USERS_JSON, user_id)
+    user = get_user(user_id)
     # We’ll assume: after choosing mode, user messages go to deepseek until they press Home
     return user.get("deepseek_mode") in ("normal", "coder")
 
+async def refuse_over_quota(update: Update, user_id: int) -> bool:
+    """Reply and return True if the user has used up a token quota (admins never do)."""
+    period = None if user_id in ADMIN_IDS else ledger.over_quota(user_id)
+    if period is None:
+        return False
+    limit = USAGE_DAILY_TOKENS if period == "day" else USAGE_MONTHLY_TOKENS
+    await update.message.reply_text(QUOTA_TEXT[period].format(limit=limit))
+    return True
+
 async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if context.user_data.get("awaiting_feedback"):
         await handle_feedback_message(update, context)
         return
+    if not rate_limiter.allow(user_id):
+        RATE_LIMITED.inc()
+        await update.message.reply_text(RATE_LIMITED_TEXT)
+        return
+    if await refuse_over_quota(update, user_id):
+        return
+    # The chat's next message may start (and supersede this one) while Deepseek answers
+    release_chat()
     # If user is on deepseek, route text to deepseek
     await handle_deepseek_text(update, context)
 
 async def photo_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    if not rate_limiter.allow(user_id):
+        RATE_LIMITED.inc()
+        await update.message.reply_text(RATE_LIMITED_TEXT)
+        return
+    if await refuse_over_quota(update, user_id):
+        return
+    release_chat()
     await handle_deepseek_photo(update, context)
 
 # ---------- Main ----------
 
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("data", data_cmd))
-    app.add_handler(CommandHandler("deepseek", deepseek_cmd))
-    app.add_handler(CommandHandler("settings", settings_cmd))
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_handler(MessageHandler(filters.Document.ALL, handle_document_upload))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
-    app.add_handler(MessageHandler(filters.PHOTO, photo_router))
+    builder = ApplicationBuilder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL)
+    if UPDATE_WORKERS > 1:
+        # Different chats in parallel, each chat's updates in order
+        builder = builder.concurrent_updates(ChatOrderedProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING))
+    app = builder.build()
+
+    commands = {
+        "start": start, "help": help_cmd, "data": data_cmd, "deepseek": deepseek_cmd,
+        "settings": settings_cmd, "reset": reset_cmd, "setdesc": set_description,
+        "import": import_cmd, "broadcast": broadcast_cmd, "find": find_cmd, "usage": usage_cmd,
+    }
+    for name, fn in commands.items():
+        app.add_handler(CommandHandler(name, instrument(f"/{name}", fn)))
+    # Every handler is timed (bot_handler_seconds); callbacks also per route (bot_callback_seconds)
+    app.add_handler(InlineQueryHandler(instrument("inline", inline_search)))
+    app.add_handler(CallbackQueryHandler(instrument("callback", on_callback)))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrument("document", handle_document_upload)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("text", text_router)))
+    app.add_handler(MessageHandler(filters.PHOTO, instrument("photo", photo_router)))
+
+    UPDATE_QUEUE_DEPTH.set_function(app.update_queue.qsize)
+    if isinstance(app.update_processor, ChatOrderedProcessor):
+        UPDATES_ADMITTED.set_function(lambda: app.update_processor.admitted)
+        UPDATES_RUNNING.set_function(lambda: app.update_processor.running)
     return app
 
 async def main():
+    # Shard workers share data/ with each other
+    shared = SHARDS > 1
+    backend = open_backend(STORAGE_BACKEND, USERS_JSON, FILES_JSON, SQLITE_DB, shared)
+    users = init_storage(backend, USERS_FLUSH_INTERVAL, shared)
     app = build_app()
     await app.initialize()
     await app.start()
-    # Long-polling
-    await app.run_polling(poll_interval=POLLING_INTERVAL)
+    users.start()
+    # Per-user token counters: last snapshot plus the ledger written since
+    ledger.start()
+    broadcaster.resume(app.bot, on_blocked=mark_inactive, save_blocked=save_inactive)
+    # Prompts left unanswered by the last run are picked up again
+    jobs.start(app.bot)
+    lag_watcher = asyncio.create_task(watch_loop_lag())
+    stop = asyncio.Event()
+    # Render and most supervisors stop services with SIGTERM; either signal runs the cleanup below
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    # A shard worker stops with its front process
+    parent_watcher = asyncio.create_task(watch_parent(stop)) if SHARD_INDEX >= 0 else None
+    server = None
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    try:
+        if metrics_server is not None:
+            await metrics_server.start()
+        if WEBHOOK_MODE:
+            processor = app.update_processor
+            server = WebhookServer(
+                app, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, PORT,
+                processor=processor if isinstance(processor, ChatOrderedProcessor) else None,
+            )
+            await server.start()
+            if WEBHOOK_URL:
+                await app.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+        else:
+            # Long-polling
+            await app.updater.start_polling(poll_interval=POLLING_INTERVAL)
+        await stop.wait()
+    finally:
+        lag_watcher.cancel()
+        if parent_watcher is not None:
+            parent_watcher.cancel()
+        if server is not None:
+            await server.stop()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        # Checkpointed; an unfinished broadcast resumes on the next start
+        await broadcaster.close()
+        # Jobs still running stay in the queue and resume on the next start
+        await jobs.close()
+        # After the jobs: nothing records usage any more, so the snapshot is complete
+        await ledger.close()
+        await app.stop()
+        # Commit uploads still waiting for their batch window while the bot can still reply
+        await uploads.flush_all()
+        await app.shutdown()
+        # Write back any settings changed since the last write-behind tick
+        await users.close()
+        await deepseek.aclose()
+        await media.aclose()
+        if completion_cache is not None:
+            completion_cache.close()
+        backend.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if SHARDS > 1 and SHARD_INDEX < 0:
+        # Front process: receives updates and routes each chat to one of SHARDS workers.
+        # Storage is created (and migrated) once here, before the workers open it together.
+        open_backend(STORAGE_BACKEND, USERS_JSON, FILES_JSON, SQLITE_DB, shared=True).close()
+        asyncio.run(run_front())
+    else:
+        asyncio.run(main())
\ No newline at end of file
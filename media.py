@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import io
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import httpx
+
+from metrics import UPSTREAM_SECONDS, counter
+
+DOWNLOAD_BYTES = counter("media_download_bytes_total", "Bytes downloaded for photo prompts.")
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+
+class MediaTooLarge(Exception):
+    """
+    The file is over the download cap (nothing beyond the cap was read), or
+    its bitmap would be over the pixel cap (nothing was decoded).
+    """
+
+
+def prepare_image(data: bytes, max_dim: int, quality: int = 85, max_pixels: int = 25_000_000) -> bytes:
+    """
+    Downscale so the longer side is at most max_dim and re-encode as JPEG.
+    JPEGs are decoded at reduced scale (draft mode), so a large photo never
+    needs its full-size bitmap in memory. Other formats are decoded at full
+    size, so an image whose bitmap would be over max_pixels is rejected from
+    its header alone: a few MB of PNG can claim a bitmap of many GB. Without
+    Pillow, the bytes are passed through (Telegram photos are already JPEG).
+    """
+    if not PIL_AVAILABLE:
+        return data
+    try:
+        img = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        # Pillow's own check, far above max_pixels
+        raise MediaTooLarge() from None
+    with img:
+        if img.format == "JPEG" and max(img.size) <= max_dim:
+            return data
+        img.draft("RGB", (max_dim, max_dim))
+        # After draft() the size is what will actually be decoded
+        if img.width * img.height > max_pixels:
+            raise MediaTooLarge()
+        img = img.convert("RGB")
+        img.thumbnail((max_dim, max_dim))
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+class MediaFetcher:
+    """
+    Downloads Telegram files into memory for model input.
+
+    One shared httpx client; at most `max_concurrency` files are downloaded
+    and processed at once, and each download is streamed and aborted as soon
+    as it exceeds `max_bytes`; images whose bitmap would exceed `max_pixels`
+    are rejected before decoding. So memory in use is bounded by roughly
+    max_concurrency * (max_bytes + max_pixels bitmap) plus the cache.
+
+    Prepared images are kept as data URLs in an LRU keyed by file_unique_id
+    (the same for every repost of the same image) and capped at
+    `cache_bytes`; concurrent requests for one image share a single download,
+    which runs as its own task: a requester that gives up (e.g. its prompt was
+    superseded) leaves it running for the others.
+    """
+
+    def __init__(self, max_bytes: int, max_dim: int = 1024, max_concurrency: int = 4,
+                 cache_bytes: int = 32 * 1024 * 1024, timeout: float = 30.0,
+                 max_pixels: int = 25_000_000):
+        self.max_bytes = max_bytes
+        self.max_dim = max_dim
+        self.max_pixels = max_pixels
+        self.max_concurrency = max_concurrency
+        self.cache_bytes = cache_bytes
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cached_size = 0
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        # Measurements
+        self.downloads = 0
+        self.hits = 0
+        self.bytes_downloaded = 0
+        self.buffered = 0        # bytes held by downloads in progress right now
+        self.peak_buffered = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+        return self._client
+
+    async def aclose(self):
+        for task in list(self._pending.values()):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict:
+        return {
+            "downloads": self.downloads,
+            "hits": self.hits,
+            "bytes_downloaded": self.bytes_downloaded,
+            "buffered": self.buffered,
+            "peak_buffered": self.peak_buffered,
+            "cached_images": len(self._cache),
+            "cached_bytes": self._cached_size,
+        }
+
+    async def download(self, url: str, size_hint: Optional[int] = None) -> bytes:
+        if size_hint and size_hint > self.max_bytes:
+            raise MediaTooLarge()
+        buf = bytearray()
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self.client.stream("GET", url) as r:
+                status = str(r.status_code)
+                r.raise_for_status()
+                length = int(r.headers.get("content-length") or 0)
+                if length > self.max_bytes:
+                    raise MediaTooLarge()
+                async for chunk in r.aiter_bytes():
+                    if len(buf) + len(chunk) > self.max_bytes:
+                        raise MediaTooLarge()
+                    buf += chunk
+                    self.buffered += len(chunk)
+                    self.peak_buffered = max(self.peak_buffered, self.buffered)
+        except MediaTooLarge:
+            status = "too_large"
+            raise
+        finally:
+            self.buffered -= len(buf)
+            UPSTREAM_SECONDS.labels("telegram_file", status).observe(time.perf_counter() - started)
+        DOWNLOAD_BYTES.inc(len(buf))
+        self.downloads += 1
+        self.bytes_downloaded += len(buf)
+        return bytes(buf)
+
+    def _remember(self, key: str, data_url: str):
+        if len(data_url) > self.cache_bytes:
+            return
+        self._cache[key] = data_url
+        self._cached_size += len(data_url)
+        while self._cached_size > self.cache_bytes:
+            _, old = self._cache.popitem(last=False)
+            self._cached_size -= len(old)
+
+    async def image_data_url(self, unique_id: str, get_url, size_hint: Optional[int] = None) -> str:
+        """
+        data:image/jpeg;base64,... for the image, downscaled to max_dim.
+        `get_url` is an async callable returning the download URL; it is only
+        called on a cache miss (it costs a getFile round trip).
+        """
+        cached = self._cache.get(unique_id)
+        if cached is not None:
+            self._cache.move_to_end(unique_id)
+            self.hits += 1
+            return cached
+        pending = self._pending.get(unique_id)
+        if pending is not None:
+            self.hits += 1
+        else:
+            pending = self._pending[unique_id] = asyncio.get_running_loop().create_task(
+                self._fetch(unique_id, get_url, size_hint))
+            # Mark the outcome retrieved: if every requester gave up it would be logged
+            pending.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # Shielded: cancelling one requester must not cancel the download the others wait on
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, unique_id: str, get_url, size_hint: Optional[int]) -> str:
+        try:
+            async with self._sem:
+                raw = await self.download(await get_url(), size_hint)
+                jpeg = await asyncio.to_thread(prepare_image, raw, self.max_dim, max_pixels=self.max_pixels)
+                del raw
+            data_url = "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii")
+            self._remember(unique_id, data_url)
+            return data_url
+        finally:
+            del self._pending[unique_id]
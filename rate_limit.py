@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Dict, Optional
+
+
+class TokenBucket:
+    """Classic token bucket, refilled lazily on each check (O(1))."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def has_token(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    Per-user buckets plus one global bucket.
+    User buckets live in an LRU capped at `max_users`; a bucket that has been
+    idle long enough to refill completely is indistinguishable from a new one,
+    so dropping it loses nothing.
+    """
+
+    def __init__(self, user_rate: float, user_burst: float,
+                 global_rate: float, global_burst: float, max_users: int = 10000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._users: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._full_after = user_burst / user_rate if user_rate > 0 else float("inf")
+
+    def _evict(self, now: float):
+        while self._users:
+            bucket = next(iter(self._users.values()))
+            if len(self._users) > self.max_users or now - bucket.updated >= self._full_after:
+                self._users.popitem(last=False)
+            else:
+                break
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        self._users.move_to_end(user_id)
+        self._evict(now)
+        # Only spend the user's token if the global bucket also admits the request
+        if not bucket.has_token(now):
+            return False
+        if not self.global_bucket.take(now):
+            return False
+        return bucket.take(now)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+class Superseded(Exception):
+    """The user's request was replaced by a newer one before it finished."""
+
+
+class InFlight:
+    """
+    At most one upstream request per user. Starting a new one cancels the
+    previous request, whose caller gets Superseded instead of a reply.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def busy(self, user_id: int) -> bool:
+        task = self._tasks.get(user_id)
+        return task is not None and not task.done()
+
+    async def run(self, user_id: int, work: Awaitable[Any]) -> Any:
+        previous = self._tasks.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.ensure_future(work)
+        self._tasks[user_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Cancelled by a newer request (not by our own caller being cancelled)
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise Superseded()
+            raise
+        finally:
+            if self._tasks.get(user_id) is task:
+                del self._tasks[user_id]
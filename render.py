@@ -0,0 +1,271 @@
+import html
+import re
+from typing import Iterator, List, Optional, Tuple
+
+TG_MESSAGE_LIMIT = 4096
+
+# Characters that may start inline markup; everything between them is copied through escaped
+_SPECIAL_RE = re.compile(r"[\\`*_~\[]")
+# Bounded so a line full of unmatched "[" stays linear
+_LINK_RE = re.compile(r"\[([^\[\]\n]{1,300})\]\(((?:https?://|tg://|mailto:)[^()\s]{1,2048})\)")
+_BULLET_RE = re.compile(r"(\s*)[-*+]\s+")
+_TAG_RE = re.compile(r"<[^>]*>")
+_ENTITY_RE = re.compile(r"&(?:amp|lt|gt|quot|#x27);")
+
+_STYLE_TAGS = {"**": "b", "__": "b", "*": "i", "_": "i", "~~": "s"}
+_ESCAPABLE = set("\\`*_~[]()#+-.!>|{}")
+
+
+def escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def visible_len(html_text: str) -> int:
+    """Length Telegram counts against the message limit: tags dropped, entities as one character."""
+    return len(_ENTITY_RE.sub("&", _TAG_RE.sub("", html_text)))
+
+
+def to_plain(html_text: str) -> str:
+    return html.unescape(_TAG_RE.sub("", html_text))
+
+
+def apply_font(text: str, font: str) -> str:
+    """Plain text as Telegram HTML in the user's font (small | normal | big | code)."""
+    text = escape(text)
+    if font == "big":
+        return f"<b>{text}</b>"
+    if font == "code":
+        return f"<code>{text}</code>"
+    return text
+
+
+def _closing_run(line: str, run: str, start: int) -> int:
+    """Start of the next backtick run exactly as long as `run`, or -1."""
+    while True:
+        end = line.find(run, start)
+        if end == -1:
+            return -1
+        after = end + len(run)
+        if after >= len(line) or line[after] != "`":
+            return end
+        while after < len(line) and line[after] == "`":
+            after += 1
+        start = after
+
+
+def render_inline(line: str) -> str:
+    """
+    One line of model Markdown as Telegram HTML: `code`, **bold**, __bold__,
+    *italic*, _italic_, ~~strike~~, [text](url) and backslash escapes.
+
+    A single left-to-right pass. Openers are pushed on a small stack (at most
+    one per delimiter kind) and closed by the matching delimiter; openers left
+    unclosed at the end of the line, or crossed by an outer close, are turned
+    back into literal text. Tags therefore always nest properly.
+    """
+    out: List[str] = []
+    stack: List[Tuple[str, int]] = []     # (delimiter, position of its opening tag in out)
+    no_close = set()                      # backtick runs with no closer further on
+    i, n = 0, len(line)
+    while i < n:
+        m = _SPECIAL_RE.search(line, i)
+        if m is None:
+            out.append(escape(line[i:]))
+            break
+        j = m.start()
+        if j > i:
+            out.append(escape(line[i:j]))
+        ch = line[j]
+        if ch == "\\":
+            if j + 1 < n and line[j + 1] in _ESCAPABLE:
+                out.append(escape(line[j + 1]))
+                i = j + 2
+            else:
+                out.append("\\")
+                i = j + 1
+        elif ch == "`":
+            k = j
+            while k < n and line[k] == "`":
+                k += 1
+            run = line[j:k]
+            end = -1 if run in no_close else _closing_run(line, run, k)
+            if end == -1:
+                no_close.add(run)
+                out.append(run)
+                i = k
+            else:
+                code = line[k:end]
+                if len(code) > 2 and code[0] == " " and code[-1] == " ":
+                    code = code[1:-1]
+                out.append(f"<code>{escape(code)}</code>")
+                i = end + len(run)
+        elif ch == "[":
+            link = _LINK_RE.match(line, j)
+            if link is None:
+                out.append("[")
+                i = j + 1
+            else:
+                href = html.escape(link.group(2), quote=True)
+                out.append(f'<a href="{href}">{escape(link.group(1))}</a>')
+                i = link.end()
+        else:
+            k = j
+            while k < n and line[k] == ch:
+                k += 1
+            delim = line[j:k]
+            if delim not in _STYLE_TAGS:
+                out.append(escape(delim))
+                i = k
+                continue
+            prev = line[j - 1] if j > 0 else " "
+            nxt = line[k] if k < n else " "
+            can_open = not nxt.isspace()
+            can_close = not prev.isspace()
+            if ch == "_":
+                # snake_case and __dunder__ names are not emphasis
+                can_open = can_open and not prev.isalnum()
+                can_close = can_close and not nxt.isalnum()
+            open_at = next((p for p, (d, _) in enumerate(stack) if d == delim), None)
+            if open_at is not None and can_close:
+                while len(stack) > open_at + 1:
+                    inner, pos = stack.pop()
+                    out[pos] = escape(inner)
+                stack.pop()
+                out.append(f"</{_STYLE_TAGS[delim]}>")
+            elif can_open and open_at is None:
+                stack.append((delim, len(out)))
+                out.append(f"<{_STYLE_TAGS[delim]}>")
+            else:
+                out.append(escape(delim))
+            i = k
+    for delim, pos in stack:
+        out[pos] = escape(delim)
+    return "".join(out)
+
+
+def render_line(line: str, bold: bool = False) -> str:
+    """A text line with its block markup: headings, bullets and rules."""
+    stripped = line.lstrip()
+    if stripped.startswith("#"):
+        level = len(stripped) - len(stripped.lstrip("#"))
+        if level <= 6 and (len(stripped) == level or stripped[level] == " "):
+            content = stripped[level:].strip()
+            trimmed = content.rstrip("#")
+            if trimmed != content and (not trimmed or trimmed.endswith(" ")):
+                content = trimmed.rstrip()
+            return f"<b>{render_inline(content)}</b>"
+    if len(stripped) >= 3 and stripped[0] in "-*_" and set(stripped) <= {stripped[0], " "} \
+            and stripped.count(stripped[0]) >= 3:
+        return "──────────"
+    m = _BULLET_RE.match(line)
+    if m is not None:
+        rendered = escape(m.group(1)) + "• " + render_inline(line[m.end():])
+    else:
+        rendered = render_inline(line)
+    return f"<b>{rendered}</b>" if bold and rendered.strip() else rendered
+
+
+def parse_blocks(text: str) -> List[Tuple[Optional[str], List[str]]]:
+    """
+    Split Markdown into (lang, lines) blocks: lang is None for text and the
+    fence's language ("" if none) for code. An unclosed fence runs to the end.
+    """
+    blocks: List[Tuple[Optional[str], List[str]]] = []
+    lines: List[str] = []
+    fence: Optional[str] = None
+    lang: Optional[str] = None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if fence is None:
+            if stripped.startswith(("```", "~~~")):
+                if lines:
+                    blocks.append((None, lines))
+                marker = stripped[0]
+                fence = stripped[:len(stripped) - len(stripped.lstrip(marker))]
+                info = stripped[len(fence):].split()
+                lang = info[0] if info else ""
+                lines = []
+            else:
+                lines.append(line)
+        elif stripped.startswith(fence) and not stripped.lstrip(fence[0]):
+            blocks.append((lang, lines))
+            fence, lines = None, []
+        else:
+            lines.append(line)
+    if lines or fence is not None:
+        blocks.append((lang if fence is not None else None, lines))
+    return blocks
+
+
+def _split_long(line: str, limit: int, at_spaces: bool) -> Iterator[str]:
+    start = 0
+    while len(line) - start > limit:
+        cut = line.rfind(" ", start + limit // 2, start + limit) if at_spaces else -1
+        cut = cut + 1 if cut != -1 else start + limit
+        yield line[start:cut]
+        start = cut
+    yield line[start:]
+
+
+class _Packer:
+    """Packs rendered lines into messages of at most `limit` visible characters, reopening <pre> across cuts."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.chunks: List[str] = []
+        self.parts: List[str] = []
+        self.size = 0
+        self.block: Optional[int] = None   # code block whose <pre> is open in the current chunk
+
+    def _close_pre(self):
+        if self.block is not None:
+            self.parts[-1] += "</code></pre>"
+            self.block = None
+
+    def _close_chunk(self):
+        self._close_pre()
+        chunk = "\n".join(self.parts)
+        if to_plain(chunk).strip():
+            self.chunks.append(chunk)
+        self.parts, self.size = [], 0
+
+    def add(self, html_line: str, vis: int, block: Optional[int] = None, lang: str = ""):
+        if self.parts and self.size + 1 + vis > self.limit:
+            self._close_chunk()
+        if block != self.block:
+            if self.parts:
+                self._close_pre()
+            if block is not None:
+                cls = f' class="language-{html.escape(lang, quote=True)}"' if lang else ""
+                html_line = f"<pre><code{cls}>" + html_line
+                self.block = block
+        self.size += vis + (1 if self.parts else 0)
+        self.parts.append(html_line)
+
+    def finish(self) -> List[str]:
+        if self.parts:
+            self._close_chunk()
+        return self.chunks
+
+
+def render_chunks(text: str, font: str = "normal", limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """
+    Model Markdown as Telegram HTML messages, each within `limit` visible
+    characters, in order. Cuts fall between lines (a line longer than the
+    limit is cut at a space); a code block cut in two is closed and reopened
+    so every message is valid on its own. Font "code" shows everything as one
+    preformatted block, "big" bolds the text lines. Linear in len(text).
+    """
+    blocks = [("", text.split("\n"))] if font == "code" else parse_blocks(text)
+    packer = _Packer(limit)
+    for block_id, (lang, lines) in enumerate(blocks):
+        if lang is None:
+            for line in lines:
+                for part in _split_long(line, limit, at_spaces=True):
+                    rendered = render_line(part, bold=font == "big")
+                    packer.add(rendered, visible_len(rendered))
+        else:
+            for line in lines:
+                for part in _split_long(line, limit, at_spaces=False):
+                    packer.add(escape(part), len(part), block_id, lang)
+    return packer.finish()
@@ -0,0 +1,155 @@
+import asyncio
+import bisect
+import email.utils
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: attempt n waits a random time in
+    [0, min(cap, base * 2**n)]. A server's Retry-After is honoured as a
+    lower bound, unless it asks for more than `max_retry_after` (then the
+    caller should give up rather than hold the user for that long).
+    """
+
+    def __init__(self, max_attempts: int = 3, base: float = 0.5, cap: float = 8.0,
+                 max_retry_after: float = 20.0, rng: Optional[random.Random] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+        self._rng = rng or random.Random()
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """Seconds to wait before retry number `attempt` (0-based), or None to stop."""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return None
+        wait = self._rng.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        return max(wait, retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through; `failure_threshold` consecutive failures open it.
+    Open: calls are refused until `reset_timeout` has passed.
+    Half-open: one trial call is let through; success closes the breaker,
+    failure opens it again for another `reset_timeout`. A trial that never
+    reports back (e.g. cancelled) is replaced after `reset_timeout`.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.CLOSED
+        self._trial_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_at = None
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            now = time.monotonic()
+            if self._trial_at is None or now - self._trial_at >= self.reset_timeout:
+                self._trial_at = now
+                return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._state = self.CLOSED
+        self._trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._trial_at = None
+
+
+class LatencyTracker:
+    """Recent latencies in a sliding window; percentiles from a sorted copy kept in step."""
+
+    def __init__(self, window: int = 200):
+        self._recent: deque = deque(maxlen=window)
+        self._sorted: list = []
+
+    def __len__(self) -> int:
+        return len(self._recent)
+
+    def record(self, seconds: float):
+        if len(self._recent) == self._recent.maxlen:
+            old = self._recent[0]
+            del self._sorted[bisect.bisect_left(self._sorted, old)]
+        self._recent.append(seconds)
+        bisect.insort(self._sorted, seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._sorted:
+            return None
+        return self._sorted[min(len(self._sorted) - 1, int(q * len(self._sorted)))]
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float],
+                 on_hedge: Optional[Callable[[], None]] = None) -> T:
+    """
+    Await call(); if it hasn't finished after `delay` seconds, start a second
+    call() and return whichever succeeds first, cancelling the other. If one
+    fails the other is still awaited. Only for idempotent calls.
+    """
+    if delay is None:
+        return await call()
+    tasks = [asyncio.ensure_future(call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            tasks.append(asyncio.ensure_future(call()))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from metrics import counter
+
+CACHE_HITS = counter("deepseek_cache_hits_total", "Completions served from the cache (memory or disk).")
+CACHE_DISK_HITS = counter("deepseek_cache_disk_hits_total", "Cache hits that had to be read from the disk store.")
+CACHE_MISSES = counter("deepseek_cache_misses_total", "Cache lookups that found nothing (the call goes upstream).")
+
+
+def normalize_text(text: str) -> str:
+    # Trailing spaces and surrounding blank lines never change the answer;
+    # leading indentation might (code), so it is left alone.
+    return "\n".join(line.rstrip() for line in text.strip().splitlines())
+
+
+def cache_key(payload: Dict) -> str:
+    """Hash of everything that shapes the completion: model, system prompt, messages, sampling."""
+    messages: List[Dict] = []
+    for m in payload.get("messages", []):
+        content = m.get("content")
+        if isinstance(content, str):
+            content = normalize_text(content)
+        messages.append({"role": m.get("role"), "content": content})
+    material = {
+        "model": payload.get("model"),
+        "messages": messages,
+        "temperature": payload.get("temperature"),
+        "max_tokens": payload.get("max_tokens"),
+    }
+    raw = json.dumps(material, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Size-bounded LRU of completions with a TTL, optionally backed by an
+    SQLite file so entries survive restarts. Memory is checked first; a disk
+    hit is promoted back into memory.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 86400.0, disk_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if disk_path:
+            if os.path.dirname(disk_path):
+                os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, expires REAL NOT NULL, content TEXT NOT NULL)"
+            )
+            self._db.execute("DELETE FROM completions WHERE expires < ?", (time.time(),))
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._mem.get(key)
+        if entry is not None:
+            expires, content = entry
+            if expires >= now:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                CACHE_HITS.inc()
+                return content
+            del self._mem[key]
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT expires, content FROM completions WHERE key = ? AND expires >= ?",
+                    (key, now),
+                ).fetchone()
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                CACHE_HITS.inc()
+                CACHE_DISK_HITS.inc()
+                return row[1]
+        self.misses += 1
+        CACHE_MISSES.inc()
+        return None
+
+    def put(self, key: str, content: str):
+        expires = time.time() + self.ttl
+        self._remember(key, expires, content)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions(key, expires, content) VALUES(?, ?, ?)",
+                    (key, expires, content),
+                )
+
+    def _remember(self, key: str, expires: float, content: str):
+        self._mem[key] = (expires, content)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._mem),
+        }
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
@@ -0,0 +1,95 @@
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Completion marker of the update being processed in the current task
+_lane: contextvars.ContextVar[Optional[asyncio.Future]] = contextvars.ContextVar("lane", default=None)
+
+
+def release_chat():
+    """
+    Let the chat's next update start before this handler returns.
+    For long handlers whose result doesn't need ordering, e.g. a Deepseek
+    reply that a newer message is allowed to supersede.
+    """
+    done = _lane.get()
+    if done is not None and not done.done():
+        done.set_result(None)
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Concurrent update processing that keeps each chat's updates in order.
+
+    Up to `workers` updates run at once, but never two from the same chat:
+    an update waits for the previous update of its chat before taking a
+    worker slot. Updates without a chat (e.g. inline queries) are keyed by
+    user. At most `max_pending` updates are admitted at a time; the rest
+    wait in arrival order, and wait_for_capacity() lets producers (the
+    webhook) hold off while the backlog is full.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(workers)
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        self.admitted = 0   # inside do_process_update (waiting or running)
+        self.running = 0
+
+    @staticmethod
+    def _key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def wait_for_capacity(self):
+        while self.admitted >= self.max_pending:
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        self.admitted += 1
+        started = False
+        try:
+            if previous is not None:
+                # Shielded so our own cancellation doesn't cancel the predecessor's marker
+                await asyncio.shield(previous)
+            async with self._slots:
+                self.running += 1
+                started = True
+                _lane.set(done)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+        finally:
+            if not started and asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            if not done.done():
+                done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+            self.admitted -= 1
+            if self.admitted < self.max_pending:
+                self._capacity.set()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,299 @@
+import bisect
+import heapq
+import itertools
+import math
+import operator
+import re
+from typing import Dict, List, Tuple
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+TITLE_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+MIN_PREFIX_LEN = 2
+# Query prefixes whose expansion, factors, bounds and merged postings are kept between queries
+MAX_CACHED_PREFIXES = 64
+
+
+def tokenize(text: str) -> List[str]:
+    # File names like "linear_algebra-v2.pdf" should match "linear" and "algebra"
+    return [t for t in _TOKEN_RE.findall((text or "").lower().replace("_", " ")) if t]
+
+
+class SearchIndex:
+    """
+    In-memory inverted index over catalog titles and descriptions.
+
+    term -> {doc: weight}, where title hits weigh more than description hits.
+    The vocabulary is also kept sorted so each query token can match as a
+    prefix ("algeb" finds "algebra"): the token's whole range of the sorted
+    vocabulary is searched. Documents are added or replaced one at a time;
+    nothing is ever rebuilt wholesale.
+
+    What a query prefix needs beyond the postings (its terms, their factors
+    and score bounds, their postings merged) is cached per prefix and dropped as soon as any term
+    in its range changes. Each term's highest weight is kept up to date as
+    documents come and go, so bounding a prefix never scans postings.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, float]] = {}
+        self._vocab: List[str] = []
+        self._doc_terms: Dict[int, List[str]] = {}
+        self._ranked_cache: Dict[str, List[Tuple[float, int]]] = {}
+        self._prefixes: Dict[str, Dict] = {}
+        # term -> its highest weight; missing when a removal made it stale
+        self._max_weight: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+    def add(self, doc: int, title: str, description: str = ""):
+        if doc in self._doc_terms:
+            self.remove(doc)
+        weights: Dict[str, float] = {}
+        for t in tokenize(title):
+            weights[t] = weights.get(t, 0.0) + TITLE_WEIGHT
+        for t in tokenize(description):
+            weights[t] = weights.get(t, 0.0) + DESCRIPTION_WEIGHT
+        for term, w in weights.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                bisect.insort(self._vocab, term)
+                self._max_weight[term] = w
+            elif w > self._max_weight.get(term, w):
+                self._max_weight[term] = w
+            postings[doc] = w
+            self._changed(term)
+        self._doc_terms[doc] = list(weights)
+
+    def remove(self, doc: int):
+        for term in self._doc_terms.pop(doc, []):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            if postings.pop(doc, None) == self._max_weight.get(term):
+                del self._max_weight[term]
+            self._changed(term)
+            if not postings:
+                del self._postings[term]
+                i = bisect.bisect_left(self._vocab, term)
+                if i < len(self._vocab) and self._vocab[i] == term:
+                    del self._vocab[i]
+
+    def _changed(self, term: str):
+        self._ranked_cache.pop(term, None)
+        if self._prefixes:
+            for i in range(MIN_PREFIX_LEN, len(term) + 1):
+                self._prefixes.pop(term[:i], None)
+
+    def _prefix(self, token: str) -> Dict:
+        """The cache entry of a query prefix."""
+        entry = self._prefixes.get(token)
+        if entry is None:
+            if len(self._prefixes) >= MAX_CACHED_PREFIXES:
+                self._prefixes.clear()
+            entry = self._prefixes[token] = {}
+        return entry
+
+    def _expand(self, token: str) -> List[str]:
+        """Vocabulary terms starting with token."""
+        if len(token) < MIN_PREFIX_LEN:
+            return [token] if token in self._postings else []
+        entry = self._prefix(token)
+        terms = entry.get("terms")
+        if terms is not None:
+            return terms
+        lo = bisect.bisect_left(self._vocab, token)
+        hi = bisect.bisect_left(self._vocab, token + "\U0010ffff", lo)
+        terms = entry["terms"] = self._vocab[lo:hi]
+        return terms
+
+    def _weight_bound(self, term: str) -> float:
+        """The highest weight term has in any document."""
+        w = self._max_weight.get(term)
+        if w is None:
+            w = self._max_weight[term] = max(self._postings[term].values())
+        return w
+
+    def _size(self, terms: List[str]) -> int:
+        """Postings of terms in total: at least the number of docs they match."""
+        return sum(map(len, map(self._postings.__getitem__, terms)))
+
+    def _ranked(self, term: str) -> List[Tuple[float, int]]:
+        """Postings of term as (-weight, doc), best first; cached until the term changes."""
+        ranked = self._ranked_cache.get(term)
+        if ranked is None:
+            ranked = self._ranked_cache[term] = sorted(
+                (-w, doc) for doc, w in self._postings[term].items()
+            )
+        return ranked
+
+    def _factor(self, term: str, token: str, n: int) -> float:
+        """idf of term among n docs, halved when it only matches token as a prefix."""
+        idf = math.log(1 + max(n, 1) / len(self._postings[term]))
+        return idf if term == token else idf * 0.5
+
+    def _factors(self, token: str, terms: List[str], n: int) -> Dict[str, float]:
+        """term -> factor over token's terms; cached while n stays the same."""
+        if len(terms) == 1:
+            return {terms[0]: self._factor(terms[0], token, n)}
+        entry = self._prefix(token)
+        if entry.get("n") != n:
+            entry["n"] = n
+            # _factor() inlined: long prefix ranges have thousands of terms
+            log, docs = math.log, max(n, 1)
+            factors = entry["factors"] = {
+                term: log(1 + docs / df) * 0.5
+                for term, df in zip(terms, map(len, map(self._postings.__getitem__, terms)))
+            }
+            if token in factors:
+                factors[token] *= 2
+            entry.pop("bounds", None)
+        return entry["factors"]
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """Documents matching every query token (as a word or word prefix), best first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        expansions: List[Tuple[str, List[str]]] = []
+        for token in dict.fromkeys(tokens):
+            terms = self._expand(token)
+            if not terms:
+                return []
+            expansions.append((token, terms))
+        if len(expansions) == 1:
+            return self._search_one(*expansions[0], limit)
+
+        # Several tokens: the documents matching all of them are narrowed down
+        # token by token, the one with the fewest postings first, by key-set
+        # intersections (in C, over the smaller side); only documents matching
+        # every token get scored. A prefix token after the first is only
+        # looked up for the documents still left.
+        sources = sorted(expansions, key=lambda src: self._size(src[1]))
+        matching = None
+        merged = []
+        for token, terms in sources:
+            docs = self._merged(token, terms, matching)
+            matching = docs.keys() if matching is None else docs.keys() & matching
+            if not matching:
+                return []
+            merged.append(docs)
+
+        n = len(self._doc_terms)
+        total: Dict[int, float] = {}
+        for (token, terms), docs in zip(sources, merged):
+            factors = self._factors(token, terms, n)
+            if len(terms) == 1:
+                factor = factors[terms[0]]
+                if not total:
+                    total = {doc: docs[doc] * factor for doc in matching}
+                    continue
+                for doc in matching:
+                    total[doc] += docs[doc] * factor
+                continue
+            if not total:
+                total = dict.fromkeys(matching, 0.0)
+            for doc in matching:
+                found = docs[doc]
+                if type(found) is tuple:
+                    w, term = found
+                    total[doc] += w * factors[term]
+                else:
+                    total[doc] += max(w * factors[term] for w, term in found)
+        return _top(total, limit)
+
+    def _merged(self, token: str, terms: List[str], candidates=None) -> Dict:
+        """
+        The docs matching token: a term's postings when it expands to one
+        term, otherwise doc -> (weight, term), or a list of those for docs
+        with several terms in the range.
+
+        With `candidates`, only those docs need to be there: the range is
+        merged lazily, its terms looked up (in C) only for the candidates
+        not looked up before, so a long range costs about as much as the
+        docs actually asked about.
+        """
+        if len(terms) == 1:
+            return self._postings[terms[0]]
+        entry = self._prefix(token)
+        merged = entry.get("merged")
+        if merged is None:
+            merged = entry["merged"] = {}
+        # Docs the range was looked up for; None once it is merged completely
+        seen = entry.setdefault("seen", set())
+        if seen is None:
+            return merged
+        if candidates is None:
+            entry["seen"] = None
+            todo, found = terms, [self._postings[term].items() for term in terms]
+        else:
+            new = candidates - seen
+            if not new:
+                return merged
+            seen |= new
+            postings = list(map(self._postings.__getitem__, terms))
+            keep = list(map(operator.not_, map(new.isdisjoint, postings)))
+            todo = itertools.compress(terms, keep)
+            found = [[(doc, p[doc]) for doc in p.keys() & new] for p in itertools.compress(postings, keep)]
+        for term, items in zip(todo, found):
+            for doc, w in items:
+                hit = merged.get(doc)
+                if hit is None:
+                    merged[doc] = (w, term)
+                elif type(hit) is tuple:
+                    merged[doc] = [hit, (w, term)]
+                else:
+                    hit.append((w, term))
+        return merged
+
+    def _search_one(self, token: str, terms: List[str], limit: int) -> List[Tuple[int, float]]:
+        """
+        A single token: the best `limit` docs of each matching term are enough.
+        Terms are taken by the best score they can give, stopping once none
+        left can beat the current limit-th best document (so of documents tied
+        with it, any may be the ones returned). The bounds are a heap, since
+        usually only a few of a long prefix range are ever taken.
+        """
+        factors = self._factors(token, terms, len(self._doc_terms))
+        entry = self._prefix(token) if len(terms) > 1 else {}
+        bounds = entry.get("bounds")
+        if bounds is None:
+            known = self._max_weight.get
+            bounds = [(-(known(term) or self._weight_bound(term)) * factor, term) for term, factor in factors.items()]
+            heapq.heapify(bounds)
+            if entry:
+                entry["bounds"] = bounds
+        bounds = list(bounds)
+        best: Dict[int, float] = {}
+        # The `limit` best (score, doc) so far, smallest first; one entry per doc
+        top: List[Tuple[float, int]] = []
+        while bounds:
+            neg_bound, term = heapq.heappop(bounds)
+            if len(top) == limit and -neg_bound <= top[0][0]:
+                break
+            factor = factors[term]
+            for neg_w, doc in self._ranked(term)[:limit]:
+                score = -neg_w * factor
+                old = best.get(doc, 0.0)
+                if score <= old:
+                    continue
+                best[doc] = score
+                if old and (old, doc) in top:
+                    top[top.index((old, doc))] = (score, doc)
+                    heapq.heapify(top)
+                elif len(top) < limit:
+                    heapq.heappush(top, (score, doc))
+                elif score > top[0][0]:
+                    heapq.heapreplace(top, (score, doc))
+        return _top(best, limit)
+
+
+def _top(scores: Dict[int, float], limit: int) -> List[Tuple[int, float]]:
+    """The `limit` best (doc, score), ties broken by lower doc."""
+    if len(scores) > limit:
+        cut = heapq.nlargest(limit, scores.values())[-1]
+        scores = {doc: s for doc, s in scores.items() if s >= cut}
+    return sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:limit]
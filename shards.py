@@ -0,0 +1,317 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    BOT_TOKEN, TELEGRAM_API_URL, SHARDS, SHARD_BASE_PORT, POLLING_INTERVAL,
+    WEBHOOK_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, PORT,
+    METRICS_HOST, METRICS_PORT, UPDATE_MAX_PENDING,
+)
+from metrics import MetricsServer, counter, gauge, histogram, watch_loop_lag
+from webhook import SECRET_HEADER
+
+FORWARDED = counter("shard_updates_forwarded_total", "Updates handed to each worker process.", ["shard"])
+FORWARD_SECONDS = histogram("shard_forward_seconds", "Time to hand one batch of updates to a worker.")
+FORWARD_RETRIES = counter("shard_forward_retries_total", "Batches sent again because a worker was unreachable.")
+RESTARTS = counter("shard_worker_restarts_total", "Worker processes started again after exiting.", ["shard"])
+PENDING = gauge("shard_pending_updates", "Updates routed but not yet accepted by a worker.")
+
+logger = logging.getLogger(__name__)
+
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# Path on the workers' webhook servers that the front posts to
+WORKER_PATH = "/updates"
+# Updates per POST to a worker, and how long getUpdates waits for new ones
+FORWARD_BATCH = 100
+POLL_TIMEOUT = 10
+
+
+def route_key(update: Dict) -> int:
+    """
+    Chat id of a raw update, or the user id for updates without a chat (inline
+    queries); the same key the in-process scheduler orders by. 0 if neither.
+    """
+    for field, body in update.items():
+        if field == "update_id" or not isinstance(body, dict):
+            continue
+        chat = body.get("chat") or (body.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = body.get("from") or body.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+def shard_of(update: Dict, shards: int) -> int:
+    return route_key(update) % shards
+
+
+class Shard:
+    """
+    One worker process (`python main.py` with SHARD_INDEX set) and the
+    ordered queue of updates forwarded to it. A single sender posts batches
+    in arrival order and waits for each to be accepted, so a chat's updates
+    reach its worker in order. The queue is bounded: when a worker falls
+    behind, route() blocks and the front stops fetching updates.
+    """
+
+    def __init__(self, index: int, secret: str, max_pending: int):
+        self.index = index
+        self.secret = secret
+        self.port = SHARD_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}{WORKER_PATH}"
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self.proc: Optional[subprocess.Popen] = None
+        self._forwarded = FORWARDED.labels(str(index))
+
+    def env(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        env.update({
+            "SHARD_INDEX": str(self.index),
+            # The worker serves forwarded updates on loopback and never talks to Telegram's webhook
+            "WEBHOOK_MODE": "true",
+            "WEBHOOK_URL": "",
+            "WEBHOOK_HOST": "127.0.0.1",
+            "WEBHOOK_PATH": WORKER_PATH,
+            "WEBHOOK_SECRET": self.secret,
+            "PORT": str(self.port),
+            "METRICS_PORT": str(METRICS_PORT + 1 + self.index) if METRICS_PORT else "0",
+        })
+        return env
+
+    def spawn(self):
+        # Own process group: a Ctrl-C reaches the front only, which then stops the workers in order
+        self.proc = subprocess.Popen([sys.executable, MAIN_PY], env=self.env(), start_new_session=True)
+        logger.info("Started shard %d (pid %d) on port %d", self.index, self.proc.pid, self.port)
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float = 60.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"shard {self.index} exited with {self.proc.returncode} during startup")
+            try:
+                r = await client.get(f"http://127.0.0.1:{self.port}/")
+                if r.status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"shard {self.index} did not start within {timeout:g}s")
+            await asyncio.sleep(0.1)
+
+    async def forward(self, client: httpx.AsyncClient):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < FORWARD_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self._post(client, batch)
+            self._forwarded.inc(len(batch))
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _post(self, client: httpx.AsyncClient, batch: List[Dict]):
+        body = json.dumps(batch, ensure_ascii=False).encode("utf-8")
+        headers = {SECRET_HEADER: self.secret, "Content-Type": "application/json"}
+        delay = 0.1
+        while True:
+            started = time.perf_counter()
+            try:
+                r = await client.post(self.url, content=body, headers=headers)
+            except httpx.TransportError as e:
+                # Restarting or overloaded; the batch waits (and so does this shard's queue)
+                logger.warning("Shard %d unreachable (%s); retrying in %.1fs", self.index, e, delay)
+            else:
+                FORWARD_SECONDS.observe(time.perf_counter() - started)
+                if r.status_code < 500:
+                    if r.status_code != 200:
+                        logger.error("Shard %d refused %d update(s): HTTP %d", self.index, len(batch), r.status_code)
+                    return
+                logger.warning("Shard %d answered %d; retrying in %.1fs", self.index, r.status_code, delay)
+            FORWARD_RETRIES.inc()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+    async def stop(self, timeout: float = 30.0):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        # SIGINT runs the worker's normal shutdown (checkpoints, write-behind flush)
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            await asyncio.to_thread(self.proc.wait, timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("Shard %d did not stop within %.0fs; killing it", self.index, timeout)
+            self.proc.kill()
+            await asyncio.to_thread(self.proc.wait)
+
+
+class ShardRouter:
+    """
+    Front process of sharded mode. Receives updates (long polling or
+    webhook) without parsing them into telegram objects, and routes each to
+    the worker that owns its chat: chat_id % SHARDS. Workers are supervised
+    and started again if they exit; their updates wait in the meantime.
+    """
+
+    def __init__(self, shards: int, max_pending: int):
+        self.secret = secrets.token_urlsafe(24)
+        self.shards = [Shard(i, self.secret, max_pending) for i in range(shards)]
+        # No read timeout: a worker holds the request while its own backlog is full, and a
+        # timed-out batch sent again would run its updates twice
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0),
+                                         limits=httpx.Limits(max_keepalive_connections=shards * 2))
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        PENDING.set_function(lambda: sum(s.queue.qsize() for s in self.shards))
+
+    async def start(self):
+        for shard in self.shards:
+            shard.spawn()
+        await asyncio.gather(*(shard.wait_ready(self._client) for shard in self.shards))
+        self._tasks = [asyncio.create_task(shard.forward(self._client)) for shard in self.shards]
+        self._tasks.append(asyncio.create_task(self._supervise()))
+
+    async def route(self, update: Dict):
+        await self.shards[shard_of(update, len(self.shards))].queue.put(update)
+
+    async def delivered(self):
+        """Wait until every update routed so far has been accepted by its worker."""
+        await asyncio.gather(*(shard.queue.join() for shard in self.shards))
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1.0)
+            for shard in self.shards:
+                if not self._stopping and shard.proc.poll() is not None:
+                    logger.error("Shard %d exited with %s; restarting it", shard.index, shard.proc.returncode)
+                    RESTARTS.labels(str(shard.index)).inc()
+                    shard.spawn()
+
+    async def close(self, drain_timeout: float = 10.0):
+        """Hand over what is queued, then stop the workers (each finishes its own shutdown)."""
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(s.queue.join() for s in self.shards)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%d update(s) not handed over at shutdown",
+                           sum(s.queue.qsize() for s in self.shards))
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(*(shard.stop() for shard in self.shards))
+        await self._client.aclose()
+
+
+async def poll_updates(router: ShardRouter, client: httpx.AsyncClient):
+    """
+    getUpdates loop. An offset is confirmed (by the next getUpdates) only
+    after the workers accepted its updates, so if the front dies before
+    that, Telegram sends them again.
+    """
+    api = f"{TELEGRAM_API_URL}{BOT_TOKEN}"
+    (await client.post(f"{api}/deleteWebhook")).raise_for_status()
+    offset = 0
+    delay = 1.0
+    while True:
+        try:
+            r = await client.post(f"{api}/getUpdates", json={"offset": offset, "timeout": POLL_TIMEOUT},
+                                  timeout=POLL_TIMEOUT + 10)
+            updates = r.json()["result"]
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning("getUpdates failed (%s); retrying in %.0fs", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 30.0)
+            continue
+        delay = 1.0
+        for update in updates:
+            await router.route(update)
+        await router.delivered()
+        if updates:
+            offset = updates[-1]["update_id"] + 1
+        if POLLING_INTERVAL:
+            await asyncio.sleep(POLLING_INTERVAL)
+
+
+async def watch_parent(stop: asyncio.Event, interval: float = 1.0):
+    """In a worker: set `stop` once the front process is gone, even if it was killed outright."""
+    parent = os.getppid()
+    while os.getppid() == parent:
+        await asyncio.sleep(interval)
+    stop.set()
+
+
+def webhook_app(router: ShardRouter) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            update = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        # Blocks while the worker's queue is full, which slows Telegram's delivery down
+        await router.route(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.router.add_get("/", health)
+    return app
+
+
+async def run_front():
+    if WEBHOOK_MODE and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode when WEBHOOK_URL is empty")
+    router = ShardRouter(SHARDS, UPDATE_MAX_PENDING)
+    client = httpx.AsyncClient(timeout=30.0)
+    stop = asyncio.Event()
+    # Render and most supervisors stop services with SIGTERM; shut the workers down cleanly then too
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    lag_watcher = asyncio.create_task(watch_loop_lag())
+    metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    runner = None
+    receiver = None
+    try:
+        if metrics_server is not None:
+            await metrics_server.start()
+        await router.start()
+        if WEBHOOK_MODE:
+            runner = web.AppRunner(webhook_app(router), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, WEBHOOK_HOST, PORT).start()
+            if WEBHOOK_URL:
+                params = {"url": WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, "allowed_updates": Update.ALL_TYPES,
+                          "secret_token": WEBHOOK_SECRET}
+                r = await client.post(f"{TELEGRAM_API_URL}{BOT_TOKEN}/setWebhook", json=params)
+                r.raise_for_status()
+        else:
+            receiver = asyncio.create_task(poll_updates(router, client))
+        logger.info("Front routing updates to %d shard(s)", SHARDS)
+        await stop.wait()
+    finally:
+        lag_watcher.cancel()
+        if receiver is not None:
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        if runner is not None:
+            await runner.cleanup()
+        await router.close()
+        if metrics_server is not None:
+            await metrics_server.stop()
+        await client.aclose()
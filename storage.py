@@ -1,9 +1,90 @@
+import asyncio
+import bisect
 import json
+import logging
 import os
+import sqlite3
+import struct
+import tempfile
 import threading
-from typing import Any, Dict
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-_lock = threading.Lock()
+from catalog import Catalog
+from metrics import LOCK_WAIT_SECONDS, STORAGE_BYTES, STORAGE_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the lock then only covers this process
+    fcntl = None
+
+# Metric children resolved once; each observation is then a couple of additions
+_JSON_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("json")
+_SQLITE_LOCK_WAIT = LOCK_WAIT_SECONDS.labels("sqlite")
+_JSON_READ_SECONDS = STORAGE_SECONDS.labels("json_read")
+_JSON_WRITE_SECONDS = STORAGE_SECONDS.labels("json_write")
+_SQLITE_WRITE_SECONDS = STORAGE_SECONDS.labels("sqlite_write")
+_USERS_FLUSH_SECONDS = STORAGE_SECONDS.labels("users_flush")
+_JSON_READ_BYTES = STORAGE_BYTES.labels("json_read")
+_JSON_WRITE_BYTES = STORAGE_BYTES.labels("json_write")
+
+logger = logging.getLogger(__name__)
+
+# Catalog edits remembered in files.json for other processes to pick up; one that
+# falls further behind reloads the whole catalog
+FILE_EDIT_LOG = 1000
+
+DEFAULT_USER = {
+    "font": "normal",          # small | normal | big | code
+    "feedback_popup": True,    # show post-deepseek popup
+    "deepseek_mode": "normal"  # normal | coder
+}
+
+class FileLock:
+    """
+    Exclusive lock on a JSON document, held across threads of this process
+    (threading.Lock) and across processes (flock on a side file next to
+    it), so shard workers sharing data/ don't interleave their writes.
+    """
+
+    def __init__(self, path: str):
+        directory, name = os.path.split(path)
+        self.lock_path = os.path.join(directory, f".{name}.lock")
+        self._thread_lock = threading.Lock()
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            try:
+                if self._fd is None:
+                    self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+_locks: Dict[str, FileLock] = {}
+_locks_guard = threading.Lock()
+
+@contextmanager
+def _locked(path: str):
+    key = os.path.abspath(path)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = FileLock(key)
+    waited = time.perf_counter()
+    with lock:
+        _JSON_LOCK_WAIT.observe(time.perf_counter() - waited)
+        yield
 
 def ensure_file(path: str, default: Any):
     os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -11,44 +92,599 @@ def ensure_file(path: str, default: Any):
         with open(path, "w", encoding="utf-8") as f:
             json.dump(default, f, ensure_ascii=False, indent=2)
 
+def _read(path: str) -> Any:
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        raw = f.read()
+    _JSON_READ_SECONDS.observe(time.perf_counter() - started)
+    _JSON_READ_BYTES.inc(len(raw))
+    return json.loads(raw)
+
+def _write(path: str, raw: bytes):
+    started = time.perf_counter()
+    _atomic_write(path, raw)
+    _JSON_WRITE_SECONDS.observe(time.perf_counter() - started)
+    _JSON_WRITE_BYTES.inc(len(raw))
+
+def _encode(data: Any, indent: Optional[int]) -> bytes:
+    return json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")
+
 def read_json(path: str) -> Any:
     ensure_file(path, default={})
-    with _lock:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+    with _locked(path):
+        return _read(path)
 
-def write_json(path: str, data: Any):
+def _atomic_write(path: str, data: bytes):
+    # Write to a temp file in the same directory, then rename over the target,
+    # so a crash mid-write never leaves a truncated JSON file behind.
+    directory = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def write_json(path: str, data: Any, indent: Optional[int] = 2):
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with _lock:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-def get_user(users_path: str, user_id: int) -> Dict:
-    users = read_json(users_path)
-    u = users.get(str(user_id), {})
-    if not u:
-        u = {
-            "font": "normal",          # small | normal | big | code
-            "feedback_popup": True,    # show post-deepseek popup
-            "deepseek_mode": "normal"  # normal | coder
-        }
-        users[str(user_id)] = u
-        write_json(users_path, users)
-    return u
-
-def set_user(users_path: str, user_id: int, key: str, value):
-    users = read_json(users_path)
-    u = users.get(str(user_id), {})
-    u[key] = value
-    users[str(user_id)] = u
-    write_json(users_path, users)
-
-def add_file(files_path: str, file_entry: Dict):
-    files = read_json(files_path)
-    files.setdefault("items", [])
-    files["items"].append(file_entry)
-    write_json(files_path, files)
-
-def list_files(files_path: str):
-    files = read_json(files_path)
-    return files.get("items", [])
\ No newline at end of file
+    raw = _encode(data, indent)
+    with _locked(path):
+        _write(path, raw)
+
+def update_json(path: str, mutate: Callable[[Any], Any], indent: Optional[int] = 2) -> Any:
+    """
+    Read, mutate in place and write back the document at `path`, all under
+    its lock, so concurrent writers (threads or processes) can't lose each
+    other's changes. Returns what mutate() returned.
+    """
+    ensure_file(path, default={})
+    with _locked(path):
+        data = _read(path)
+        result = mutate(data)
+        _write(path, _encode(data, indent))
+    return result
+
+def file_version(path: str):
+    """Changes whenever the file is replaced; None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def read_records(path: str, record: struct.Struct, offset: int = 0) -> bytes:
+    """
+    The whole records of the append-only log at `path` after `offset`. A
+    partial record at the end (a crash mid-append) is cut off the file, so
+    later appends stay aligned.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    whole = len(data) - len(data) % record.size
+    if whole != len(data):
+        logger.warning("Cutting %d stray byte(s) off %s", len(data) - whole, path)
+        with open(path, "r+b") as f:
+            f.truncate(offset + whole)
+    return data[:whole]
+
+# ---------- Backends ----------
+
+class StorageBackend:
+    """
+    Persistence for user settings and the file catalog.
+    Users are keyed by str(user_id); files are an ordered list addressed by
+    zero-based index (the position shown in DATA).
+    """
+
+    def load_users(self) -> Dict[str, Dict]:
+        raise NotImplementedError
+
+    def save_users(self, rows: Dict[str, Dict]):
+        """
+        Persist changed user fields: each row holds only the fields to set,
+        merged into the stored row (DEFAULT_USER for a user not stored yet),
+        so writers changing different fields of one user never undo each other.
+        """
+        raise NotImplementedError
+
+    def list_files(self) -> List[Dict]:
+        raise NotImplementedError
+
+    def add_file(self, entry: Dict) -> int:
+        """Append a catalog entry and return its index."""
+        raise NotImplementedError
+
+    def add_files(self, entries: List[Dict]):
+        """Append several entries in one write."""
+        for entry in entries:
+            self.add_file(entry)
+
+    def update_file(self, index: int, fields: Dict) -> bool:
+        """Merge fields into the entry at index; False if out of range."""
+        raise NotImplementedError
+
+    def files_version(self):
+        """Opaque token that changes whenever any process changes the catalog."""
+        raise NotImplementedError
+
+    def file_changes(self, count: int, cursor) -> Optional[Tuple[Any, List[Dict], Dict[int, Dict]]]:
+        """
+        What a reader holding the first `count` entries, as of `cursor`, is
+        missing: (new cursor, entries appended after those, {position: entry}
+        for those edited since). cursor None = nothing held yet. None when
+        the reader has to start over with file_changes(0, None).
+        This fallback re-reads everything and reports every held entry as edited.
+        """
+        items = self.list_files()
+        if len(items) < count:
+            return None
+        return 0, items[count:], dict(enumerate(items[:count])) if cursor is not None else {}
+
+    def close(self):
+        pass
+
+class JsonBackend(StorageBackend):
+    """
+    The original layout: users.json and files.json rewritten as whole documents.
+    With shared=True (several shard workers on the same files), user flushes
+    merge their fields into the file on disk and catalog writes
+    read-modify-write it under the file lock. Otherwise both are rewritten
+    from this process's own copy, without reading the file back first.
+    """
+
+    def __init__(self, users_path: str, files_path: str, shared: bool = False):
+        self.users_path = users_path
+        self.files_path = files_path
+        self.shared = shared
+        self._users: Dict[str, Dict] = {}
+        # Unshared: files.json as last read or written here, kept apart from the catalog's entries
+        self._files: Optional[Dict] = None
+        self._files_lock = threading.Lock()
+
+    def load_users(self) -> Dict[str, Dict]:
+        users = read_json(self.users_path)
+        self._users = {k: dict(v) for k, v in users.items()}
+        return users
+
+    def save_users(self, rows: Dict[str, Dict]):
+        if self.shared:
+            update_json(self.users_path, lambda users: _merge_users(users, rows), None)
+            return
+        # Called from the flush thread only, so the private copy needs no extra locking
+        _merge_users(self._users, rows)
+        write_json(self.users_path, self._users, None)
+
+    def list_files(self) -> List[Dict]:
+        if self.shared:
+            return read_json(self.files_path).get("items", [])
+        with self._files_lock:
+            self._files = read_json(self.files_path)
+            return [dict(item) for item in self._files.get("items", [])]
+
+    def _update_files(self, mutate: Callable[[Dict], Any]) -> Any:
+        if self.shared:
+            return update_json(self.files_path, mutate)
+        # Catalog writes may run in worker threads; the lock also keeps the copy still while it is encoded
+        with self._files_lock:
+            if self._files is None:
+                self._files = read_json(self.files_path)
+            result = mutate(self._files)
+            write_json(self.files_path, self._files)
+        return result
+
+    def add_file(self, entry: Dict) -> int:
+        def append(files):
+            items = files.setdefault("items", [])
+            items.append(dict(entry))
+            return len(items) - 1
+
+        return self._update_files(append)
+
+    def add_files(self, entries: List[Dict]):
+        self._update_files(lambda files: files.setdefault("items", []).extend(map(dict, entries)))
+
+    def update_file(self, index: int, fields: Dict) -> bool:
+        def merge(files):
+            items = files.setdefault("items", [])
+            if index < 0 or index >= len(items):
+                return False
+            items[index].update(fields)
+            # Logged so other processes reload just this entry
+            files["edits"] = seq = files.get("edits", 0) + 1
+            edited = files.setdefault("edited", [])
+            edited.append([seq, index])
+            del edited[:-FILE_EDIT_LOG]
+            return True
+
+        return self._update_files(merge)
+
+    def files_version(self):
+        return file_version(self.files_path)
+
+    def file_changes(self, count: int, cursor) -> Optional[Tuple[Any, List[Dict], Dict[int, Dict]]]:
+        # A JSON document can only be read whole; what is spared is comparing it with the catalog
+        files = read_json(self.files_path)
+        items = files.get("items", [])
+        seq = files.get("edits", 0)
+        edited = files.get("edited", [])
+        if len(items) < count:
+            return None
+        if cursor is None or cursor == seq:
+            return seq, items[count:], {}
+        if not edited or edited[0][0] > cursor + 1:
+            return None  # edits missed: the log was cut past the cursor
+        return seq, items[count:], {index: items[index] for s, index in edited if s > cursor and index < count}
+
+class SqliteBackend(StorageBackend):
+    """
+    SQLite in WAL mode: one primary-key row per user, one row per file.
+    Writes touch only the affected rows and readers do not block each other.
+    Safe to share between processes: SQLite locks the file, and a writer
+    waits (sqlite3's 5 s busy timeout) for another process's transaction.
+    Catalog writes bump meta.files_version so other processes notice them.
+    Files are addressed by position through a position -> rowid list; rows
+    are only ever appended (AUTOINCREMENT, one writer at a time), so the list
+    is extended with the rows added since, never rebuilt.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        data    TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id TEXT,
+        data    TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS files_file_id ON files(file_id);
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS file_edits (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id  INTEGER NOT NULL
+    );
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # Shared between the event loop and the flush thread; _db_lock serializes use
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        # files.id of the row at each catalog position
+        self._ids: List[int] = []
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _transaction(self, files: bool = False):
+        waited = time.perf_counter()
+        with self._db_lock:
+            started = time.perf_counter()
+            _SQLITE_LOCK_WAIT.observe(started - waited)
+            # IMMEDIATE takes the write lock up front, so two processes never deadlock upgrading
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                if files:
+                    self._conn.execute(
+                        "INSERT INTO meta(key, value) VALUES('files_version', '1') "
+                        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            finally:
+                _SQLITE_WRITE_SECONDS.observe(time.perf_counter() - started)
+
+    def _write(self, sql: str, rows: Iterable, files: bool = False):
+        with self._transaction(files) as conn:
+            conn.executemany(sql, rows)
+
+    def _sync_ids(self):
+        # Under _db_lock: append the rows added since (by this process or another)
+        last = self._ids[-1] if self._ids else 0
+        self._ids.extend(rowid for (rowid,) in self._conn.execute(
+            "SELECT id FROM files WHERE id > ? ORDER BY id", (last,)
+        ))
+
+    def load_users(self) -> Dict[str, Dict]:
+        with self._db_lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {uid: json.loads(data) for uid, data in rows}
+
+    def save_users(self, rows: Dict[str, Dict]):
+        # Read and merge inside the write transaction: another worker's fields survive
+        with self._transaction() as conn:
+            stored = {}
+            keys = list(rows)
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                stored.update(conn.execute(
+                    f"SELECT user_id, data FROM users WHERE user_id IN ({','.join('?' * len(part))})", part
+                ).fetchall())
+            users = {uid: json.loads(stored[uid]) for uid in rows if uid in stored}
+            _merge_users(users, rows)
+            conn.executemany(
+                "INSERT INTO users(user_id, data) VALUES(?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                [(uid, json.dumps(users[uid], ensure_ascii=False)) for uid in rows],
+            )
+
+    def list_files(self) -> List[Dict]:
+        with self._db_lock:
+            rows = self._conn.execute("SELECT id, data FROM files ORDER BY id").fetchall()
+            self._ids = [rowid for rowid, _ in rows]
+        return [json.loads(data) for _, data in rows]
+
+    def add_file(self, entry: Dict) -> int:
+        with self._transaction(files=True) as conn:
+            conn.execute("INSERT INTO files(file_id, data) VALUES(?, ?)",
+                         (entry.get("file_id"), json.dumps(entry, ensure_ascii=False)))
+            # Same transaction: no other writer can append in between, so ours is the last row
+            self._sync_ids()
+            return len(self._ids) - 1
+
+    def add_files(self, entries: List[Dict]):
+        with self._transaction(files=True) as conn:
+            conn.executemany(
+                "INSERT INTO files(file_id, data) VALUES(?, ?)",
+                [(e.get("file_id"), json.dumps(e, ensure_ascii=False)) for e in entries],
+            )
+            self._sync_ids()
+
+    def update_file(self, index: int, fields: Dict) -> bool:
+        if index < 0:
+            return False
+        with self._db_lock:
+            if index >= len(self._ids):
+                self._sync_ids()
+            if index >= len(self._ids):
+                return False
+            rowid = self._ids[index]
+        with self._transaction(files=True) as conn:
+            (data,) = conn.execute("SELECT data FROM files WHERE id = ?", (rowid,)).fetchone()
+            entry = json.loads(data)
+            entry.update(fields)
+            conn.execute("UPDATE files SET file_id = ?, data = ? WHERE id = ?",
+                         (entry.get("file_id"), json.dumps(entry, ensure_ascii=False), rowid))
+            conn.execute("INSERT INTO file_edits(id) VALUES(?)", (rowid,))
+        return True
+
+    def files_version(self):
+        with self._db_lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'files_version'").fetchone()
+        return row[0] if row else None
+
+    def file_changes(self, count: int, cursor) -> Optional[Tuple[Any, List[Dict], Dict[int, Dict]]]:
+        with self._db_lock:
+            # The edit cursor first: an edit committed after it is only picked up again next time
+            (seq,) = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM file_edits").fetchone()
+            self._sync_ids()
+            ids = self._ids
+            if len(ids) < count:
+                return None
+            appended = []
+            if count < len(ids):
+                appended = [json.loads(data) for (data,) in self._conn.execute(
+                    "SELECT data FROM files WHERE id BETWEEN ? AND ? ORDER BY id", (ids[count], ids[-1])
+                )]
+            edited = {}
+            if cursor is not None and seq > cursor and count:
+                for rowid, data in self._conn.execute(
+                    "SELECT e.id, f.data FROM file_edits e JOIN files f ON f.id = e.id "
+                    "WHERE e.seq > ? AND e.seq <= ? AND e.id <= ?", (cursor, seq, ids[count - 1])
+                ):
+                    # Rows are only appended, so positions follow rowids
+                    edited[bisect.bisect_left(ids, rowid)] = json.loads(data)
+        return seq, appended, edited
+
+    def _migrated(self, locked: bool = False) -> bool:
+        if not locked:
+            with self._db_lock:
+                return self._migrated(locked=True)
+        return self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is not None
+
+    def migrate_from_json(self, users_path: str, files_path: str):
+        """One-shot import of users.json / files.json; later calls are no-ops."""
+        if self._migrated():
+            return
+        users = read_json(users_path) if os.path.exists(users_path) else {}
+        items = read_json(files_path).get("items", []) if os.path.exists(files_path) else []
+        with self._db_lock:
+            # One transaction, so shard workers starting together import the files only once
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if not self._migrated(locked=True):
+                    self._conn.executemany(
+                        "INSERT INTO users(user_id, data) VALUES(?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                        [(uid, json.dumps(u, ensure_ascii=False)) for uid, u in users.items()],
+                    )
+                    self._conn.executemany(
+                        "INSERT INTO files(file_id, data) VALUES(?, ?)",
+                        [(e.get("file_id"), json.dumps(e, ensure_ascii=False)) for e in items],
+                    )
+                    self._conn.execute("INSERT INTO meta(key, value) VALUES('json_migrated', '1')")
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
+
+def open_backend(kind: str, users_path: str, files_path: str, db_path: str,
+                 shared: bool = False) -> StorageBackend:
+    if kind == "sqlite":
+        backend = SqliteBackend(db_path)
+        backend.migrate_from_json(users_path, files_path)
+        return backend
+    if kind == "json":
+        return JsonBackend(users_path, files_path, shared)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+# ---------- Users ----------
+
+def _merge_users(users: Dict[str, Dict], rows: Dict[str, Dict]):
+    """Set each row's fields on the stored user, starting new users from DEFAULT_USER."""
+    for uid, fields in rows.items():
+        user = users.get(uid)
+        if user is None:
+            user = users[uid] = dict(DEFAULT_USER)
+        user.update(fields)
+
+class UserStore:
+    """
+    Resident user settings, loaded once.
+    Reads and writes are dict operations; a write-behind task batches
+    mutations and flushes them to disk every `flush_interval` seconds.
+    Only the fields changed since the last flush are written, so in sharded
+    mode two workers changing different settings of one user (a private
+    chat and a group on different shards) both keep their change. Each
+    worker holds the users whose chats it is routed; refresh() adds the
+    ones other workers created since startup.
+    """
+
+    def __init__(self, backend: StorageBackend, flush_interval: float = 2.0, shared: bool = False):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self._users: Dict[str, Dict] = backend.load_users()
+        # user key -> fields changed since the last flush (empty: a new user with the defaults)
+        self._dirty: Dict[str, set] = {}
+        self._task: Optional[asyncio.Task] = None
+        # One flush at a time: a backend's own copy is written by one thread only
+        self._flushing = asyncio.Lock()
+
+    def get(self, user_id: int) -> Dict:
+        key = str(user_id)
+        u = self._users.get(key)
+        if not u:
+            u = dict(DEFAULT_USER)
+            self._users[key] = u
+            self._dirty.setdefault(key, set())
+        return u
+
+    def set(self, user_id: int, key: str, value):
+        self.get(user_id)[key] = value
+        self._dirty.setdefault(str(user_id), set()).add(key)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def ids(self) -> List[int]:
+        return [int(k) for k in self._users]
+
+    async def refresh(self):
+        """Load users added by other processes; rows already held here win. No-op unless shared."""
+        if not self.shared:
+            return
+        rows = await asyncio.to_thread(self.backend.load_users)
+        for key, row in rows.items():
+            self._users.setdefault(key, row)
+
+    async def flush(self):
+        async with self._flushing:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            # Copy the changed fields so the flush thread never sees a dict being mutated
+            rows = {k: {f: self._users[k][f] for f in fields} for k, fields in dirty.items()}
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.backend.save_users, rows)
+            except BaseException:
+                # Failed or cancelled: written again by the next flush
+                for k, fields in dirty.items():
+                    self._dirty.setdefault(k, set()).update(fields)
+                raise
+            finally:
+                _USERS_FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # Shielded: close() cancels this loop but lets a flush under way finish
+                await asyncio.shield(self.flush())
+            except Exception:
+                pass  # keep dirty; retried on the next tick
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Waits for a flush the loop had under way, then writes what is left
+        await self.flush()
+
+# ---------- Module API ----------
+
+_backend: Optional[StorageBackend] = None
+_users: Optional[UserStore] = None
+_catalog: Optional[Catalog] = None
+
+def init_storage(backend: StorageBackend, flush_interval: float = 2.0, shared: bool = False) -> UserStore:
+    """shared=True when other processes (shard workers) write the same backend."""
+    global _backend, _users, _catalog
+    _backend = backend
+    _users = UserStore(backend, flush_interval, shared)
+    _catalog = Catalog(backend, shared)
+    return _users
+
+def _require() -> StorageBackend:
+    if _backend is None:
+        raise RuntimeError("storage not initialized; call init_storage() first")
+    return _backend
+
+def user_store() -> UserStore:
+    _require()
+    return _users
+
+def catalog() -> Catalog:
+    _require()
+    # Picks up uploads and edits made by other shard workers
+    _catalog.refresh()
+    return _catalog
+
+def get_user(user_id: int) -> Dict:
+    return user_store().get(user_id)
+
+def set_user(user_id: int, key: str, value):
+    user_store().set(user_id, key, value)
+
+async def add_file(file_entry: Dict) -> int:
+    return await catalog().add(file_entry)
+
+async def add_files(entries: List[Dict]):
+    """Add entries in one write, skipping duplicates; returns (new indexes, skipped)."""
+    return await catalog().add_many(entries)
+
+def list_files() -> List[Dict]:
+    return catalog().items()
+
+def update_file(index: int, fields: Dict) -> bool:
+    return catalog().update(index, fields)
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from typing import Callable, List, Optional
+
+from telegram import Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+
+from render import TG_MESSAGE_LIMIT, to_plain
+
+PLACEHOLDER = "…"
+
+
+def split_point(text: str, limit: int = TG_MESSAGE_LIMIT) -> int:
+    """Where to cut an over-long text: the last newline in the second half, else the hard limit."""
+    cut = text.rfind("\n", limit // 2, limit)
+    return cut + 1 if cut != -1 else limit
+
+
+async def put_html(reply_to: Message, html_text: str, target: Optional[Message] = None) -> Message:
+    """
+    Edit `target` (or send a new reply to `reply_to`) with rendered HTML.
+    Falls back to the plain text if Telegram rejects the markup, and waits
+    out RetryAfter as often as it comes: the message returned has always
+    been sent.
+    """
+    while True:
+        try:
+            try:
+                if target is None:
+                    return await reply_to.reply_text(html_text, parse_mode=ParseMode.HTML)
+                await target.edit_text(html_text, parse_mode=ParseMode.HTML)
+                return target
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return target
+                plain = to_plain(html_text)
+                if target is None:
+                    return await reply_to.reply_text(plain)
+                await target.edit_text(plain)
+                return target
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+            return target
+
+
+async def send_chunks(reply_to: Message, chunks: List[str]) -> List[Message]:
+    """Send rendered chunks as consecutive replies, in order."""
+    return [await put_html(reply_to, chunk) for chunk in chunks]
+
+
+class StreamingReply:
+    """
+    Renders a streamed completion into Telegram messages.
+    Posts a placeholder reply, then edits it at most once per `min_interval`
+    seconds (Telegram throttles edits per chat). While streaming, text is
+    shown raw and rolls over into a new reply beyond 4096 characters. At the
+    end, `render` (full text -> HTML chunks) lays the whole answer out again:
+    the sent messages are edited in place, extra chunks are appended and
+    leftover messages deleted.
+
+    `sent` resumes a reply whose messages were posted earlier (e.g. by a
+    previous run of a queued job); `on_sent` is called with the message list
+    whenever a new message is posted, so it can be saved.
+    """
+
+    def __init__(self, message: Message, min_interval: float = 1.0,
+                 render: Optional[Callable[[str], List[str]]] = None,
+                 sent: Optional[List[Message]] = None,
+                 on_sent: Optional[Callable[[List[Message]], None]] = None):
+        self.message = message
+        self.min_interval = min_interval
+        self.render = render
+        self.on_sent = on_sent
+        self.sent: List[Message] = list(sent or [])
+        self._current: Optional[Message] = self.sent[0] if self.sent else None
+        self._buf = ""
+        self._parts: List[str] = []
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def start(self):
+        """Post the placeholder; a resumed reply starts over in its first message instead."""
+        if self.sent:
+            await self._delete(self.sent[1:])
+            del self.sent[1:]
+            self._current = self.sent[0]
+            return
+        self._current = await self.message.reply_text(PLACEHOLDER)
+        self._posted(self._current)
+
+    def _posted(self, msg: Message):
+        self.sent.append(msg)
+        if self.on_sent is not None:
+            self.on_sent(self.sent)
+
+    @staticmethod
+    async def _delete(messages: List[Message]):
+        for msg in messages:
+            try:
+                await msg.delete()
+            except BadRequest:
+                pass
+
+    async def _edit(self, text: str, final: bool = False):
+        if not text or (text == self._shown and not final):
+            return
+        for _ in range(2):
+            try:
+                await self._current.edit_text(text)
+                self._shown = text
+                return
+            except RetryAfter as e:
+                if not final:
+                    self._next_edit = time.monotonic() + float(e.retry_after)
+                    return
+                await asyncio.sleep(float(e.retry_after))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                self._shown = text
+                return
+
+    async def feed(self, delta: str):
+        self._buf += delta
+        self._parts.append(delta)
+        while len(self._buf) > TG_MESSAGE_LIMIT:
+            cut = split_point(self._buf)
+            head, self._buf = self._buf[:cut], self._buf[cut:]
+            await self._edit(head, final=True)
+            self._current = await self.message.reply_text(self._buf[:TG_MESSAGE_LIMIT] or PLACEHOLDER)
+            self._posted(self._current)
+            self._shown = self._buf[:TG_MESSAGE_LIMIT]
+        now = time.monotonic()
+        if now >= self._next_edit:
+            self._next_edit = now + self.min_interval
+            await self._edit(self._buf)
+
+    @property
+    def text(self) -> str:
+        """Everything received so far, across all rolled-over messages."""
+        return "".join(self._parts)
+
+    async def finish(self, fallback: str = "No content returned.", text: Optional[str] = None):
+        """Lay out the final answer: the streamed text, or `text` when it arrived in one piece."""
+        streamed = text is None
+        if streamed:
+            text = self.text
+        chunks = self.render(text) if self.render is not None and text.strip() else []
+        if not chunks:
+            await self._edit((self._buf if streamed else text[:TG_MESSAGE_LIMIT]) or fallback, final=True)
+            return
+        for i, chunk in enumerate(chunks):
+            target = self.sent[i] if i < len(self.sent) else None
+            msg = await put_html(self.message, chunk, target)
+            if target is None:
+                self._posted(msg)
+        await self._delete(self.sent[len(chunks):])
+        del self.sent[len(chunks):]
+
+    async def fail(self, text: str):
+        """Replace the pending placeholder (or append to partial output) with an error note."""
+        if self._buf:
+            await self._edit(f"{self._buf}\n\n{text}"[-TG_MESSAGE_LIMIT:], final=True)
+        else:
+            await self._edit(text, final=True)
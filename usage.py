@@ -0,0 +1,338 @@
+import asyncio
+import heapq
+import logging
+import os
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+from metrics import counter, histogram
+from storage import read_json, read_records, write_json
+
+# One Deepseek call: unix time, user id, prompt tokens, completion tokens, flags
+RECORD = struct.Struct("<IqIIB")
+CODER, VISION, ESTIMATED = 1, 2, 4
+
+TOKENS = counter("deepseek_tokens_total", "Deepseek tokens used, by kind (usage reported by the API or estimated).",
+                 ["kind"])
+QUOTA_REFUSED = counter("usage_quota_refused_total", "Prompts refused because a token quota was used up.", ["period"])
+FLUSH_SECONDS = histogram("usage_ledger_flush_seconds", "Time to append buffered usage records to the ledger.")
+
+logger = logging.getLogger(__name__)
+
+
+def day_of(ts: float) -> int:
+    return int(ts // 86400)
+
+
+def month_of(ts: float) -> int:
+    t = time.gmtime(ts)
+    return t.tm_year * 12 + t.tm_mon - 1
+
+
+def month_name(month: int) -> str:
+    return f"{month // 12:04d}-{month % 12 + 1:02d}"
+
+
+class UsageLedger:
+    """
+    Token usage per user: an append-only ledger on disk plus rolling counters
+    in memory.
+
+    Every call is one fixed-size binary record appended to the current
+    month's segment (`<dir>/YYYY-MM.log`). Records are buffered and written in
+    one append per `flush_interval`, so recording costs no I/O on the request
+    path. Each user has one counter row, [day, day tokens, month, month prompt
+    tokens, month completion tokens, month calls] (UTC days and calendar
+    months), that rolls over lazily, so quota checks are a dict lookup.
+
+    Compaction: every `snapshot_interval` the rows for this month are written
+    to `<dir>/snapshot.json` with the segment's length at that point. start()
+    loads the snapshot and replays only the records appended after it (a
+    torn record at the end is cut off), so a restart reads a few seconds of
+    ledger, not the month. Older months' segments are never read again; they
+    stay as the audit trail. Rows of users idle since last month are dropped
+    at the next snapshot.
+
+    With SHARDS > 1 each worker keeps its own directory (`<dir>/shard-<i>`).
+    Updates are routed by chat, so one user (a private chat and a group) can
+    spend on several workers. Each worker therefore also follows the other
+    workers' ledgers, read-only: their snapshots at start, then whatever they
+    append, picked up on every flush tick. Quota checks, usage() and report()
+    count the user's tokens on all workers, at most a couple of flush
+    intervals behind for the other workers' share.
+    """
+
+    def __init__(self, directory: str, daily_limit: int = 0, monthly_limit: int = 0,
+                 flush_interval: float = 1.0, snapshot_interval: float = 60.0,
+                 shard: int = -1, shards: int = 1):
+        base = directory
+        self.directory = os.path.join(base, f"shard-{shard}") if shard >= 0 else directory
+        # The other workers' directories, and how far their ledgers have been read
+        self.peers = [{"directory": os.path.join(base, f"shard-{i}"), "month": None, "offset": 0}
+                      for i in range(shards) if i != shard] if shard >= 0 else []
+        self.snapshot_path = os.path.join(self.directory, "snapshot.json")
+        self.daily_limit = daily_limit
+        self.monthly_limit = monthly_limit
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self._rows: Dict[int, List[int]] = {}
+        # The same rows summed over the other workers' ledgers
+        self._peer_rows: Dict[int, List[int]] = {}
+        self._pending: List[bytes] = []
+        # Token totals of the pending records, added to the metric on flush
+        self._unflushed = [0, 0]
+        self._log = None
+        self._log_month: Optional[int] = None
+        self._day = self._month = -1
+        self._day_ends = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.replayed = 0
+
+    # ---------- Counters ----------
+
+    def _periods(self, now: float) -> Tuple[int, int]:
+        # gmtime() only when the UTC day changes (replayed records come in order, so rarely there too)
+        if now >= self._day_ends or now < self._day_ends - 86400:
+            self._day, self._month = day_of(now), month_of(now)
+            self._day_ends = (self._day + 1) * 86400.0
+        return self._day, self._month
+
+    def _apply(self, ts: float, user_id: int, prompt: int, completion: int, rows: Optional[Dict] = None):
+        day, month = self._periods(ts)
+        rows = self._rows if rows is None else rows
+        row = rows.get(user_id)
+        if row is None:
+            row = rows[user_id] = [day, 0, month, 0, 0, 0]
+        if month > row[2]:
+            row[2:] = [month, 0, 0, 0]
+        if day > row[0]:
+            row[0], row[1] = day, 0
+        # A straggler from an earlier period (e.g. written just after midnight) counts nowhere
+        if day == row[0]:
+            row[1] += prompt + completion
+        if month == row[2]:
+            row[3] += prompt
+            row[4] += completion
+            row[5] += 1
+
+    def record(self, user_id: int, prompt_tokens: int, completion_tokens: int, flags: int = 0,
+               now: Optional[float] = None):
+        now = time.time() if now is None else now
+        prompt_tokens, completion_tokens = max(0, int(prompt_tokens)), max(0, int(completion_tokens))
+        self._apply(now, user_id, prompt_tokens, completion_tokens)
+        self._pending.append(RECORD.pack(int(now), user_id, prompt_tokens, completion_tokens, flags))
+        self._unflushed[0] += prompt_tokens
+        self._unflushed[1] += completion_tokens
+
+    def _totals(self, user_id: int, day: int, month: int) -> Tuple[int, int, int, int]:
+        """The user's tokens today, and prompt/completion tokens and calls this month, on all workers."""
+        today = prompt = completion = calls = 0
+        for row in (self._rows.get(user_id), self._peer_rows.get(user_id)):
+            if row is None:
+                continue
+            if row[0] == day:
+                today += row[1]
+            if row[2] == month:
+                prompt, completion, calls = prompt + row[3], completion + row[4], calls + row[5]
+        return today, prompt, completion, calls
+
+    def over_quota(self, user_id: int, now: Optional[float] = None) -> Optional[str]:
+        """The quota the user has used up ("day" or "month"), or None."""
+        if user_id not in self._rows and user_id not in self._peer_rows:
+            return None
+        day, month = self._periods(time.time() if now is None else now)
+        today, prompt, completion, _ = self._totals(user_id, day, month)
+        if self.daily_limit and today >= self.daily_limit:
+            QUOTA_REFUSED.labels("day").inc()
+            return "day"
+        if self.monthly_limit and prompt + completion >= self.monthly_limit:
+            QUOTA_REFUSED.labels("month").inc()
+            return "month"
+        return None
+
+    def usage(self, user_id: int, now: Optional[float] = None) -> Dict:
+        day, month = self._periods(time.time() if now is None else now)
+        today, prompt, completion, calls = self._totals(user_id, day, month)
+        return {"today": today, "month": prompt + completion, "prompt": prompt, "completion": completion,
+                "calls": calls, "daily_limit": self.daily_limit, "monthly_limit": self.monthly_limit}
+
+    def _month_rows(self, month: int, rows: Optional[Dict] = None) -> Dict[int, List[int]]:
+        return {uid: row for uid, row in (self._rows if rows is None else rows).items() if row[2] == month}
+
+    def report(self, n: int = 10, now: Optional[float] = None) -> Tuple[List[Tuple[int, int, int, int]], int]:
+        """
+        Top `n` users by tokens this month as (user_id, prompt, completion,
+        calls), and the month's total over all users, on all workers.
+        """
+        _, month = self._periods(time.time() if now is None else now)
+        totals = {uid: row[3:] for uid, row in self._month_rows(month).items()}
+        for uid, row in self._month_rows(month, self._peer_rows).items():
+            mine = totals.get(uid, (0, 0, 0))
+            totals[uid] = [a + b for a, b in zip(mine, row[3:])]
+        top = heapq.nlargest(n, totals.items(), key=lambda item: item[1][0] + item[1][1])
+        total = sum(p + c for p, c, _ in totals.values())
+        return [(uid, p, c, calls) for uid, (p, c, calls) in top], total
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    # ---------- Ledger ----------
+
+    def _segment(self, month: int, directory: Optional[str] = None) -> str:
+        return os.path.join(directory or self.directory, f"{month_name(month)}.log")
+
+    def _replay(self, path: str, offset: int) -> int:
+        """Apply the records after `offset`; returns the end of the last whole record."""
+        if not os.path.exists(path):
+            return 0
+        data = read_records(path, RECORD, offset)
+        for ts, user_id, prompt, completion, _ in RECORD.iter_unpack(data):
+            self._apply(ts, user_id, prompt, completion)
+        self.replayed += len(data) // RECORD.size
+        return offset + len(data)
+
+    def load(self, now: Optional[float] = None):
+        """Rebuild the counters: snapshot, then the ledger written after it."""
+        now = time.time() if now is None else now
+        os.makedirs(self.directory, exist_ok=True)
+        snap = read_json(self.snapshot_path) if os.path.exists(self.snapshot_path) else {}
+        self._rows = {int(uid): row for uid, row in snap.get("users", {}).items()}
+        self.replayed = 0
+        month = month_of(now)
+        snap_month = snap.get("month")
+        if snap_month is not None:
+            self._replay(self._segment(snap_month), snap.get("offset", 0))
+        if snap_month != month:
+            # First start this month (or no snapshot yet): this month's segment from the start
+            self._replay(self._segment(month), 0)
+
+    def _follow(self, peer: Dict, month: int):
+        """Apply the whole records another worker appended since the last call; its files are never written."""
+        if peer["month"] != month:
+            # That worker's first flush this month starts a new segment
+            if peer["month"] is not None:
+                self._tail(peer)
+            peer["month"], peer["offset"] = month, 0
+        self._tail(peer)
+
+    def _tail(self, peer: Dict):
+        path = self._segment(peer["month"], peer["directory"])
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            f.seek(peer["offset"])
+            data = f.read()
+        # A record still being written is left for the next call
+        whole = len(data) - len(data) % RECORD.size
+        for ts, user_id, prompt, completion, _ in RECORD.iter_unpack(data[:whole]):
+            self._apply(ts, user_id, prompt, completion, self._peer_rows)
+        peer["offset"] += whole
+
+    def load_peers(self, now: Optional[float] = None):
+        """Rebuild the other workers' counters: their snapshots, then their ledgers after them."""
+        now = time.time() if now is None else now
+        self._peer_rows = {}
+        for peer in self.peers:
+            path = os.path.join(peer["directory"], "snapshot.json")
+            snap = read_json(path) if os.path.exists(path) else {}
+            for uid, row in snap.get("users", {}).items():
+                self._add_row(self._peer_rows, int(uid), row)
+            peer["month"], peer["offset"] = snap.get("month"), snap.get("offset", 0)
+            self._follow(peer, month_of(now))
+
+    @staticmethod
+    def _add_row(rows: Dict[int, List[int]], user_id: int, row: List[int]):
+        mine = rows.get(user_id)
+        if mine is None:
+            rows[user_id] = list(row)
+            return
+        if row[0] > mine[0]:
+            mine[0], mine[1] = row[0], row[1]
+        elif row[0] == mine[0]:
+            mine[1] += row[1]
+        if row[2] > mine[2]:
+            mine[2:] = row[2:]
+        elif row[2] == mine[2]:
+            mine[3], mine[4], mine[5] = mine[3] + row[3], mine[4] + row[4], mine[5] + row[5]
+
+    def _open(self, month: int):
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self._segment(month), "ab", buffering=0)
+        self._log_month = month
+
+    def flush(self, now: Optional[float] = None):
+        """Append the buffered records to this month's segment in one write."""
+        if not self._pending:
+            return
+        month = month_of(time.time() if now is None else now)
+        started = time.perf_counter()
+        if self._log is None or self._log_month != month:
+            self._open(month)
+        data, self._pending = b"".join(self._pending), []
+        self._log.write(data)
+        TOKENS.labels("prompt").inc(self._unflushed[0])
+        TOKENS.labels("completion").inc(self._unflushed[1])
+        self._unflushed = [0, 0]
+        FLUSH_SECONDS.observe(time.perf_counter() - started)
+
+    def sync(self, now: Optional[float] = None):
+        """Flush, then pick up what the other workers appended to their ledgers."""
+        now = time.time() if now is None else now
+        self.flush(now)
+        month = month_of(now)
+        for peer in self.peers:
+            self._follow(peer, month)
+
+    def _snapshot_doc(self, now: float) -> Dict:
+        self.flush(now)
+        month = month_of(now)
+        if self._log is None or self._log_month != month:
+            self._open(month)
+        self._rows = self._month_rows(month)
+        self._peer_rows = self._month_rows(month, self._peer_rows)
+        return {
+            "month": month,
+            "offset": self._log.tell(),
+            "written_at": int(now),
+            # Copies: the rows go on changing while the snapshot is written
+            "users": {str(uid): list(row) for uid, row in self._rows.items()},
+        }
+
+    def snapshot(self, now: Optional[float] = None):
+        write_json(self.snapshot_path, self._snapshot_doc(time.time() if now is None else now), indent=None)
+
+    # ---------- Lifecycle ----------
+
+    def start(self):
+        started = time.perf_counter()
+        self.load()
+        self.load_peers()
+        logger.info("Usage ledger: %d user(s) this month (%d on other workers), %d record(s) replayed in %.3fs",
+                    len(self._rows), len(self._peer_rows), self.replayed, time.perf_counter() - started)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        next_snapshot = time.monotonic() + self.snapshot_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.sync()
+                if time.monotonic() >= next_snapshot:
+                    next_snapshot = time.monotonic() + self.snapshot_interval
+                    # Rows are copied here; only the file write leaves the loop
+                    doc = self._snapshot_doc(time.time())
+                    await asyncio.to_thread(write_json, self.snapshot_path, doc, None)
+            except Exception:
+                logger.exception("Usage ledger write failed")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.snapshot()
+        if self._log is not None:
+            self._log.close()
+            self._log = None